@@ -0,0 +1,127 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Queue backed logging. Log records are put on a queue by the green threads
+that log them and a native writer thread formats them and does the file
+I/O, so that logging does not block the eventlet hub.
+"""
+
+import atexit
+import logging
+import time
+
+from eventlet import patcher
+
+# The writer must be a real OS thread even when eventlet has monkey patched
+# the threading and Queue modules
+_threading = patcher.original('threading')
+_Queue = patcher.original('Queue')
+
+_STOP = object()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue without formatting them. Records are formatted
+    by the writer thread, using the formatter set on this handler. If the
+    queue is full the record is dropped rather than blocking the caller.
+    """
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = _Queue.Queue(queue_size)
+        self.dropped = 0
+        self._writer = None
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except _Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord(dict(
+                    name=__name__, levelno=logging.WARN, levelname='WARNING',
+                    msg='Log queue was full, dropped %d messages',
+                    args=(dropped,))))
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def start(self):
+        self._writer = _threading.Thread(target=self._write,
+                                         name='log-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        if self._writer and self._writer.is_alive():
+            self.queue.put(_STOP)
+            self._writer.join(timeout)
+        self.target.close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst identical messages through in every interval seconds.
+    The first message let through after some were suppressed carries the
+    number of suppressed copies.
+    """
+    def __init__(self, interval=60, burst=5):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self._seen = {}
+
+    def _key(self, record):
+        key = (record.name, record.levelno, record.msg)
+        try:
+            return hash(key + (record.args,))
+        except TypeError:
+            return hash(key + (repr(record.args),))
+
+    def filter(self, record):
+        now = time.time()
+        key = self._key(record)
+        window_start, count, suppressed = self._seen.get(key, (now, 0, 0))
+        if now - window_start >= self.interval:
+            window_start, count = now, 0
+        if count >= self.burst:
+            self._seen[key] = (window_start, count, suppressed + 1)
+            return False
+        if suppressed:
+            record.msg = '%s (%d identical messages suppressed)' % (
+                record.msg, suppressed)
+        self._seen[key] = (window_start, count + 1, 0)
+        if len(self._seen) > 10000:
+            self._purge(now)
+        return True
+
+    def _purge(self, now):
+        for key, (window_start, _, suppressed) in self._seen.items():
+            if now - window_start >= self.interval and not suppressed:
+                del self._seen[key]
@@ -17,6 +17,7 @@ import requests
 import logging
 
 from hamgr import exceptions
+from hamgr.common import trace
 
 LOG = logging.getLogger(__name__)
 _URL = 'http://localhost:8080/masakari/v1'
@@ -25,7 +26,8 @@ def get_failover_segment(token, name):
     url = '/'.join([_URL, 'segments'])
     headers = {'X-Auth-Token': token['id'],
                'Content-Type': 'application/json'}
-    resp = requests.get(url, headers=headers)
+    with trace.span('masakari.get_segments') as sp:
+        resp = sp.record_response(requests.get(url, headers=headers))
     resp.raise_for_status()
 
     if 'segments' in resp.json():
@@ -42,7 +44,8 @@ def get_nodes_in_segment(token, name):
     url = '/'.join([_URL, 'segments', segment['uuid'], 'hosts'])
     headers = {'X-Auth-Token': token['id'],
                'Content-Type': 'application/json'}
-    resp = requests.get(url, headers=headers)
+    with trace.span('masakari.get_segment_hosts') as sp:
+        resp = sp.record_response(requests.get(url, headers=headers))
     resp.raise_for_status()
 
     return resp.json()['hosts']
@@ -57,7 +60,8 @@ def delete_failover_segment(token, name):
         nodes = get_nodes_in_segment(token, name)
         for node in nodes:
             url = '/'.join([_URL, 'segments', node['failover_segment_id'], 'hosts', node['uuid']])
-            resp = requests.delete(url, headers=headers)
+            with trace.span('masakari.delete_segment_host') as sp:
+                resp = sp.record_response(requests.delete(url, headers=headers))
             if resp.status_code not in [ requests.codes.no_content, requests.codes.not_found ]:
                 resp.raise_for_status()
     except exceptions.SegmentNotFound:
@@ -65,7 +69,8 @@ def delete_failover_segment(token, name):
 
     url = '/'.join([_URL, 'segments', seg['uuid']])
 
-    resp = requests.delete(url, headers=headers)
+    with trace.span('masakari.delete_segment') as sp:
+        resp = sp.record_response(requests.delete(url, headers=headers))
     if resp.status_code not in [ requests.codes.no_content, requests.codes.not_found ]:
         resp.raise_for_status()
 
@@ -83,7 +88,9 @@ def create_failover_segment(token, name, hosts):
     url = '/'.join([_URL, 'segments'])
     data = dict(name=name, service_type='COMPUTE', recovery_method='auto', description='Created by HA Manager')
 
-    resp = requests.post(url, headers=headers, data=json.dumps(dict(segment=data)))
+    with trace.span('masakari.create_segment') as sp:
+        resp = sp.record_response(requests.post(
+            url, headers=headers, data=json.dumps(dict(segment=data))))
     resp.raise_for_status()
 
     seg = resp.json()['segment']
@@ -94,7 +101,9 @@ def create_failover_segment(token, name, hosts):
                               reserved='False',
                               on_maintenance='False',
                               control_attributes=''))
-        resp = requests.post(url, headers=headers, data=json.dumps(data))
+        with trace.span('masakari.create_segment_host') as sp:
+            resp = sp.record_response(requests.post(
+                url, headers=headers, data=json.dumps(data)))
         resp.raise_for_status()
 
 
@@ -105,8 +114,9 @@ def create_notification(token, ntype, hostname, time, payload):
         'Content-Type': 'application/json'
     }
     url = '/'.join([_URL, 'notifications'])
-    resp = requests.post(url, headers=headers,
-                         data=json.dumps(dict(notification=data)))
+    with trace.span('masakari.create_notification') as sp:
+        resp = sp.record_response(requests.post(
+            url, headers=headers, data=json.dumps(dict(notification=data))))
     if resp.status_code == requests.codes.accepted:
         LOG.info('Status notification successfully accepted by masakari')
         LOG.info('Masakari response: %s', resp.json())
@@ -133,7 +143,9 @@ def get_notifications(token, host_id, generated_since=None):
     }
     if generated_since:
         query_params['generated-since'] = generated_since
-    resp = requests.get(url, params=query_params, headers=headers)
+    with trace.span('masakari.get_notifications') as sp:
+        resp = sp.record_response(requests.get(url, params=query_params,
+                                               headers=headers))
     if resp.status_code == requests.codes.ok:
         LOG.debug('Fetched notifications for %s', host_id)
     else:
@@ -0,0 +1,112 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Ordering of the hosts of a consul cluster, the first ones become its servers.
+The ordering is driven by placement inputs, each of which reads one kind of
+data about the hosts from nova:
+
+    load    hosts using less of their vcpus and memory come first
+    zone    hosts are spread over the nova availability zones
+
+Hosts without a score come after the scored ones. Ties are ordered by host
+ID so that the same hosts always get the same order.
+"""
+
+import logging
+
+LOG = logging.getLogger(__name__)
+_NO_SCORE = float('inf')
+
+
+def _usage(hypervisor):
+    usage = []
+    for used, total in [('vcpus_used', 'vcpus'),
+                        ('memory_mb_used', 'memory_mb')]:
+        total = getattr(hypervisor, total, None)
+        if total:
+            usage.append(float(getattr(hypervisor, used, 0) or 0) / total)
+    return max(usage) if usage else None
+
+
+def load_scores(client, hosts):
+    """
+    Map hosts to the fraction of their vcpus or memory in use, whichever is
+    higher
+    """
+    lookup = set(hosts)
+    scores = {}
+    for hyp in client.hypervisors.list():
+        host_id = hyp.service['host']
+        if host_id in lookup:
+            usage = _usage(hyp)
+            if usage is not None:
+                scores[host_id] = usage
+    return scores
+
+
+def zone_domains(client, hosts):
+    """
+    Map hosts to the availability zone of their nova-compute service
+    """
+    lookup = set(hosts)
+    return dict((service.host, service.zone)
+                for service in client.services.list(binary='nova-compute')
+                if service.host in lookup and getattr(service, 'zone', None))
+
+
+INPUTS = {
+    'load': load_scores,
+    'zone': zone_domains,
+}
+
+
+def order_hosts(hosts, scores=None, domains=None):
+    """
+    Order the hosts by score, lowest first, taking one host of every
+    failure domain in turn so that the first hosts are in as many domains
+    as possible. Hosts without a domain share one.
+    """
+    scores = scores or {}
+    domains = domains or {}
+
+    def key(host):
+        return (scores.get(host, _NO_SCORE), host)
+
+    by_domain = {}
+    for host in sorted(hosts, key=key):
+        by_domain.setdefault(domains.get(host), []).append(host)
+    # Domains take turns in the order of their best host
+    queues = sorted(by_domain.values(), key=lambda queue: key(queue[0]))
+    ordered = []
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def read_inputs(client, hosts, inputs):
+    """
+    Read the named placement inputs for the hosts, as keyword arguments of
+    order_hosts. Inputs that cannot be read are left out.
+    """
+    data = {}
+    for name in inputs:
+        try:
+            data[name] = INPUTS[name](client, hosts)
+        except Exception:
+            LOG.exception('Could not read %s for consul server placement',
+                          name)
+    return dict(scores=data.get('load'), domains=data.get('zone'))
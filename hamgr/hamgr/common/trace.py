@@ -0,0 +1,239 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Timing instrumentation for calls made to downstream services.
+
+Every call is recorded as a span carrying its duration, HTTP status code and
+response payload size. Spans opened while a trace is active share its trace
+ID, so that all the hops made while handling one operation (e.g. a host down
+event) can be looked at together. Finished spans are handed to the configured
+sinks.
+"""
+
+import collections
+import functools
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from uuid import uuid4
+
+LOG = logging.getLogger(__name__)
+
+TRACE_HEADER = 'X-Trace-Id'
+
+_sinks = []
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, name, trace_id=None, operation=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.operation = operation
+        self.start = time.time()
+        self.duration = None
+        self.status_code = None
+        self.payload_size = None
+        self.error = None
+
+    def record_response(self, resp):
+        """
+        Record the status code and payload size of a requests response
+        """
+        self.status_code = getattr(resp, 'status_code', None)
+        try:
+            self.payload_size = len(resp.content)
+        except (AttributeError, TypeError):
+            pass
+        return resp
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    trace_id=self.trace_id,
+                    operation=self.operation,
+                    start=self.start,
+                    duration=self.duration,
+                    status_code=self.status_code,
+                    payload_size=self.payload_size,
+                    error=self.error)
+
+
+class LogSink(object):
+    """
+    Writes every finished span to the log
+    """
+    def __init__(self, logger=LOG, level=logging.INFO):
+        self._logger = logger
+        self._level = level
+
+    def emit(self, span):
+        self._logger.log(self._level,
+                         'span %s trace=%s operation=%s duration=%.3fs '
+                         'status=%s size=%s error=%s', span.name,
+                         span.trace_id, span.operation, span.duration,
+                         span.status_code, span.payload_size, span.error)
+
+
+class RingBufferSink(object):
+    """
+    Keeps the most recent spans in memory so that they can be queried
+    """
+    def __init__(self, size=1000):
+        self._spans = collections.deque(maxlen=size)
+
+    def emit(self, span):
+        self._spans.append(span.to_dict())
+
+    def spans(self, trace_id=None):
+        spans = list(self._spans)
+        if trace_id:
+            spans = [s for s in spans if s['trace_id'] == trace_id]
+        return spans
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def clear_sinks():
+    del _sinks[:]
+
+
+def get_spans(trace_id=None):
+    """
+    Return the spans held by all the in-memory sinks
+    """
+    spans = []
+    for sink in _sinks:
+        if isinstance(sink, RingBufferSink):
+            spans.extend(sink.spans(trace_id=trace_id))
+    return spans
+
+
+def configure(conf):
+    """
+    Set up the sinks from the [trace] section of hamgr.conf. The sink option
+    is a comma separated list of 'log' and 'memory'.
+    """
+    clear_sinks()
+    if not conf.has_section('trace'):
+        return
+    sinks = conf.get('trace', 'sink') if conf.has_option('trace', 'sink') \
+        else ''
+    for name in [s.strip() for s in sinks.split(',') if s.strip()]:
+        if name == 'log':
+            add_sink(LogSink())
+        elif name == 'memory':
+            size = conf.getint('trace', 'buffer_size') \
+                if conf.has_option('trace', 'buffer_size') else 1000
+            add_sink(RingBufferSink(size))
+        else:
+            LOG.warn('Ignoring unknown trace sink %s', name)
+
+
+def _emit(span):
+    for sink in _sinks:
+        try:
+            sink.emit(span)
+        except Exception:
+            LOG.exception('Trace sink %s failed', sink)
+
+
+@contextmanager
+def start_trace(operation, trace_id=None):
+    """
+    Group all the spans opened within this context under one trace ID. Nested
+    calls reuse the outer trace. trace_id continues a trace started by the
+    caller, e.g. the one sent by the host agent in the X-Trace-Id header.
+    """
+    if getattr(_local, 'trace_id', None):
+        yield _local.trace_id
+        return
+    _local.trace_id = trace_id or str(uuid4())
+    _local.operation = operation
+    try:
+        yield _local.trace_id
+    finally:
+        _local.trace_id = None
+        _local.operation = None
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed call. Use span.record_response(resp) to also record
+    the status code and payload size of an HTTP response.
+    """
+    sp = Span(name, trace_id=getattr(_local, 'trace_id', None),
+              operation=getattr(_local, 'operation', None))
+    try:
+        yield sp
+    except Exception as e:
+        sp.error = e.__class__.__name__
+        raise
+    finally:
+        sp.finish()
+        _emit(sp)
+
+
+def traced(name):
+    """
+    Decorator recording a span for every call of the decorated function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def propagate(func):
+    """
+    Wrap func so that it runs within the trace active where propagate is
+    called. The trace is held per thread, which is per greenthread once
+    eventlet has patched threading, so functions handed to a GreenPool
+    would otherwise lose it.
+    """
+    trace_id = getattr(_local, 'trace_id', None)
+    if not trace_id:
+        return func
+    name = getattr(_local, 'operation', None)
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with start_trace(name, trace_id=trace_id):
+            return func(*args, **kwargs)
+    return inner
+
+
+def operation(name):
+    """
+    Decorator running the decorated function within a trace, so that every
+    span recorded during the call shares one trace ID
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with start_trace(name):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
@@ -17,7 +17,10 @@ import requests
 import time
 import json
 
+from hamgr.common import trace
+
 LOG = logging.getLogger(__name__)
+_KEYSTONE_URL = 'http://localhost:8080/keystone/v2.0/tokens'
 
 def _get_auth_token(tenant, user, password):
     data = {
@@ -30,10 +33,10 @@ def _get_auth_token(tenant, user, password):
         }
     }
 
-    url = 'http://localhost:8080/keystone/v2.0/tokens'
-
-    r = requests.post(url, json.dumps(data),
-                      verify=False, headers={'Content-Type': 'application/json'})
+    with trace.span('keystone.get_token') as sp:
+        r = sp.record_response(requests.post(
+            _KEYSTONE_URL, json.dumps(data), verify=False,
+            headers={'Content-Type': 'application/json'}))
 
     if r.status_code != requests.codes.ok:
         raise RuntimeError('Token request returned: %d' % r.status_code)
@@ -56,13 +56,40 @@ class Cluster(Base):
 def init(config, connection_string=None):
     conn_str = connection_string or config.get('database', 'sqlconnectURI')
 
+    engine_args = {}
+    if not conn_str.startswith('sqlite'):
+        # sqlite does not use a QueuePool, hence the pool options only apply
+        # to the other databases
+        for opt in ['pool_size', 'max_overflow', 'pool_recycle']:
+            if config.has_option('database', opt):
+                engine_args[opt] = config.getint('database', opt)
+
     global _engine
-    _engine = create_engine(conn_str)
+    _engine = create_engine(conn_str, **engine_args)
 
     global _session_maker
     _session_maker = sessionmaker(bind=_engine, expire_on_commit=False)
 
 
+def warm_pool():
+    """
+    Open as many connections as the pool keeps so that the first requests
+    do not pay for connecting to the database
+    """
+    size = getattr(_engine.pool, 'size', None)
+    if not callable(size):
+        return
+    connections = []
+    try:
+        for _ in range(size()):
+            connections.append(_engine.connect())
+    except SQLAlchemyError as se:
+        LOG.warn('Could not warm up DB connection pool: %s', se)
+    finally:
+        for conn in connections:
+            conn.close()
+
+
 def _has_unsaved_changes(session):
     if any([session.dirty, session.new, session.deleted]):
         return True
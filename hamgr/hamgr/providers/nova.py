@@ -27,11 +27,18 @@ from hamgr import states
 from hamgr import periodic_task
 from hamgr.common import utils
 from hamgr.common import masakari
+from hamgr.common import placement
+from hamgr.common import trace
 from novaclient import client, exceptions
 from provider import Provider
 from urlparse import urlparse
 
 LOG = logging.getLogger(__name__)
+_RESMGR_URL = 'http://localhost:8080/resmgr/v1/hosts/'
+# Number of masakari notifications sent at once for a batch of host events
+_NOTIFICATION_CONCURRENCY = 16
+# Smallest consul cluster that keeps a quorum when one host fails
+_MIN_CLUSTER_SIZE = 3
 eventlet.monkey_patch()
 
 
@@ -43,6 +50,21 @@ class NovaProvider(Provider):
         self._auth_uri = config.get('keystone_middleware', 'auth_uri')
         self._tenant = config.get('keystone_middleware', 'admin_tenant_name')
         self._region = config.get('nova', 'region')
+        # Aggregates with more hosts are split into several consul clusters,
+        # 0 keeps one consul cluster per aggregate
+        self._max_cluster_size = 0
+        if config.has_option('nova', 'max_cluster_size'):
+            self._max_cluster_size = config.getint('nova', 'max_cluster_size')
+        # Inputs used to pick the consul servers, see hamgr.common.placement
+        self._server_placement = []
+        if config.has_option('nova', 'server_placement'):
+            for name in config.get('nova', 'server_placement').split(','):
+                name = name.strip()
+                if name in placement.INPUTS:
+                    self._server_placement.append(name)
+                elif name:
+                    LOG.warn('Ignoring unknown server placement input %s',
+                             name)
         self._token = None
         periodic_task.add_task(self._check_host_aggregate_changes, 120,
                                run_now=True)
@@ -51,6 +73,7 @@ class NovaProvider(Provider):
         self.aggregate_task_running = False
         self.host_down_dict_lock = threading.Lock()
 
+    @trace.operation('check_host_aggregate_changes')
     def _check_host_aggregate_changes(self):
         with self.aggregate_task_lock:
             if self.aggregate_task_running:
@@ -87,15 +110,15 @@ class NovaProvider(Provider):
                                      ' of the cluster', host)
                 removed_host_ids = db_node_ids - current_host_ids
 
-                LOG.info('Found %s active hosts', str(active_host_ids))
-                LOG.info('Found %s new hosts', str(new_host_ids))
-                LOG.info('Found %s inactive hosts', str(inactive_host_ids))
-                LOG.info('Found %s removed hosts', str(removed_host_ids))
+                LOG.info('Found %s active hosts', active_host_ids)
+                LOG.info('Found %s new hosts', new_host_ids)
+                LOG.info('Found %s inactive hosts', inactive_host_ids)
+                LOG.info('Found %s removed hosts', removed_host_ids)
 
                 if len(new_host_ids) == 0 and len(removed_host_ids) == 0:
                     # No new hosts to process
-                    LOG.info('No new hosts to process in {clsid} '
-                             'cluster'.format(clsid=cluster.name))
+                    LOG.info('No new hosts to process in %s cluster',
+                             cluster.name)
                     continue
 
                 if inactive_host_ids or \
@@ -103,9 +126,8 @@ class NovaProvider(Provider):
                     # Host aggregate has changed but there are inactive hosts
                     # in the host aggregate or another thread is working on
                     # same cluster so do not reconfigure the cluster yet
-                    LOG.warn('Skipping {clsid} because there are inactive '
-                             'hosts or incomplete tasks'.format(
-                                 clsid=cluster.name))
+                    LOG.warn('Skipping %s because there are inactive '
+                             'hosts or incomplete tasks', cluster.name)
                     continue
 
                 self._disable(aggregate_id, synchronize=True)
@@ -199,11 +221,13 @@ class NovaProvider(Provider):
         self._token = utils.get_token(self._tenant, self._username, self._passwd, self._token)
         headers = {'X-Auth-Token': self._token['id'],
                    'Content-Type': 'application/json'}
-        resmgr_url = 'http://localhost:8080/resmgr/v1/hosts/'
+        resmgr_url = _RESMGR_URL
         current_roles = {}
         for host in hosts:
             host_url = '/'.join([resmgr_url, host])
-            resp = requests.get(host_url, headers=headers)
+            with trace.span('resmgr.get_host') as sp:
+                resp = sp.record_response(requests.get(host_url,
+                                                       headers=headers))
             resp.raise_for_status()
             json_resp = resp.json()
             if json_resp['role_status'] != 'ok':
@@ -215,9 +239,9 @@ class NovaProvider(Provider):
             current_roles[host] = json_resp['roles']
         return current_roles
 
-    def _auth(self, ip_lookup, token, nodes, role, ip=None):
+    def _auth(self, ip_lookup, token, nodes, role, ip=None, cluster_size=0):
         assert role in ['server', 'agent']
-        url = 'http://localhost:8080/resmgr/v1/hosts/'
+        url = _RESMGR_URL
         headers = {'X-Auth-Token': token['id'],
                    'Content-Type': 'application/json'}
         for node in nodes:
@@ -225,9 +249,11 @@ class NovaProvider(Provider):
                      node, ip_lookup[node])
             data = dict(join=ip, ip_address=ip_lookup[node])
             data['bootstrap_expect'] = 3 if role == 'server' else 0
+            data['cluster_size'] = cluster_size
             auth_url = '/'.join([url, node, 'roles', 'pf9-ha-slave'])
-            resp = requests.put(auth_url, headers=headers,
-                                json=data, verify=False)
+            with trace.span('resmgr.put_role') as sp:
+                resp = sp.record_response(requests.put(
+                    auth_url, headers=headers, json=data, verify=False))
             if resp.status_code == requests.codes.not_found and \
                 resp.content.find('HostDown'):
                 raise ha_exceptions.HostOffline(node)
@@ -235,8 +261,9 @@ class NovaProvider(Provider):
             while resp.status_code == requests.codes.conflict:
                 LOG.info('Role conflict error for node %s, retrying after 5 sec', node)
                 time.sleep(5)
-                resp = requests.put(auth_url, headers=headers,
-                                    json=data, verify=False)
+                with trace.span('resmgr.put_role') as sp:
+                    resp = sp.record_response(requests.put(
+                        auth_url, headers=headers, json=data, verify=False))
                 if datetime.now() - start_time > timedelta(minutes=2):
                     break
             resp.raise_for_status()
@@ -251,9 +278,10 @@ class NovaProvider(Provider):
         self._token = utils.get_token(self._tenant, self._username, self._passwd, self._token)
         headers = {'X-Auth-Token': self._token['id'],
                    'Content-Type': 'application/json'}
-        resmgr_url = 'http://localhost:8080/resmgr/v1/hosts/'
+        resmgr_url = _RESMGR_URL
         host_url = '/'.join([resmgr_url, host_id, 'roles', rolename])
-        resp = requests.get(host_url, headers=headers)
+        with trace.span('resmgr.get_host_role') as sp:
+            resp = sp.record_response(requests.get(host_url, headers=headers))
         resp.raise_for_status()
         json_resp = resp.json()
         if 'consul_ip' in json_resp and json_resp['consul_ip']:
@@ -280,8 +308,49 @@ class NovaProvider(Provider):
                     ip_lookup[host_id] = consul_ip
         return ip_lookup
 
-    def _assign_roles(self, client, hosts, current_roles):
+    def _partition_hosts(self, hosts):
+        """
+        Split the sorted hosts in consul clusters of at most
+        max_cluster_size hosts and at least _MIN_CLUSTER_SIZE hosts, of
+        about the same size
+        """
         hosts = sorted(hosts)
+        max_size = max(self._max_cluster_size, _MIN_CLUSTER_SIZE)
+        if not self._max_cluster_size or len(hosts) <= max_size:
+            return [hosts]
+        count = -(-len(hosts) // max_size)
+        count = min(count, len(hosts) // _MIN_CLUSTER_SIZE)
+        size, extra = divmod(len(hosts), count)
+        partitions = []
+        start = 0
+        for i in range(count):
+            end = start + size + (1 if i < extra else 0)
+            partitions.append(hosts[start:end])
+            start = end
+        return partitions
+
+    def _assign_roles(self, client, hosts, current_roles):
+        """
+        Set up one consul cluster per partition of the hosts. The clusters
+        are led and report host events independently, the masakari segment
+        still covers all the hosts.
+        """
+        partitions = self._partition_hosts(hosts)
+        if len(partitions) > 1:
+            LOG.info('Splitting %d hosts in %d consul clusters', len(hosts),
+                     len(partitions))
+        ip_lookup = self._get_ips(client, hosts, current_roles)
+        placement_data = placement.read_inputs(client, hosts,
+                                               self._server_placement)
+        for partition in partitions:
+            self._assign_cluster_roles(
+                ip_lookup, placement.order_hosts(partition, **placement_data))
+
+    def _assign_cluster_roles(self, ip_lookup, hosts):
+        """
+        The first hosts become the consul servers, the first one of them
+        being the one the others join
+        """
         leader = hosts[0]
         servers = hosts[1:3]
 
@@ -292,7 +361,6 @@ class NovaProvider(Provider):
         elif len(hosts) >= 4:
             agents = hosts[3:]
 
-        ip_lookup = self._get_ips(client, hosts, current_roles)
         if leader not in ip_lookup:
             LOG.error('Leader %s not found in nova', leader)
             raise ha_exceptions.HostNotFound(leader)
@@ -301,8 +369,9 @@ class NovaProvider(Provider):
         self._token = utils.get_token(self._tenant, self._username,
                                       self._passwd, self._token)
         self._auth(ip_lookup, self._token, [leader] + servers,
-                   'server', ip=leader_ip)
-        self._auth(ip_lookup, self._token, agents, 'agent', ip=leader_ip)
+                   'server', ip=leader_ip, cluster_size=len(hosts))
+        self._auth(ip_lookup, self._token, agents, 'agent', ip=leader_ip,
+                   cluster_size=len(hosts))
 
     def _enable(self, aggregate_id, hosts=None, next_state=states.TASK_COMPLETED):
         """
@@ -382,17 +451,21 @@ class NovaProvider(Provider):
         self._token = utils.get_token(self._tenant, self._username, self._passwd, self._token)
         headers = {'X-Auth-Token': self._token['id'],
                    'Content-Type': 'application/json'}
-        url = 'http://localhost:8080/resmgr/v1/hosts/'
+        url = _RESMGR_URL
         for node in nodes:
             start_time = datetime.now()
             auth_url = '/'.join([url, node])
-            resp = requests.get(auth_url, headers=headers)
+            with trace.span('resmgr.get_host') as sp:
+                resp = sp.record_response(requests.get(auth_url,
+                                                       headers=headers))
             resp.raise_for_status()
             json_resp = resp.json()
             while json_resp['role_status'] != 'ok' or \
                     rolename in json_resp['roles']:
                 time.sleep(5)
-                resp = requests.get(auth_url, headers=headers)
+                with trace.span('resmgr.get_host') as sp:
+                    resp = sp.record_response(requests.get(auth_url,
+                                                           headers=headers))
                 resp.raise_for_status()
                 json_resp = resp.json()
                 if datetime.now() - start_time > timedelta(minutes=5):
@@ -403,19 +476,23 @@ class NovaProvider(Provider):
                                       self._passwd, self._token)
         headers = {'X-Auth-Token': self._token['id'],
                    'Content-Type': 'application/json'}
-        url = 'http://localhost:8080/resmgr/v1/hosts/'
+        url = _RESMGR_URL
 
         for node in nodes:
             LOG.info('De-authorizing pf9-ha-slave role on node %s', node)
             start_time = datetime.now()
             auth_url = '/'.join([url, node, 'roles', 'pf9-ha-slave'])
-            resp = requests.delete(auth_url, headers=headers)
+            with trace.span('resmgr.delete_role') as sp:
+                resp = sp.record_response(requests.delete(auth_url,
+                                                          headers=headers))
             # Retry deauth if resmgr throws conflict error for upto 2 minutes
             while resp.status_code == requests.codes.conflict:
                 LOG.info('Role removal conflict error for node %s, retrying'
                          'after 5 sec', node)
                 time.sleep(5)
-                resp = requests.delete(auth_url, headers=headers)
+                with trace.span('resmgr.delete_role') as sp:
+                    resp = sp.record_response(requests.delete(
+                        auth_url, headers=headers))
                 if datetime.now() - start_time > timedelta(minutes=2):
                     break
             resp.raise_for_status()
@@ -486,6 +563,7 @@ class NovaProvider(Provider):
                 db_api.update_cluster(cluster.id, False)
                 db_api.update_cluster_task_state(cluster.id, next_state)
 
+    @trace.operation('update_cluster')
     def put(self, aggregate_id, method):
         if method == 'enable':
             self._enable(aggregate_id)
@@ -503,7 +581,27 @@ class NovaProvider(Provider):
                 return cluster
         raise ha_exceptions.HostNotFound(host=host_id)
 
-    def _remove_host_from_cluster(self, cluster, host, client=None):
+    def _get_clusters_for_hosts(self, host_ids, client=None):
+        """
+        Map each of the given hosts to the active cluster it belongs to,
+        looking every aggregate up at most once. Hosts that are not in any
+        active cluster are left out.
+        """
+        if not client:
+            client = self._get_client()
+        pending = set(host_ids)
+        host_clusters = {}
+        for cluster in db_api.get_all_active_clusters():
+            if not pending:
+                break
+            aggregate = self._get_aggregate(client, cluster.name)
+            for host_id in pending.intersection(aggregate.hosts):
+                host_clusters[host_id] = cluster
+            pending.difference_update(aggregate.hosts)
+        return host_clusters
+
+    @trace.operation('remove_host_from_cluster')
+    def _remove_hosts_from_cluster(self, cluster, hosts, client=None):
         if not client:
             client = self._get_client()
         aggregate_id = cluster.name
@@ -522,7 +620,8 @@ class NovaProvider(Provider):
                     if current_host in self.hosts_down_per_cluster[cluster.id]:
                         self.hosts_down_per_cluster.pop(current_host)
 
-            self.hosts_down_per_cluster[cluster.id][host] = True
+            for host in hosts:
+                self.hosts_down_per_cluster[cluster.id][host] = True
             if all([v for k, v in self.hosts_down_per_cluster[cluster.id].items()]):
                 host_list = current_host_ids - \
                         set(self.hosts_down_per_cluster[cluster.id].keys())
@@ -538,10 +637,11 @@ class NovaProvider(Provider):
                 LOG.info('There are still down hosts that need to be reported'
                          ' before reconfiguring the cluster')
         except:
-            LOG.exception('Could not process {host} host down'.format(host=host))
+            LOG.exception('Could not process {hosts} host down'.format(
+                hosts=', '.join(hosts)))
         db_api.update_cluster_task_state(cluster.id, states.TASK_COMPLETED)
 
-    def host_down(self, event_details):
+    def _notify_host_down(self, event_details):
         host = event_details['hostname']
         time = event_details['time']
         event = 'STOPPED'
@@ -553,25 +653,34 @@ class NovaProvider(Provider):
             "host_status": host_status,
             "cluster_status": cluster_status
         }
+        masakari.create_notification(self._token, notification_type,
+                                     host, time, payload)
+
+    def _schedule_host_removal(self, cluster, hosts):
+        def _remove_hosts_task():
+            self._remove_hosts_from_cluster(cluster, hosts)
 
+        periodic_task.add_task(_remove_hosts_task, 0, run_now=True,
+                               run_once=True)
+
+    @trace.operation('host_down')
+    def host_down(self, event_details):
+        host = event_details['hostname']
         try:
             cluster = self._get_cluster_for_host(host)
             db_api.update_cluster_task_state(cluster.id, states.TASK_MIGRATING)
             cluster = db_api.get_cluster(cluster.id)
             self._token = utils.get_token(self._tenant, self._username,
                                           self._passwd, self._token)
-            masakari.create_notification(self._token, notification_type,
-                                         host, time, payload)
-            def _remove_host_task():
-                self._remove_host_from_cluster(cluster, host)
-
-            periodic_task.add_task(_remove_host_task, 0, run_now=True, run_once=True)
+            self._notify_host_down(event_details)
+            self._schedule_host_removal(cluster, [host])
             retval = True
         except:
             LOG.exception('Error processing {host} host down'.format(host=host))
             retval = False
         return retval
 
+    @trace.operation('host_up')
     def host_up(self, event_details):
         host = event_details['hostname']
         try:
@@ -587,7 +696,90 @@ class NovaProvider(Provider):
             return False
         return True
 
+    def _try_notify_host_down(self, event_details):
+        try:
+            self._notify_host_down(event_details)
+            return True
+        except:
+            LOG.exception('Error processing {host} host down'.format(
+                host=event_details['hostname']))
+            return False
+
+    def _hosts_down(self, events):
+        """
+        :param events: list of (index, event_details) tuples
+        :return: dict mapping the index of each event to its result
+        """
+        results = dict((index, False) for index, _ in events)
+        try:
+            host_clusters = self._get_clusters_for_hosts(
+                [details['hostname'] for _, details in events])
+            self._token = utils.get_token(self._tenant, self._username,
+                                          self._passwd, self._token)
+        except:
+            LOG.exception('Error processing host down events')
+            return results
+
+        events_per_cluster = defaultdict(list)
+        for index, details in events:
+            cluster = host_clusters.get(details['hostname'])
+            if cluster is None:
+                LOG.error('Host %s is not in any HA enabled cluster',
+                          details['hostname'])
+                continue
+            events_per_cluster[cluster.id].append((index, details))
+        if not events_per_cluster:
+            return results
+
+        for cluster_id in events_per_cluster:
+            db_api.update_cluster_task_state(cluster_id, states.TASK_MIGRATING)
+        # Notifications of all the clusters are sent together
+        cluster_events = [e for evts in events_per_cluster.values()
+                          for e in evts]
+        pool = eventlet.GreenPool(_NOTIFICATION_CONCURRENCY)
+        notified = pool.imap(trace.propagate(self._try_notify_host_down),
+                             [details for _, details in cluster_events])
+        for (index, _), result in zip(cluster_events, notified):
+            results[index] = result
+
+        # One reconfiguration per cluster covers all its hosts that are down
+        for cluster_id, evts in events_per_cluster.items():
+            hosts = [details['hostname'] for index, details in evts
+                     if results[index]]
+            if not hosts:
+                db_api.update_cluster_task_state(cluster_id,
+                                                 states.TASK_COMPLETED)
+                continue
+            self._schedule_host_removal(db_api.get_cluster(cluster_id), hosts)
+        return results
+
+    @trace.operation('host_events')
+    def host_events(self, events):
+        """
+        Handle a batch of host-up and host-down events. Masakari is notified
+        of the host down events concurrently and each affected cluster is
+        reconfigured once for all its hosts that are down.
+        :param events: list of dicts with the event and event_details keys
+        :return: list with the result of each event, in the order of events
+        """
+        results = [False] * len(events)
+        down = [(index, e['event_details']) for index, e in enumerate(events)
+                if e['event'] == 'host-down']
+        up = [(index, e['event_details']) for index, e in enumerate(events)
+              if e['event'] == 'host-up']
+        if down:
+            for index, result in self._hosts_down(down).items():
+                results[index] = result
+        if up:
+            pool = eventlet.GreenPool(_NOTIFICATION_CONCURRENCY)
+            up_results = pool.imap(trace.propagate(self.host_up),
+                                   [details for _, details in up])
+            for (index, _), result in zip(up, up_results):
+                results[index] = result
+        return results
+
 def get_provider(config):
     db_api.init(config)
+    db_api.warm_pool()
     return NovaProvider(config)
 
@@ -37,3 +37,12 @@ class Provider(object):
     @abstractmethod
     def host_down(self, event_details):
         pass
+
+    @abstractmethod
+    def host_events(self, events):
+        """
+        Handle a batch of host-up and host-down events
+        :param events: list of dicts with the event and event_details keys
+        :return: list with the result of each event, in the order of events
+        """
+        pass
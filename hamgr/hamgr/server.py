@@ -16,6 +16,8 @@
 
 from eventlet import wsgi
 from hamgr import periodic_task
+from hamgr.common import log
+from hamgr.common import trace
 from paste.deploy import loadapp
 import argparse
 import ConfigParser
@@ -33,19 +35,33 @@ def _get_arg_parser():
     return parser.parse_args()
 
 
+def _get_log_opt(conf, option, default, getter='get'):
+    if conf.has_option('log', option):
+        return getattr(conf, getter)('log', option)
+    return default
+
+
 def _configure_logging(conf):
     log_filename = conf.get("log", "location")
-    logging.basicConfig(filename=log_filename,
-                        level=logging.DEBUG,
-                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                        datefmt='%m-%d %H:%M')
     handler = logging.handlers.RotatingFileHandler(
         log_filename, maxBytes=1024 * 1024 * 5, backupCount=5)
+    if _get_log_opt(conf, 'use_queue', False, 'getboolean'):
+        handler = log.QueueHandler(handler)
+        handler.start()
+    interval = _get_log_opt(conf, 'rate_limit_interval', 0, 'getint')
+    if interval:
+        burst = _get_log_opt(conf, 'rate_limit_burst', 5, 'getint')
+        handler.addFilter(log.RateLimitFilter(interval, burst))
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        datefmt='%m-%d %H:%M'))
     logging.root.addHandler(handler)
+    logging.root.setLevel(_get_log_opt(conf, 'level', 'DEBUG').upper())
 
 
 def start_server(conf, paste_ini):
     _configure_logging(conf)
+    trace.configure(conf)
     if paste_ini:
         paste_file = paste_ini
     else:
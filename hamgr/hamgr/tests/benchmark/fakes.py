@@ -0,0 +1,286 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Local stand-ins for the services hamgr talks to. Each fake HTTP service runs
+in its own server thread and can be slowed down or made to fail randomly.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import threading
+import time
+
+from datetime import datetime
+from datetime import timedelta
+from urlparse import urlparse
+from uuid import uuid4
+
+
+class Inventory(object):
+    """
+    Aggregates and hosts shared by the fake nova client and fake services
+    """
+    def __init__(self, num_aggregates, num_hosts):
+        # Host IDs are UUIDs, like the ones assigned by resmgr
+        self.hosts = ['00000000-0000-4000-8000-%012d' % i
+                      for i in range(num_hosts)]
+        self.host_ips = dict((h, '10.%d.%d.%d' % ((i >> 16) & 255,
+                                                  (i >> 8) & 255, i & 255))
+                             for i, h in enumerate(self.hosts))
+        self.aggregates = dict((str(a), []) for a in range(1, num_aggregates + 1))
+        for i, host in enumerate(self.hosts):
+            self.aggregates[str(i % num_aggregates + 1)].append(host)
+        self.roles = dict((h, set(['pf9-ostackhost'])) for h in self.hosts)
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self, method):
+        service = self.server.service
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        service.requests += 1
+        if service.latency:
+            time.sleep(service.latency)
+        if service.error_rate and service.random.random() < service.error_rate:
+            status, data = 503, dict(error='injected failure')
+        else:
+            path = [p for p in urlparse(self.path).path.split('/') if p]
+            try:
+                status, data = service.handle(method, path,
+                                              json.loads(body) if body else None)
+            except Exception as e:
+                status, data = 500, dict(error=str(e))
+        payload = json.dumps(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    """
+    Base class for the fake HTTP services. Subclasses implement handle() and
+    return a (status code, json body) tuple.
+    """
+    prefix = ''
+
+    def __init__(self, inventory, latency=0.0, error_rate=0.0, seed=None):
+        self.inventory = inventory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d/%s' % (host, port, self.prefix)
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.service = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, method, path, body):
+        raise NotImplementedError()
+
+
+class FakeKeystone(FakeService):
+    prefix = 'keystone/v2.0/tokens'
+
+    def handle(self, method, path, body):
+        expires = datetime.utcnow() + timedelta(hours=1)
+        token = dict(id=str(uuid4()),
+                     expires=expires.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return 200, dict(access=dict(token=token))
+
+
+class FakeResmgr(FakeService):
+    prefix = 'resmgr/v1/hosts/'
+
+    def handle(self, method, path, body):
+        # resmgr/v1/hosts/<host>[/roles/<role>]
+        host = path[3]
+        inventory = self.inventory
+        if host not in inventory.roles:
+            return 404, dict(error='HostNotFound')
+        if len(path) == 4:
+            with inventory.lock:
+                roles = list(inventory.roles[host])
+            return 200, dict(id=host, role_status='ok', roles=roles,
+                             info=dict(responding=True))
+        role = path[5]
+        if method == 'GET':
+            return 200, dict(consul_ip=inventory.host_ips[host])
+        with inventory.lock:
+            if method == 'PUT':
+                inventory.roles[host].add(role)
+            elif method == 'DELETE':
+                inventory.roles[host].discard(role)
+        return 200, None
+
+
+class FakeMasakari(FakeService):
+    prefix = 'masakari/v1'
+
+    def __init__(self, *args, **kwargs):
+        super(FakeMasakari, self).__init__(*args, **kwargs)
+        self.segments = {}
+        self.notifications = []
+        self._lock = threading.Lock()
+
+    def add_segment(self, name, hosts):
+        seg_id = str(uuid4())
+        seg_hosts = {}
+        for host in hosts:
+            host_id = str(uuid4())
+            seg_hosts[host_id] = dict(uuid=host_id, name=host,
+                                      failover_segment_id=seg_id)
+        self.segments[seg_id] = dict(uuid=seg_id, name=name, hosts=seg_hosts)
+        return self.segments[seg_id]
+
+    def _segment_view(self, seg):
+        return dict((k, v) for k, v in seg.items() if k != 'hosts')
+
+    def handle(self, method, path, body):
+        # masakari/v1/<collection>[/<id>[/hosts[/<id>]]]
+        collection = path[2]
+        with self._lock:
+            if collection == 'notifications':
+                if method == 'POST':
+                    notification = dict(body['notification'])
+                    notification['received_at'] = time.time()
+                    self.notifications.append(notification)
+                    return 202, dict(notification=notification)
+                return 200, dict(notifications=self.notifications)
+            if len(path) == 3:
+                if method == 'POST':
+                    seg = self.add_segment(body['segment']['name'], [])
+                    return 200, dict(segment=self._segment_view(seg))
+                return 200, dict(segments=[self._segment_view(s)
+                                           for s in self.segments.values()])
+            seg = self.segments.get(path[3])
+            if seg is None:
+                return 404, None
+            if len(path) == 4:
+                if method == 'DELETE':
+                    del self.segments[path[3]]
+                    return 204, None
+                return 200, dict(segment=self._segment_view(seg))
+            if len(path) == 5:
+                if method == 'POST':
+                    host_id = str(uuid4())
+                    seg['hosts'][host_id] = dict(
+                        uuid=host_id, name=body['host']['name'],
+                        failover_segment_id=seg['uuid'])
+                    return 200, dict(host=seg['hosts'][host_id])
+                return 200, dict(hosts=seg['hosts'].values())
+            if method == 'DELETE':
+                return (204, None) if seg['hosts'].pop(path[5], None) \
+                    else (404, None)
+            return 200, dict(host=seg['hosts'].get(path[5]))
+
+
+class _Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeNovaClient(object):
+    """
+    Serves the subset of the novaclient API used by NovaProvider from the
+    inventory, sleeping latency seconds on every call.
+    """
+    def __init__(self, inventory, latency=0.0):
+        self.aggregates = _Aggregates(inventory, latency)
+        self.hypervisors = _Hypervisors(inventory, latency)
+        self.services = _Services(inventory, latency)
+
+
+class _Aggregates(object):
+    def __init__(self, inventory, latency):
+        self._inventory = inventory
+        self._latency = latency
+
+    def get(self, aggregate_id):
+        time.sleep(self._latency)
+        return _Obj(id=str(aggregate_id),
+                    hosts=list(self._inventory.aggregates[str(aggregate_id)]))
+
+    def list(self):
+        time.sleep(self._latency)
+        return [_Obj(id=a, hosts=list(h))
+                for a, h in self._inventory.aggregates.items()]
+
+
+class _Hypervisors(object):
+    def __init__(self, inventory, latency):
+        self._inventory = inventory
+        self._latency = latency
+
+    def list(self):
+        time.sleep(self._latency)
+        return [_Obj(service=dict(host=h), host_ip=ip)
+                for h, ip in self._inventory.host_ips.items()]
+
+
+class _Services(object):
+    def __init__(self, inventory, latency):
+        self._inventory = inventory
+        self._latency = latency
+        self.down = set()
+
+    def list(self, binary=None, host=None):
+        time.sleep(self._latency)
+        state = 'down' if host in self.down else 'up'
+        return [_Obj(binary=binary, host=host, state=state, status='enabled',
+                     disabled_reason=None)]
+
+    def enable(self, binary=None, host=None):
+        time.sleep(self._latency)
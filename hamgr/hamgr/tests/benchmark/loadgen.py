@@ -0,0 +1,235 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Load generator for the host status endpoint, POST /v1/ha/<host_id>.
+
+A hamgr server (eventlet wsgi and the paste pipeline, with the keystone auth
+filter replaced by a pass-through) is started in a child process on top of
+the fake services used by the scale benchmark. Storms of host-up and
+host-down events are then replayed against it, e.g.
+
+    python -m hamgr.tests.benchmark.loadgen --hosts 2000 --storm host-down \\
+        --concurrency 200 --output loadgen.json
+
+Throughput, p50/p99 latency and error rates are reported for every storm,
+along with the eventlet hub lag measured inside the server process.
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import atexit
+import json
+import logging
+import mock
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from eventlet import wsgi
+from paste.deploy import loadapp
+
+import requests
+
+from hamgr import periodic_task
+from hamgr import wsgi as hamgr_wsgi
+from hamgr.tests.benchmark import scale
+
+LOG = logging.getLogger(__name__)
+
+HUB_STATS_PATH = '/loadgen/hub'
+
+PASTE_INI = """
+[app:myService]
+paste.app_factory = hamgr.wsgi:app_factory
+provider = nova
+
+[pipeline:main]
+pipeline = noauth myService
+
+[filter:noauth]
+paste.filter_factory = hamgr.tests.benchmark.loadgen:noauth_filter_factory
+"""
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description='Host status load generator')
+    parser.add_argument('--aggregates', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every fake HTTP service call')
+    parser.add_argument('--nova-latency', type=float, default=0.0,
+                        help='Seconds added to every fake nova client call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of fake HTTP calls that return 503')
+    parser.add_argument('--storm', action='append',
+                        choices=['host-down', 'host-up'],
+                        help='Storms to replay, in order. Defaults to a '
+                             'host-down storm followed by a host-up storm')
+    parser.add_argument('--events', type=int, default=None,
+                        help='Events per storm, defaults to one per host')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--max-size', type=int, default=1024,
+                        help='Maximum concurrent connections of the server')
+    parser.add_argument('--port', type=int, default=9183)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='hamgr-loadgen.json')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run the hamgr server instead of the load')
+    return parser.parse_args()
+
+
+class HubMonitor(object):
+    """
+    Measures how late a green thread sleeping on the eventlet hub wakes up.
+    A saturated hub shows up as a growing lag.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+
+    def _run(self):
+        while True:
+            start = time.time()
+            eventlet.sleep(self.interval)
+            self.lags.append(max(0.0, time.time() - start - self.interval))
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def stats(self):
+        lags, self.lags = self.lags, []
+        summary = scale.summarize(lags)
+        summary['saturated'] = len([l for l in lags if l > self.interval])
+        return summary
+
+
+_monitor = HubMonitor()
+
+
+def noauth_filter_factory(global_config, **local_conf):
+    """
+    Stand-in for the keystone auth_token filter. Also serves the hub lag
+    collected in the server process.
+    """
+    def _filter(app):
+        def _app(environ, start_response):
+            if environ.get('PATH_INFO') == HUB_STATS_PATH:
+                body = json.dumps(_monitor.stats())
+                start_response('200 OK', [('Content-Type', 'application/json'),
+                                          ('Content-Length', str(len(body)))])
+                return [body]
+            return app(environ, start_response)
+        return _app
+    return _filter
+
+
+def serve(args):
+    bench = scale.Benchmark(args)
+    mock.patch.object(periodic_task, 'add_task').start()
+    bench.setup()
+    mock.patch.object(hamgr_wsgi, '_provider', bench.provider).start()
+    atexit.register(bench.teardown)
+    with tempfile.NamedTemporaryFile(suffix='.ini', delete=False) as fptr:
+        fptr.write(PASTE_INI)
+    app = loadapp('config:%s' % fptr.name, 'main')
+    os.unlink(fptr.name)
+    _monitor.start()
+    wsgi.server(eventlet.listen(('127.0.0.1', args.port)), app,
+                max_size=args.max_size, log_output=False)
+
+
+def _wait_for_server(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url + HUB_STATS_PATH)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError('hamgr server did not start in %d seconds' % timeout)
+
+
+def _post_event(url, event, host):
+    details = dict(hostname=host,
+                   time=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+    payload = json.dumps(dict(event=event, event_details=details))
+    start = time.time()
+    try:
+        resp = requests.post('/'.join([url, 'v1', 'ha', host]), data=payload,
+                             headers={'Content-Type': 'application/json'})
+        status = resp.status_code
+    except requests.RequestException as e:
+        status = e.__class__.__name__
+    return time.time() - start, status
+
+
+def run_storm(url, event, hosts, concurrency):
+    requests.get(url + HUB_STATS_PATH)
+    pool = eventlet.GreenPool(concurrency)
+    start = time.time()
+    results = list(pool.imap(lambda h: _post_event(url, event, h), hosts))
+    elapsed = time.time() - start
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = len([s for _, s in results if s != requests.codes.ok])
+    return dict(event=event,
+                requests=len(results),
+                elapsed=elapsed,
+                throughput=len(results) / elapsed if elapsed else None,
+                latency=scale.summarize([l for l, _ in results]),
+                error_rate=float(errors) / len(results) if results else 0.0,
+                statuses=statuses,
+                hub_lag=requests.get(url + HUB_STATS_PATH).json())
+
+
+def main():
+    args = _get_arg_parser()
+    logging.basicConfig(level=logging.WARN)
+    if args.serve:
+        serve(args)
+        return
+
+    # The server is started through an import rather than with -m so that
+    # the paste filter and the hub monitor share this module
+    server = subprocess.Popen(
+        [sys.executable, '-c',
+         'from hamgr.tests.benchmark import loadgen; loadgen.main()',
+         '--serve'] + sys.argv[1:])
+    url = 'http://127.0.0.1:%d' % args.port
+    try:
+        _wait_for_server(url)
+        hosts = scale.fakes.Inventory(args.aggregates, args.hosts).hosts
+        if args.events:
+            hosts = (hosts * (args.events // len(hosts) + 1))[:args.events]
+        storms = [run_storm(url, event, hosts, args.concurrency)
+                  for event in args.storm or ['host-down', 'host-up']]
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    result = dict(timestamp=time.time(), config=vars(args), storms=storms)
+    with open(args.output, 'w') as fptr:
+        json.dump(result, fptr, indent=2, sort_keys=True)
+    print json.dumps(storms, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
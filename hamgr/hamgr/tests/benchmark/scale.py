@@ -0,0 +1,246 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Scale benchmark for NovaProvider.
+
+Runs NovaProvider against local fake resmgr, masakari and keystone services
+and a fake nova client and writes the measured timings as JSON, e.g.
+
+    python -m hamgr.tests.benchmark.scale --aggregates 1000 --hosts 10000 \\
+        --latency 0.005 --output results.json
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import logging
+import mock
+import os
+import tempfile
+import time
+
+from ConfigParser import ConfigParser
+from datetime import datetime
+
+import hamgr.db.api as db_api
+from hamgr import periodic_task
+from hamgr import states
+from hamgr.common import masakari
+from hamgr.common import trace
+from hamgr.common import utils
+from hamgr.providers import nova
+from hamgr.tests.benchmark import fakes
+
+LOG = logging.getLogger(__name__)
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description='NovaProvider scale benchmark')
+    parser.add_argument('--aggregates', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every fake HTTP service call')
+    parser.add_argument('--nova-latency', type=float, default=0.0,
+                        help='Seconds added to every fake nova client call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of fake HTTP calls that return 503')
+    parser.add_argument('--cycles', type=int, default=3,
+                        help='Number of reconcile cycles to time')
+    parser.add_argument('--samples', type=int, default=5,
+                        help='Number of aggregates to enable/disable and of '
+                             'host down events to send')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='hamgr-benchmark.json')
+    return parser.parse_args()
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(samples):
+    if not samples:
+        return dict(count=0)
+    return dict(count=len(samples),
+                min=min(samples),
+                max=max(samples),
+                mean=sum(samples) / len(samples),
+                p50=_percentile(samples, 50),
+                p99=_percentile(samples, 99))
+
+
+def _get_config(db_file):
+    config = ConfigParser()
+    config.add_section('database')
+    # A file backed database is shared by all the green threads, an in-memory
+    # one is not
+    config.set('database', 'sqlconnectURI', 'sqlite:///%s' % db_file)
+    config.add_section('keystone_middleware')
+    config.set('keystone_middleware', 'admin_user', 'bench')
+    config.set('keystone_middleware', 'admin_password', 'bench')
+    config.set('keystone_middleware', 'auth_uri', 'bench')
+    config.set('keystone_middleware', 'admin_tenant_name', 'bench')
+    config.add_section('nova')
+    config.set('nova', 'region', 'bench')
+    return config
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.inventory = fakes.Inventory(args.aggregates, args.hosts)
+        kwargs = dict(latency=args.latency, error_rate=args.error_rate,
+                      seed=args.seed)
+        self.keystone = fakes.FakeKeystone(self.inventory, **kwargs)
+        self.resmgr = fakes.FakeResmgr(self.inventory, **kwargs)
+        self.masakari = fakes.FakeMasakari(self.inventory, **kwargs)
+        self.nova = fakes.FakeNovaClient(self.inventory, args.nova_latency)
+        self.spans = trace.RingBufferSink(size=1000000)
+        self.provider = None
+        self._saved_urls = None
+        self._db_file = None
+
+    def setup(self):
+        for service in [self.keystone, self.resmgr, self.masakari]:
+            service.start()
+        self._saved_urls = (masakari._URL, utils._KEYSTONE_URL,
+                            nova._RESMGR_URL)
+        masakari._URL = self.masakari.url
+        utils._KEYSTONE_URL = self.keystone.url
+        nova._RESMGR_URL = self.resmgr.url
+        trace.add_sink(self.spans)
+
+        fd, self._db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.provider = nova.get_provider(_get_config(self._db_file))
+        self.provider._get_client = lambda: self.nova
+        db_api.Base.metadata.create_all(db_api._engine)
+
+        # Start from a steady state where every aggregate has HA enabled
+        for aggregate_id, hosts in self.inventory.aggregates.items():
+            db_api.create_cluster_if_needed(aggregate_id, states.TASK_COMPLETED)
+            db_api.update_cluster(aggregate_id, True)
+            self.masakari.add_segment(aggregate_id, hosts)
+            for host in hosts:
+                self.inventory.roles[host].add('pf9-ha-slave')
+
+    def teardown(self):
+        trace.clear_sinks()
+        masakari._URL, utils._KEYSTONE_URL, nova._RESMGR_URL = \
+            self._saved_urls
+        for service in [self.keystone, self.resmgr, self.masakari]:
+            service.stop()
+        os.unlink(self._db_file)
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            func(*args)
+            return time.time() - start, None
+        except Exception as e:
+            return time.time() - start, e.__class__.__name__
+
+    def run_reconcile(self):
+        durations = []
+        for _ in range(self.args.cycles):
+            duration, _ = self._timed(
+                self.provider._check_host_aggregate_changes)
+            durations.append(duration)
+        return summarize(durations)
+
+    def run_enable_disable(self):
+        disable, enable, errors = [], [], []
+        sample = sorted(self.inventory.aggregates.keys(),
+                        key=int)[:self.args.samples]
+        for aggregate_id in sample:
+            duration, error = self._timed(self.provider.put, aggregate_id,
+                                          'disable')
+            disable.append(duration)
+            if error:
+                errors.append(dict(aggregate=aggregate_id, action='disable',
+                                   error=error))
+                continue
+            duration, error = self._timed(self.provider.put, aggregate_id,
+                                          'enable')
+            enable.append(duration)
+            if error:
+                errors.append(dict(aggregate=aggregate_id, action='enable',
+                                   error=error))
+        return dict(disable=summarize(disable), enable=summarize(enable),
+                    errors=errors)
+
+    def run_host_down(self):
+        latencies, failed = [], 0
+        sample = sorted(self.inventory.aggregates.keys(),
+                        key=int)[-self.args.samples:]
+        for aggregate_id in sample:
+            host = self.inventory.aggregates[aggregate_id][0]
+            self.nova.services.down.add(host)
+            event = dict(hostname=host,
+                         time=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+            start = time.time()
+            if not self.provider.host_down(event):
+                failed += 1
+                continue
+            received = [n['received_at'] for n in self.masakari.notifications
+                        if n['hostname'] == host]
+            if received:
+                latencies.append(received[-1] - start)
+        return dict(notification_latency=summarize(latencies), failed=failed)
+
+    def span_breakdown(self):
+        by_name = {}
+        for span in self.spans.spans():
+            by_name.setdefault(span['name'], []).append(span['duration'])
+        return dict((name, dict(summarize(durations),
+                                total=sum(durations)))
+                    for name, durations in by_name.items())
+
+    def run(self):
+        # Host down handling queues the cluster reconfiguration as a periodic
+        # task, which is not part of the notification latency
+        with mock.patch.object(periodic_task, 'add_task'):
+            self.setup()
+            try:
+                results = dict(
+                    reconcile_cycle=self.run_reconcile(),
+                    enable_disable=self.run_enable_disable(),
+                    host_down=self.run_host_down(),
+                    calls=self.span_breakdown(),
+                    service_requests=dict(
+                        keystone=self.keystone.requests,
+                        resmgr=self.resmgr.requests,
+                        masakari=self.masakari.requests))
+            finally:
+                self.teardown()
+        return dict(timestamp=time.time(), config=vars(self.args),
+                    results=results)
+
+
+def main():
+    args = _get_arg_parser()
+    logging.basicConfig(level=logging.WARN)
+    result = Benchmark(args).run()
+    with open(args.output, 'w') as fptr:
+        json.dump(result, fptr, indent=2, sort_keys=True)
+    print json.dumps(result['results'], indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import unittest
+import mock
+
+from hamgr.common import log
+
+
+def _record(msg, args):
+    return logging.makeLogRecord(dict(name='test', levelno=logging.INFO,
+                                      msg=msg, args=args))
+
+
+class RateLimitFilterTest(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_identical_messages_limited(self, mock_time):
+        mock_time.return_value = 100
+        limiter = log.RateLimitFilter(interval=60, burst=2)
+        allowed = [limiter.filter(_record('Found %s hosts', ('a',)))
+                   for _ in range(4)]
+        self.assertEqual([True, True, False, False], allowed)
+        self.assertTrue(limiter.filter(_record('Found %s hosts', ('b',))))
+
+        mock_time.return_value = 161
+        record = _record('Found %s hosts', ('a',))
+        self.assertTrue(limiter.filter(record))
+        self.assertIn('2 identical messages suppressed', record.getMessage())
+
+    def test_queue_handler_writes_in_background(self):
+        target = mock.Mock()
+        handler = log.QueueHandler(target)
+        handler.start()
+        record = _record('Found %s hosts', ('a',))
+        handler.emit(record)
+        handler.stop()
+        target.handle.assert_called_once_with(record)
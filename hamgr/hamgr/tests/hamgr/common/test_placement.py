@@ -0,0 +1,49 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+import mock
+
+from hamgr.common import placement
+
+
+def _hypervisor(host, vcpus_used, memory_mb_used):
+    return mock.Mock(service=dict(host=host), vcpus=8, vcpus_used=vcpus_used,
+                     memory_mb=1000, memory_mb_used=memory_mb_used)
+
+
+class PlacementTest(unittest.TestCase):
+    def test_default_order(self):
+        self.assertEqual(['a', 'b', 'c'],
+                         placement.order_hosts(['c', 'a', 'b']))
+
+    def test_spread_over_domains(self):
+        hosts = ['a', 'b', 'c', 'd', 'e']
+        domains = dict(a='z1', b='z1', c='z1', d='z2', e='z3')
+        scores = dict(a=0.9, b=0.1, d=0.5)
+        self.assertEqual(['b', 'd', 'e', 'a', 'c'],
+                         placement.order_hosts(hosts, scores, domains))
+
+    def test_read_inputs(self):
+        client = mock.Mock()
+        client.hypervisors.list.return_value = [
+            _hypervisor('a', 4, 100), _hypervisor('b', 1, 900),
+            _hypervisor('x', 0, 0)]
+        client.services.list.side_effect = Exception('nova is down')
+
+        data = placement.read_inputs(client, ['a', 'b'], ['load', 'zone'])
+
+        self.assertEqual(dict(a=0.5, b=0.9), data['scores'])
+        self.assertIsNone(data['domains'])
+        self.assertEqual(['a', 'b'], placement.order_hosts(['b', 'a'], **data))
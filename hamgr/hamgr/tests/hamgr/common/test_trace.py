@@ -0,0 +1,77 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import unittest
+import mock
+
+from eventlet import corolocal
+
+from hamgr.common import trace
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self._sink = trace.RingBufferSink(size=2)
+        trace.clear_sinks()
+        trace.add_sink(self._sink)
+
+    def tearDown(self):
+        trace.clear_sinks()
+
+    def test_span_records_response(self):
+        resp = mock.Mock()
+        resp.status_code = 202
+        resp.content = '{"id": 1}'
+        with trace.start_trace('host_down') as trace_id:
+            with trace.span('masakari.create_notification') as sp:
+                sp.record_response(resp)
+        spans = trace.get_spans(trace_id=trace_id)
+        self.assertEqual(1, len(spans))
+        self.assertEqual(202, spans[0]['status_code'])
+        self.assertEqual(9, spans[0]['payload_size'])
+        self.assertEqual('host_down', spans[0]['operation'])
+        self.assertIsNotNone(spans[0]['duration'])
+
+    def test_span_records_error(self):
+        with self.assertRaises(ValueError):
+            with trace.span('resmgr.get_host'):
+                raise ValueError()
+        self.assertEqual('ValueError', trace.get_spans()[0]['error'])
+
+    # Held per greenthread as when threading is patched by eventlet
+    @mock.patch.object(trace, '_local', corolocal.local())
+    def test_propagate_to_greenthreads(self):
+        def call(name):
+            with trace.span(name):
+                pass
+
+        with trace.start_trace('host_events') as trace_id:
+            pool = eventlet.GreenPool(2)
+            list(pool.imap(trace.propagate(call), ['a', 'b']))
+        self.assertEqual([trace_id, trace_id],
+                         [s['trace_id'] for s in trace.get_spans()])
+        self.assertEqual(['host_events', 'host_events'],
+                         [s['operation'] for s in trace.get_spans()])
+
+    def test_propagate_without_trace(self):
+        func = mock.Mock()
+        self.assertIs(func, trace.propagate(func))
+
+    def test_ring_buffer_is_bounded(self):
+        for i in range(3):
+            with trace.span('span%d' % i):
+                pass
+        self.assertEqual(['span1', 'span2'],
+                         [s['name'] for s in trace.get_spans()])
@@ -118,4 +118,57 @@ class NovaProviderTest(unittest.TestCase):
         mock_token.return_value = dict(id='12ewef')
         db_api.create_cluster_if_needed('fake', TASK_COMPLETED)
         db_api.update_cluster('fake', True)
-        self._provider.put('fake', 'disable')
\ No newline at end of file
+        self._provider.put('fake', 'disable')
+
+    @mock.patch('hamgr.periodic_task.add_task')
+    @mock.patch('hamgr.common.masakari.create_notification')
+    @mock.patch('hamgr.common.utils.get_token')
+    def test_host_events(self, mock_token, mock_notify, mock_add_task):
+        mock_token.return_value = dict(id='12ewef')
+        db_api.create_cluster_if_needed('fake', TASK_COMPLETED)
+        db_api.update_cluster('fake', True)
+        self._provider._is_nova_service_active = lambda host: True
+        details = dict(time='2017-01-01 00:00:00')
+        events = [dict(event='host-down', event_details=dict(details, hostname='0')),
+                  dict(event='host-up', event_details=dict(details, hostname='2')),
+                  dict(event='host-down', event_details=dict(details, hostname='1')),
+                  dict(event='host-down', event_details=dict(details, hostname='9'))]
+
+        results = self._provider.host_events(events)
+
+        self.assertEqual([True, True, True, False], results)
+        self.assertEqual(2, mock_notify.call_count)
+        # Both hosts of the cluster are removed by a single task
+        self.assertEqual(1, mock_add_task.call_count)
+        self.assertEqual(TASK_MIGRATING,
+                         db_api.get_cluster('fake').task_state)
+
+    @mock.patch('hamgr.common.utils.get_token')
+    def test_assign_roles_cluster_size(self, mock_token):
+        mock_token.return_value = dict(id='12ewef')
+        hosts = [str(i) for i in range(4)]
+        self._provider._get_ips = mock.Mock(
+            return_value=dict((h, '192.178.1.%s' % h) for h in hosts))
+        self._provider._auth = mock.Mock()
+
+        self._provider._assign_roles(FakeNovaClient(), hosts, {})
+
+        self.assertEqual(2, self._provider._auth.call_count)
+        for call in self._provider._auth.call_args_list:
+            self.assertEqual(4, call[1]['cluster_size'])
+
+    def test_partition_hosts(self):
+        hosts = [str(i) for i in range(10, 21)]
+        self.assertEqual([sorted(hosts)],
+                         self._provider._partition_hosts(hosts))
+
+        self._provider._max_cluster_size = 4
+        partitions = self._provider._partition_hosts(hosts)
+        self.assertEqual([4, 4, 3], [len(p) for p in partitions])
+        self.assertEqual(sorted(hosts), sum(partitions, []))
+
+        # Every consul cluster keeps at least three hosts
+        self._provider._max_cluster_size = 3
+        self.assertEqual([4, 3],
+                         [len(p) for p in
+                          self._provider._partition_hosts(hosts[:7])])
@@ -0,0 +1,62 @@
+# Copyright (c) 2017 Platform9 Systems Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import unittest
+import mock
+
+from hamgr import wsgi
+
+
+class WsgiTest(unittest.TestCase):
+    def setUp(self):
+        self._provider = mock.Mock()
+        self._provider.get.return_value = []
+        patcher = mock.patch('hamgr.providers.nova.get_provider',
+                             return_value=self._provider)
+        self._get_provider = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, wsgi, '_provider', None)
+        wsgi._provider = None
+        self._client = wsgi.app_factory({}, provider='nova').test_client()
+
+    def test_provider_built_once(self):
+        for _ in range(3):
+            resp = self._client.get('/v1/ha')
+            self.assertEqual(200, resp.status_code)
+        self.assertEqual(1, self._get_provider.call_count)
+        self.assertEqual(3, self._provider.get.call_count)
+
+    def test_host_events(self):
+        self._provider.host_events.return_value = [True, False]
+        events = [dict(event='host-down', event_details=dict(hostname='h1')),
+                  dict(event='host-up', event_details=dict(hostname='h2'))]
+        resp = self._client.post('/v1/ha/events',
+                                 data=json.dumps(dict(events=events)),
+                                 content_type='application/json')
+        self.assertEqual(200, resp.status_code)
+        self._provider.host_events.assert_called_once_with(events)
+        results = json.loads(resp.data)['results']
+        self.assertEqual([('h1', True), ('h2', False)],
+                         [(r['hostname'], r['success']) for r in results])
+
+    def test_host_events_invalid(self):
+        events = [dict(event='host-down', event_details=dict(hostname='h1')),
+                  dict(event='host-gone', event_details=dict(hostname='h2'))]
+        resp = self._client.post('/v1/ha/events',
+                                 data=json.dumps(dict(events=events)),
+                                 content_type='application/json')
+        self.assertEqual(422, resp.status_code)
+        self.assertEqual([1], json.loads(resp.data)['invalid'])
+        self.assertFalse(self._provider.host_events.called)
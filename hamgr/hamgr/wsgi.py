@@ -2,30 +2,49 @@
 # Copyright (c) 2016, Platform9 Systems. All Rights Reserved
 #
 from ConfigParser import ConfigParser
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify
 from context import error_handler
 from hamgr.exceptions import *
+from hamgr.common import trace
 import logging
+import threading
+import time
 
 LOG = logging.getLogger(__name__)
 app = Flask(__name__)
 app.debug = True
 CONTENT_TYPE_HEADER = {'Content-Type': 'application/json'}
+CONFIG_FILE = '/etc/pf9/hamgr/hamgr.conf'
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def init_provider(conf, provider_name='nova'):
+    """
+    Build the provider shared by all the requests served by this process.
+    The provider owns the DB engine and registers the periodic tasks, hence
+    it is built only once, at startup.
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            start = time.time()
+            pkg = __import__('hamgr.providers.%s' % provider_name)
+            module = getattr(pkg.providers, provider_name)
+            _provider = module.get_provider(conf)
+            LOG.info('Initialized %s provider in %.3f seconds', provider_name,
+                     time.time() - start)
+    return _provider
 
 
 def get_provider():
-    provider = getattr(g, '_provider', None)
-
-    if provider is None:
-        # TODO: Make this part of config
-        provider_name = 'nova'
-        pkg = __import__('hamgr.providers.%s' % provider_name)
-        conf = ConfigParser()
-        conf.read(['/etc/pf9/hamgr/hamgr.conf'])
-        module = getattr(pkg.providers, provider_name)
-        provider = module.get_provider(conf)
-        g._provider = provider
-    return provider
+    with trace.span('wsgi.get_provider'):
+        if _provider is None:
+            conf = ConfigParser()
+            conf.read([CONFIG_FILE])
+            return init_provider(conf)
+        return _provider
 
 
 @app.route('/v1/ha', methods=['GET'])
@@ -36,6 +55,13 @@ def get_all():
     return jsonify(status=status)
 
 
+@app.route('/v1/ha/traces', methods=['GET'])
+@error_handler
+def get_traces():
+    trace_id = request.args.get('trace_id', None)
+    return jsonify(spans=trace.get_spans(trace_id=trace_id))
+
+
 @app.route('/v1/ha/<int:aggregate_id>', methods=['GET'])
 @error_handler
 def get_status(aggregate_id):
@@ -71,19 +97,57 @@ def update_status(aggregate_id, action):
         return jsonify(dict(error=ex.message)), 409, CONTENT_TYPE_HEADER
 
 
+HOST_EVENTS = ['host-up', 'host-down']
+
+
+def _validate_host_event(event):
+    if not isinstance(event, dict) or event.get('event') not in HOST_EVENTS:
+        return False
+    details = event.get('event_details')
+    return isinstance(details, dict) and bool(details.get('hostname'))
+
+
+@app.route('/v1/ha/events', methods=['POST'])
+@error_handler
+def update_host_status_batch():
+    """
+    Takes a batch of host events, {"events": [{"event": ...,
+    "event_details": {...}}, ...]}, and returns the result of each one in
+    the same order.
+    """
+    events = (request.get_json() or {}).get('events', None)
+    if not isinstance(events, list):
+        return jsonify(dict(error='Invalid input')), 422, CONTENT_TYPE_HEADER
+    invalid = [i for i, e in enumerate(events) if not _validate_host_event(e)]
+    if invalid:
+        LOG.warn('Invalid host events at %s', invalid)
+        return jsonify(dict(error='Invalid events', invalid=invalid)), 422, \
+            CONTENT_TYPE_HEADER
+
+    provider = get_provider()
+    with trace.start_trace('host-events',
+                           request.headers.get(trace.TRACE_HEADER)):
+        results = provider.host_events(events)
+    return jsonify(results=[
+        dict(event=e['event'], hostname=e['event_details']['hostname'],
+             success=bool(r)) for e, r in zip(events, results)
+    ]), 200, CONTENT_TYPE_HEADER
+
+
 @app.route('/v1/ha/<uuid:host_id>', methods=['POST'])
 @error_handler
 def update_host_status(host_id):
     event = request.get_json().get('event', None)
     event_details = request.get_json().get('event_details', {})
     provider = get_provider()
-    if event and event == 'host-down':
-        masakari_notified = provider.host_down(event_details)
-    elif event and event == 'host-up':
-        masakari_notified = provider.host_up(event_details)
-    else:
-        LOG.warn('Invalid request')
-        return jsonify(dict(success=False)), 422, CONTENT_TYPE_HEADER
+    with trace.start_trace(event, request.headers.get(trace.TRACE_HEADER)):
+        if event and event == 'host-down':
+            masakari_notified = provider.host_down(event_details)
+        elif event and event == 'host-up':
+            masakari_notified = provider.host_up(event_details)
+        else:
+            LOG.warn('Invalid request')
+            return jsonify(dict(success=False)), 422, CONTENT_TYPE_HEADER
     if masakari_notified:
         return jsonify(dict(success=True)), 200, CONTENT_TYPE_HEADER
     else:
@@ -91,4 +155,7 @@ def update_host_status(host_id):
 
 
 def app_factory(global_config, **local_conf):
+    conf = ConfigParser()
+    conf.read([global_config.get('hamgr_config', CONFIG_FILE)])
+    init_provider(conf, local_conf.get('provider', 'nova'))
     return app
@@ -7,12 +7,17 @@ from oslo_config import cfg
 from ha.utils import log as logging
 from ha.utils import consul_helper
 from ha.utils import report
+from ha.utils import trace
 from subprocess import call
+from subprocess import check_output
 from time import daylight
 from time import sleep
+from time import time
 from time import tzname
 
+import copy
 import json
+import re
 
 LOG = logging.getLogger('ha-manager')
 
@@ -30,6 +35,27 @@ consul_opts = [
                      'agent mode while 1, 3 and 5 indicate that consul is '
                      'started in server mode with bootstrap_expect being that '
                      'specified value.'),
+    cfg.IntOpt('startup_timeout', default=90,
+               help='Seconds to wait for the consul agent to start'),
+    cfg.FloatOpt('startup_probe_interval', default=0.5,
+                 help='Seconds between consul readiness checks at startup'),
+    cfg.IntOpt('idle_check_interval', default=60,
+               help='Maximum time in seconds between checks on a node that '
+                    'is not the cluster leader. Such a node also checks '
+                    'when a health check of the cluster changes. A leader '
+                    'change without a failed node can take this long to '
+                    'be acted on.'),
+    cfg.IntOpt('active_check_interval', default=2,
+               help='Time in seconds between status checks by the cluster '
+                    'leader while status changes wait to be reported.'),
+    cfg.IntOpt('cluster_size', default=0,
+               help='Number of nodes in the consul cluster, 0 if unknown. '
+                    'Used to pick the performance profile.'),
+    cfg.StrOpt('performance_profile', default='auto',
+               choices=['auto', 'small', 'medium', 'large'],
+               help='Consul gossip and raft timing profile. auto picks one '
+                    'from cluster_size, or keeps the timing of the consul '
+                    'conf templates if it is 0.'),
 ]
 
 default_opts = [
@@ -42,6 +68,7 @@ CONF.register_group(consul_grp)
 CONF.register_opts(consul_opts, consul_grp)
 CONF.register_opts(default_opts)
 PF9_CONSUL_CONF_DIR = '/opt/pf9/etc/pf9-consul/'
+CONSUL_BIN = '/usr/bin/consul'
 
 
 def expand_stats(cluster_stat):
@@ -52,12 +79,153 @@ def expand_stats(cluster_stat):
     cluster_stat['daylight'] = daylight
 
 
-def generate_consul_conf():
+# Small clusters detect failures fast, large ones keep the gossip and raft
+# traffic down. medium is the consul default timing.
+CONSUL_PROFILES = {
+    'small': {
+        'performance': {'raft_multiplier': 1},
+        'gossip_lan': {'gossip_interval': '100ms', 'probe_interval': '500ms',
+                       'probe_timeout': '250ms', 'suspicion_mult': 3},
+    },
+    'medium': {
+        'performance': {'raft_multiplier': 5},
+        'gossip_lan': {'gossip_interval': '200ms', 'probe_interval': '1s',
+                       'probe_timeout': '500ms', 'suspicion_mult': 4,
+                       'gossip_nodes': 3},
+    },
+    'large': {
+        'performance': {'raft_multiplier': 7},
+        'gossip_lan': {'gossip_interval': '500ms', 'probe_interval': '2s',
+                       'probe_timeout': '1s', 'suspicion_mult': 6,
+                       'gossip_nodes': 4},
+    },
+}
+
+# Largest cluster each profile is picked for by the auto profile
+PROFILE_MAX_SIZE = [('small', 8), ('medium', 64)]
+
+# First consul version that accepts each section, older ones refuse to
+# start with keys they do not know
+PROFILE_MIN_VERSION = {
+    'performance': (0, 7, 0),
+    'gossip_lan': (1, 0, 7),
+}
+
+VERSION_PATTERN = re.compile(r'v?(\d+)\.(\d+)\.(\d+)')
+
+DURATION_PATTERN = re.compile(r'^\d+(ms|s|m)$')
+
+
+def select_profile(cluster_size):
+    """
+    Name of the profile to apply, None to keep the timing of the template
+    """
+    if CONF.consul.performance_profile != 'auto':
+        return CONF.consul.performance_profile
+    if cluster_size <= 0:
+        return None
+    for profile, max_size in PROFILE_MAX_SIZE:
+        if cluster_size <= max_size:
+            return profile
+    return 'large'
+
+
+def parse_consul_version(version):
+    match = VERSION_PATTERN.search(version or '')
+    if not match:
+        return None
+    return tuple(int(part) for part in match.groups())
+
+
+def get_consul_version(cc=None):
+    """
+    Version of consul as a tuple of integers, None if it is not known. The
+    running agent is asked first, the consul binary if there is none.
+    """
+    if cc:
+        try:
+            return parse_consul_version(
+                cc.agent.self()['Config']['Version'])
+        except Exception:
+            LOG.debug('Consul agent did not report its version',
+                      exc_info=True)
+    try:
+        return parse_consul_version(check_output([CONSUL_BIN, 'version']))
+    except Exception:
+        LOG.warn('Could not get the version of %s', CONSUL_BIN,
+                 exc_info=True)
+        return None
+
+
+def validate_consul_conf(template, conf):
+    """
+    Check that the generated conf keeps every setting of its template and
+    that the timing settings are well formed. Raises ValueError otherwise.
+    """
+    for key, value in template.items():
+        if key not in conf:
+            raise ValueError('%s of the template is missing' % key)
+        if isinstance(value, dict):
+            validate_consul_conf(value, conf[key])
+    for key, value in conf.get('gossip_lan', {}).items():
+        if key.endswith(('_interval', '_timeout')):
+            if not DURATION_PATTERN.match(str(value)):
+                raise ValueError('gossip_lan %s is not a duration: %s' %
+                                 (key, value))
+        elif not isinstance(value, int) or value <= 0:
+            raise ValueError('gossip_lan %s is not a positive integer: %s' %
+                             (key, value))
+    multiplier = conf.get('performance', {}).get('raft_multiplier', 1)
+    if not isinstance(multiplier, int) or not 1 <= multiplier <= 10:
+        raise ValueError('raft_multiplier must be between 1 and 10: %s' %
+                         multiplier)
+
+
+def apply_performance_profile(template, server, version):
+    """
+    Return a copy of the template with the performance profile for the
+    cluster size applied. Settings of the template take precedence. Only
+    the sections that consul version accepts are added. The template is
+    returned unchanged if the version is not known or if the result is not
+    valid.
+    """
+    profile = select_profile(CONF.consul.cluster_size)
+    if profile is None:
+        return copy.deepcopy(template)
+    if version is None:
+        LOG.warn('Not applying consul performance profile %s to an unknown '
+                 'consul version', profile)
+        return copy.deepcopy(template)
+    conf = copy.deepcopy(template)
+    for section, settings in CONSUL_PROFILES[profile].items():
+        if section == 'performance' and not server:
+            # Raft only runs on the servers
+            continue
+        if version < PROFILE_MIN_VERSION[section]:
+            LOG.info('Consul %s does not support the %s settings',
+                     '.'.join(str(part) for part in version), section)
+            continue
+        merged = dict(settings)
+        merged.update(conf.get(section, {}))
+        conf[section] = merged
+    try:
+        validate_consul_conf(template, conf)
+    except ValueError:
+        LOG.exception('Not applying consul performance profile %s', profile)
+        return copy.deepcopy(template)
+    LOG.info('Using consul performance profile %s for a cluster of %d nodes',
+             profile, CONF.consul.cluster_size)
+    return conf
+
+
+def generate_consul_conf(cc=None):
     ip_address = consul_helper.get_ip_address()
+    version = get_consul_version(cc)
     if CONF.consul.bootstrap_expect == 0:
         # Start consul with agent conf
         with open(PF9_CONSUL_CONF_DIR + 'client.json.template') as fptr:
-            agent_conf = json.load(fptr)
+            agent_conf = apply_performance_profile(json.load(fptr), False,
+                                                   version)
         agent_conf['advertise_addr'] = ip_address
         agent_conf['bind_addr'] = ip_address
         agent_conf['disable_remote_exec'] = True
@@ -68,7 +236,8 @@ def generate_consul_conf():
     else:
         # Start consul with server conf
         with open(PF9_CONSUL_CONF_DIR + 'server.json.template') as fptr:
-            server_conf = json.load(fptr)
+            server_conf = apply_performance_profile(json.load(fptr), True,
+                                                    version)
         server_conf['advertise_addr'] = ip_address
         server_conf['bind_addr'] = ip_address
         server_conf['bootstrap_expect'] = CONF.consul.bootstrap_expect
@@ -82,37 +251,140 @@ def generate_consul_conf():
 def run_cmd(cmd):
     retcode = call(cmd, shell=True)
     if retcode != 0:
-        LOG.warn('{cmd} returned non-zero code'.format(cmd=cmd))
+        LOG.warn('%s returned non-zero code', cmd)
     return retcode
 
 
-def start_consul_service():
-    retval = False
-    service_start_retry = 30
+# Seconds a started consul agent gets to answer before it is started again
+CONSUL_START_ATTEMPT_TIMEOUT = 10
+
+
+def wait_for(probe, timeout, interval=None):
+    """
+    Call probe every interval seconds until it returns True or timeout
+    seconds have passed. Probe errors count as not ready.
+    """
+    interval = interval or CONF.consul.startup_probe_interval
+    deadline = time() + timeout
+    while True:
+        try:
+            if probe():
+                return True
+        except Exception:
+            pass
+        if time() >= deadline:
+            return False
+        sleep(interval)
+
+
+def consul_agent_ready(cc):
+    return bool(cc.agent.self())
 
-    retcode = run_cmd('sudo service pf9-consul status')
-    if retcode == 0:
+
+def agent_join(cc, address):
+    """
+    Have the local agent join address. python-consul sends the join as a
+    GET, which consul 1.0 and later answer with 405, so it is sent as a PUT
+    that all consul versions accept.
+    """
+    return cc.http.put(lambda response: response.code == 200,
+                       '/v1/agent/join/%s' % address)
+
+
+def log_phase(phase, start):
+    LOG.info('consul startup phase %s took %.2f seconds', phase, time() - start)
+
+
+def start_consul_service(cc):
+    start = time()
+    if wait_for(lambda: consul_agent_ready(cc), 0):
         LOG.warn('Consul service was already running.')
         return True
 
-    while service_start_retry > 0:
-        retcode = run_cmd('sudo service pf9-consul start')
-        # Sleep 3s to allow consul to fail in case the bootstrap server
-        # has not yet started. This also allows us 90s before the cluster
-        # creation will fail
-        sleep(3)
-        if retcode == 0:
-            retcode = run_cmd('sudo service pf9-consul status')
-            if retcode == 0:
-                LOG.info('Consul service started')
-                retval = True
-                break
-            else:
-                LOG.warn('Consul service stopped. Retrying...')
-        else:
+    deadline = start + CONF.consul.startup_timeout
+    while time() < deadline:
+        if run_cmd('sudo service pf9-consul start') != 0:
             LOG.warn('Consul service could not be started')
-        service_start_retry = service_start_retry - 1
-    return retval
+            sleep(CONF.consul.startup_probe_interval)
+            continue
+        # Consul exits if the bootstrap server has not started yet, in that
+        # case it is started again
+        timeout = min(CONSUL_START_ATTEMPT_TIMEOUT, deadline - time())
+        if wait_for(lambda: consul_agent_ready(cc), timeout):
+            LOG.info('Consul service started')
+            log_phase('start', start)
+            return True
+        LOG.warn('Consul agent is not responding. Retrying...')
+    LOG.error('Consul service did not start in %d seconds',
+              CONF.consul.startup_timeout)
+    return False
+
+
+def join_consul_cluster(cc):
+    """
+    Join the cluster through the server given by the join option and wait
+    for the cluster to have a leader
+    """
+    start = time()
+    try:
+        # Joining oneself generates a warning message in the consul logs but
+        # does not cause consul to crash
+        if not agent_join(cc, CONF.consul.join):
+            LOG.warn('Could not join consul cluster server %s',
+                     CONF.consul.join)
+            return False
+    except Exception:
+        LOG.warn('Could not join consul cluster server %s', CONF.consul.join,
+                 exc_info=True)
+        return False
+    LOG.info('Joined consul cluster server %s', CONF.consul.join)
+    log_phase('join', start)
+
+    start = time()
+    if wait_for(lambda: cc.status.leader() != '',
+                CONF.consul.startup_timeout):
+        log_phase('leader election', start)
+    else:
+        LOG.warn('Consul cluster has no leader yet')
+    return True
+
+
+class AdaptiveScheduler(object):
+    """
+    Decides how long the manager loop waits before the next status check.
+    A node that is not the leader only has its host ID to publish so it
+    waits for idle_check_interval, or until a health check of the cluster
+    changes. A new raft leader that did not change any check is only seen
+    after idle_check_interval. The leader checks every
+    active_check_interval seconds while changes are waiting to be reported
+    and at its usual interval otherwise.
+    """
+    def __init__(self, ch):
+        self.ch = ch
+
+    def next_interval(self, leader):
+        if not leader:
+            return CONF.consul.idle_check_interval
+        if CONF.consul.watch:
+            stable_interval = CONF.consul.watch_interval
+        else:
+            stable_interval = CONF.consul.status_check_interval
+        if not len(self.ch.changed_clusters):
+            return stable_interval
+        timeout = self.ch.seconds_until_next_report(stable_interval)
+        if timeout <= 0:
+            # A change is due but could not be reported, retry later
+            return CONF.consul.status_check_interval
+        return min(timeout, CONF.consul.active_check_interval)
+
+    def wait(self, leader):
+        timeout = self.next_interval(leader)
+        if leader and not CONF.consul.watch:
+            LOG.debug('sleeping for %s seconds', timeout)
+            sleep(timeout)
+        else:
+            LOG.debug('waiting up to %s seconds for cluster changes', timeout)
+            self.ch.wait_for_change(timeout)
 
 
 def loop():
@@ -120,44 +392,68 @@ def loop():
     cfgparser.read('/var/opt/pf9/hostagent/data.conf')
     hostid = cfgparser.get('DEFAULT', 'host_id')
     sleep_time = CONF.consul.status_check_interval
+    trace.configure()
     ch = consul_helper.consul_status(hostid)
     reporter = report.HaManagerReporter()
+    scheduler = AdaptiveScheduler(ch)
     start_loop = False
     cluster_setup = False
 
     # TODO(pacharya): Handle restart of pf9-ha-slave service
-    generate_consul_conf()
+    generate_consul_conf(ch.cc)
 
     # Assume that consul was not running beforehand
     # TODO(pacharya): If consul was running beforehand we need to cleanup the
     #                 data dir of consul to get rid of the earlier state.
-    start_loop = start_consul_service()
+    start_loop = start_consul_service(ch.cc)
 
     while start_loop:
+        # Consul state read during this iteration is shared by all the checks
+        # below. None makes each of them read it afresh.
+        snapshot = None
         if not cluster_setup:
-            # Running join against oneself generates a warning message in
-            # logs but does not cause consul to crash
-            retcode = run_cmd('consul join {ip}'.format(ip=CONF.consul.join))
-            if retcode == 0:
-                LOG.info('Joined consul cluster server {ip}'.format(
-                    ip=CONF.consul.join))
-                cluster_setup = True
-        elif ch.am_i_cluster_leader():
-            cluster_stat = ch.get_cluster_status()
-            if cluster_stat:
-                expand_stats(cluster_stat)
-                LOG.info('cluster_stat: %s', cluster_stat)
-                if reporter.report_status(cluster_stat):
-                    ch.update_reported_status(cluster_stat)
-            ch.cleanup_consul_kv_store()
+            cluster_setup = join_consul_cluster(ch.cc)
+        else:
+            snapshot = ch.snapshot()
+            if ch.am_i_cluster_leader(snapshot):
+                with trace.start_trace('report_cluster_status'):
+                    # All the changes confirmed in this iteration are
+                    # reported in it, a correlated failure of several hosts
+                    # is not spread over several iterations
+                    cluster_stats = ch.get_cluster_status(snapshot)
+                    for cluster_stat in cluster_stats:
+                        expand_stats(cluster_stat)
+                        LOG.info('cluster_stat: %s', cluster_stat)
+                    if cluster_stats:
+                        try:
+                            results = reporter.report_status_batch(
+                                cluster_stats)
+                        except Exception:
+                            # The changes stay pending and are reported again
+                            LOG.exception('Could not report cluster status')
+                            results = [False] * len(cluster_stats)
+                        for cluster_stat, reported in zip(cluster_stats,
+                                                          results):
+                            if reported:
+                                ch.update_reported_status(cluster_stat)
+                if ch.cleanup_due():
+                    ch.cleanup_consul_kv_store(snapshot)
+            else:
+                # Evidence for the leader that a failure is real
+                ch.vote_failures(snapshot)
         # It is possible that host ID was not published when the consul
         # helper was created as the cluster was not yet formed. Since this
         # operation is idempotent calling it in a loop will not cause
         # multiple updates.
-        ch.publish_hostid()
+        ch.publish_hostid(snapshot)
+        # KV writes of this iteration are committed together
+        ch.commit_kv()
 
-        LOG.info('sleeping for %s seconds' % sleep_time)
-        sleep(sleep_time)
+        if cluster_setup:
+            scheduler.wait(ch.leader)
+        else:
+            LOG.info('sleeping for %s seconds', sleep_time)
+            sleep(sleep_time)
 
     LOG.error('pf9-ha-slave service exiting...')
 
@@ -3,6 +3,7 @@
 
 from oslo_config import cfg
 from ha.hostapp import manager
+from ha.utils import log as logging
 from glob import glob
 
 import argparse
@@ -27,5 +28,7 @@ def main():
     # CONF should be setup before any processing starts
     conf_files = glob(opts.config_dir + '/*.conf')
     CONF(default_config_files=conf_files)
+    # Logging was set up with the default options when it was imported
+    logging.setup_logger()
     manager.loop()
 
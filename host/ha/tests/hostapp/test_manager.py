@@ -0,0 +1,235 @@
+# Copyright 2017 Platform9 Systems Inc.
+# All Rights Reserved
+
+import unittest
+
+import mock
+
+from oslo_config import cfg
+
+from ha.hostapp import manager
+
+CONSUL_1_0_7 = (1, 0, 7)
+
+
+class PerformanceProfileTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        self.addCleanup(cfg.CONF.clear_override, 'cluster_size', 'consul')
+        self.addCleanup(cfg.CONF.clear_override, 'performance_profile',
+                        'consul')
+        self.template = {'datacenter': 'pf9-dc1', 'server': True}
+
+    def _set(self, cluster_size, profile='auto'):
+        cfg.CONF.set_override('cluster_size', cluster_size, 'consul')
+        cfg.CONF.set_override('performance_profile', profile, 'consul')
+
+    def test_size_thresholds(self):
+        for size, profile in [(0, None), (1, 'small'), (8, 'small'),
+                              (9, 'medium'), (64, 'medium'),
+                              (65, 'large'), (500, 'large')]:
+            self.assertEqual(profile, manager.select_profile(size))
+
+    def test_configured_profile(self):
+        self._set(0, 'large')
+        self.assertEqual('large', manager.select_profile(0))
+        self.assertEqual('large', manager.select_profile(3))
+
+    def test_unknown_size_keeps_template(self):
+        self._set(0)
+        self.assertEqual(self.template, manager.apply_performance_profile(
+            self.template, True, CONSUL_1_0_7))
+
+    def test_medium_is_consul_default(self):
+        self._set(20)
+        conf = manager.apply_performance_profile(self.template, True,
+                                                 CONSUL_1_0_7)
+        self.assertEqual(5, conf['performance']['raft_multiplier'])
+        self.assertEqual('200ms', conf['gossip_lan']['gossip_interval'])
+
+    def test_template_takes_precedence(self):
+        self._set(3)
+        self.template['gossip_lan'] = {'probe_interval': '3s'}
+        conf = manager.apply_performance_profile(self.template, True,
+                                                 CONSUL_1_0_7)
+        self.assertEqual('3s', conf['gossip_lan']['probe_interval'])
+        self.assertEqual('100ms', conf['gossip_lan']['gossip_interval'])
+        self.assertEqual({'probe_interval': '3s'},
+                         self.template['gossip_lan'])
+
+    def test_raft_settings_only_on_servers(self):
+        self._set(100)
+        server = manager.apply_performance_profile(self.template, True,
+                                                   CONSUL_1_0_7)
+        client = manager.apply_performance_profile(self.template, False,
+                                                   CONSUL_1_0_7)
+        self.assertEqual(7, server['performance']['raft_multiplier'])
+        self.assertNotIn('performance', client)
+        self.assertEqual(server['gossip_lan'], client['gossip_lan'])
+
+    def test_invalid_settings_keep_template(self):
+        self._set(3)
+        for section, settings in [
+                ('gossip_lan', {'probe_interval': 'soon'}),
+                ('gossip_lan', {'suspicion_mult': 0}),
+                ('performance', {'raft_multiplier': 11})]:
+            template = dict(self.template)
+            template[section] = settings
+            self.assertEqual(template, manager.apply_performance_profile(
+                template, True, CONSUL_1_0_7))
+
+    def test_sections_gated_on_version(self):
+        self._set(3)
+        conf = manager.apply_performance_profile(self.template, True,
+                                                 (0, 7, 5))
+        self.assertEqual(1, conf['performance']['raft_multiplier'])
+        self.assertNotIn('gossip_lan', conf)
+        self.assertEqual(self.template, manager.apply_performance_profile(
+            self.template, True, (0, 6, 4)))
+
+    def test_unknown_version_keeps_template(self):
+        self._set(3)
+        self.assertEqual(self.template, manager.apply_performance_profile(
+            self.template, True, None))
+
+
+class ConsulVersionTest(unittest.TestCase):
+    def test_agent_version(self):
+        cc = mock.Mock()
+        cc.agent.self.return_value = {'Config': {'Version': '0.7.5'}}
+        self.assertEqual((0, 7, 5), manager.get_consul_version(cc))
+
+    @mock.patch.object(manager, 'check_output',
+                       return_value='Consul v1.0.7\nProtocol 2 spoken by '
+                                    'default, understands 2 to 3\n')
+    def test_binary_version(self, check_output):
+        cc = mock.Mock()
+        cc.agent.self.side_effect = Exception('connection refused')
+        self.assertEqual((1, 0, 7), manager.get_consul_version(cc))
+        check_output.assert_called_once_with([manager.CONSUL_BIN, 'version'])
+
+    @mock.patch.object(manager, 'check_output', side_effect=OSError())
+    def test_no_version(self, check_output):
+        self.assertIsNone(manager.get_consul_version())
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ConsulStartupTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        cfg.CONF.set_override('join', '10.0.0.1', 'consul')
+        self.addCleanup(cfg.CONF.clear_override, 'join', 'consul')
+        self.clock = FakeClock()
+        for patcher in [
+                mock.patch.object(manager, 'time', self.clock.time),
+                mock.patch.object(manager, 'sleep', self.clock.sleep),
+                mock.patch.object(manager, 'run_cmd', return_value=0)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cc = mock.Mock()
+
+    def test_wait_for_ready(self):
+        probe = mock.Mock(side_effect=[Exception(), False, True])
+        self.assertTrue(manager.wait_for(probe, 10, interval=1))
+        self.assertEqual(3, probe.call_count)
+        self.assertEqual(1002, self.clock.now)
+
+    def test_wait_for_timeout(self):
+        probe = mock.Mock(return_value=False)
+        self.assertFalse(manager.wait_for(probe, 3, interval=1))
+        self.assertEqual(1003, self.clock.now)
+
+    def test_consul_already_running(self):
+        self.cc.agent.self.return_value = {'Config': {}}
+        self.assertTrue(manager.start_consul_service(self.cc))
+        self.assertFalse(manager.run_cmd.called)
+
+    def test_consul_started_again(self):
+        # Not up before the start and during the first start attempt
+        attempts = int(manager.CONSUL_START_ATTEMPT_TIMEOUT /
+                       cfg.CONF.consul.startup_probe_interval) + 2
+        self.cc.agent.self.side_effect = [Exception()] * attempts + \
+            [{'Config': {}}]
+        self.assertTrue(manager.start_consul_service(self.cc))
+        self.assertEqual(2, manager.run_cmd.call_count)
+
+    def test_consul_start_timeout(self):
+        self.cc.agent.self.side_effect = Exception()
+        self.assertFalse(manager.start_consul_service(self.cc))
+        self.assertGreaterEqual(self.clock.now,
+                                1000 + cfg.CONF.consul.startup_timeout)
+
+    def test_join_as_put(self):
+        self.cc.http.put.return_value = True
+        self.cc.status.leader.return_value = '10.0.0.1:8300'
+        self.assertTrue(manager.join_consul_cluster(self.cc))
+        self.assertEqual('/v1/agent/join/10.0.0.1',
+                         self.cc.http.put.call_args[0][1])
+        callback = self.cc.http.put.call_args[0][0]
+        self.assertFalse(callback(mock.Mock(code=405)))
+        self.assertTrue(callback(mock.Mock(code=200)))
+
+    def test_join_failure(self):
+        self.cc.http.put.return_value = False
+        self.assertFalse(manager.join_consul_cluster(self.cc))
+        self.cc.http.put.side_effect = Exception('connection refused')
+        self.assertFalse(manager.join_consul_cluster(self.cc))
+        self.assertFalse(self.cc.status.leader.called)
+
+
+class AdaptiveSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        self.addCleanup(cfg.CONF.clear_override, 'watch', 'consul')
+        self.ch = mock.Mock()
+        self.ch.changed_clusters = []
+        self.scheduler = manager.AdaptiveScheduler(self.ch)
+
+    def test_not_leader(self):
+        self.assertEqual(cfg.CONF.consul.idle_check_interval,
+                         self.scheduler.next_interval(False))
+
+    def test_leader_without_changes(self):
+        self.assertEqual(cfg.CONF.consul.status_check_interval,
+                         self.scheduler.next_interval(True))
+        cfg.CONF.set_override('watch', True, 'consul')
+        self.assertEqual(cfg.CONF.consul.watch_interval,
+                         self.scheduler.next_interval(True))
+
+    def test_leader_with_changes(self):
+        self.ch.changed_clusters = [mock.Mock()]
+        self.ch.seconds_until_next_report.return_value = 1
+        self.assertEqual(1, self.scheduler.next_interval(True))
+        self.ch.seconds_until_next_report.return_value = 100
+        self.assertEqual(cfg.CONF.consul.active_check_interval,
+                         self.scheduler.next_interval(True))
+        # Due but not reported yet
+        self.ch.seconds_until_next_report.return_value = -5
+        self.assertEqual(cfg.CONF.consul.status_check_interval,
+                         self.scheduler.next_interval(True))
+
+    @mock.patch.object(manager, 'sleep')
+    def test_wait(self, sleep):
+        self.scheduler.wait(True)
+        sleep.assert_called_once_with(cfg.CONF.consul.status_check_interval)
+        self.assertFalse(self.ch.wait_for_change.called)
+
+        self.scheduler.wait(False)
+        self.ch.wait_for_change.assert_called_once_with(
+            cfg.CONF.consul.idle_check_interval)
+
+        cfg.CONF.set_override('watch', True, 'consul')
+        self.scheduler.wait(True)
+        self.ch.wait_for_change.assert_called_with(
+            cfg.CONF.consul.watch_interval)
+        self.assertEqual(1, sleep.call_count)
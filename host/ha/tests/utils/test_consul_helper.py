@@ -0,0 +1,783 @@
+# Copyright 2017 Platform9 Systems Inc.
+# All Rights Reserved
+
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import consul
+import mock
+
+from datetime import datetime
+
+from oslo_config import cfg
+
+from ha.utils import consul_helper
+
+
+class FakeResponse(object):
+    def __init__(self, code, body=''):
+        self.code = code
+        self.body = body
+        self.headers = {}
+
+
+class FakeHttp(object):
+    """
+    /v1/txn of consul. Responses are taken from responses in order, the
+    operations of every transaction are recorded.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.txns = []
+
+    def put(self, callback, path, params=None, data=''):
+        ops = [op['KV'] for op in json.loads(data)]
+        for op in ops:
+            if 'Value' in op:
+                op['Value'] = base64.b64decode(op['Value'])
+        self.txns.append(ops)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return callback(response)
+
+
+def _keys(ops):
+    return [op['Key'] for op in ops]
+
+
+class KVWriteBufferTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        self.cc = mock.Mock()
+
+    def _buffer(self, responses):
+        self.cc.http = FakeHttp(responses)
+        return consul_helper.KVWriteBuffer(self.cc)
+
+    def test_commit_in_one_transaction(self):
+        kv = self._buffer([FakeResponse(200)])
+        kv.set('a', '1')
+        kv.set('b', '2', cas=0)
+        kv.delete('c')
+
+        self.assertEqual(0, kv.commit())
+
+        self.assertEqual([['a', 'b', 'c']], map(_keys, self.cc.http.txns))
+        self.assertEqual(['set', 'cas', 'delete'],
+                         [op['Verb'] for op in self.cc.http.txns[0]])
+        self.assertEqual(0, len(kv))
+
+    def test_commit_retries_without_failed_checks(self):
+        errors = json.dumps(dict(Errors=[dict(OpIndex=1, What='cas')]))
+        kv = self._buffer([FakeResponse(409, errors), FakeResponse(200)])
+        kv.set('a', '1')
+        kv.set('b', '2', cas=0)
+        kv.set('c', '3')
+
+        self.assertEqual(1, kv.commit())
+
+        self.assertEqual([['a', 'b', 'c'], ['a', 'c']],
+                         map(_keys, self.cc.http.txns))
+
+    def test_commit_falls_back_to_single_keys(self):
+        for code in [400, 404]:
+            kv = self._buffer([FakeResponse(code)])
+            self.cc.kv.put.side_effect = [True, False]
+            kv.set('a', '1')
+            kv.set('b', '2', cas=0)
+            kv.delete('c')
+
+            self.assertEqual(1, kv.commit())
+
+            self.assertFalse(kv.txn_supported)
+            self.assertEqual([mock.call('a', '1', cas=None),
+                              mock.call('b', '2', cas=0)],
+                             self.cc.kv.put.call_args_list)
+            self.cc.kv.delete.assert_called_once_with('c')
+            self.cc.reset_mock()
+
+    def test_commit_chunks(self):
+        count = consul_helper.TXN_MAX_OPS * 2 + 1
+        kv = self._buffer([FakeResponse(200)] * 3)
+        for i in range(count):
+            kv.set('key%d' % i, str(i))
+
+        kv.commit()
+
+        self.assertEqual([consul_helper.TXN_MAX_OPS,
+                          consul_helper.TXN_MAX_OPS, 1],
+                         [len(ops) for ops in self.cc.http.txns])
+
+    def test_commit_keeps_unsent_operations(self):
+        kv = self._buffer([FakeResponse(200), FakeResponse(500, 'down')])
+        kv.set('first', 'x')
+        for i in range(consul_helper.TXN_MAX_OPS - 1):
+            kv.set('key%d' % i, str(i))
+        kv.set('last', 'y', cas=0)
+
+        self.assertRaises(consul.ConsulException, kv.commit)
+
+        self.assertEqual(1, len(kv))
+        self.assertEqual('y', kv.get_pending('last'))
+        self.cc.http.responses = [FakeResponse(200)]
+        kv.commit()
+        self.assertEqual([{'Verb': 'cas', 'Key': 'last', 'Value': 'y',
+                           'Index': 0}], self.cc.http.txns[-1])
+
+    def test_set_after_delete(self):
+        kv = self._buffer([FakeResponse(200)])
+        kv.set('a', '1')
+        kv.delete('a')
+        self.assertIsNone(kv.get_pending('a'))
+        kv.set('a', '2')
+
+        kv.commit()
+
+        self.assertEqual([('delete', 'a', None), ('set', 'a', '2')],
+                         [(op['Verb'], op['Key'], op.get('Value'))
+                          for op in self.cc.http.txns[0]])
+
+
+def _change(time, hostname, event='host-down'):
+    return consul_helper.cluster(time, {'hostname': hostname,
+                                        'eventType': event})
+
+
+def _hosts(changes):
+    return [cls.change_info['hostname'] for cls in changes]
+
+
+class PendingChangesTest(unittest.TestCase):
+    def test_add_deduplicates_by_host_and_event(self):
+        pending = consul_helper.PendingChanges()
+        self.assertTrue(pending.add(_change(10, 'a')))
+        self.assertFalse(pending.add(_change(20, 'a')))
+        self.assertTrue(pending.add(_change(20, 'a', 'host-up')))
+        self.assertEqual(2, len(pending))
+        self.assertEqual(10, pending.oldest().change_time)
+
+    def test_older_than(self):
+        pending = consul_helper.PendingChanges()
+        for time, host in [(10, 'a'), (20, 'b'), (30, 'c')]:
+            pending.add(_change(time, host))
+        self.assertEqual(['a', 'b'], _hosts(pending.older_than(30)))
+        self.assertEqual([], _hosts(pending.older_than(10)))
+
+    def test_older_than_stops_at_first_newer_change(self):
+        # Only correct while changes are added in the order of their time;
+        # older changes have to go through merge
+        pending = consul_helper.PendingChanges()
+        pending.add(_change(30, 'a'))
+        pending.add(_change(10, 'b'))
+        self.assertEqual([], _hosts(pending.older_than(20)))
+
+    def test_merge_keeps_time_order(self):
+        pending = consul_helper.PendingChanges()
+        pending.add(_change(20, 'b'))
+        pending.add(_change(40, 'd'))
+
+        added = pending.merge([_change(30, 'c'), _change(10, 'a'),
+                               _change(5, 'b')])
+
+        self.assertEqual(['c', 'a'], _hosts(added))
+        self.assertEqual(['a', 'b', 'c', 'd'], _hosts(pending))
+        self.assertEqual(20, [cls.change_time for cls in pending][1])
+        self.assertEqual(['a', 'b', 'c'], _hosts(pending.older_than(35)))
+
+    def test_remove(self):
+        pending = consul_helper.PendingChanges()
+        pending.add(_change(10, 'a'))
+        self.assertIn(_change(20, 'a'), pending)
+        pending.remove(_change(20, 'a'))
+        self.assertEqual(0, len(pending))
+        self.assertIsNone(pending.oldest())
+
+
+class ConsulStatusTestCase(unittest.TestCase):
+    """
+    consul_status of host-1 at 10.0.0.1, using self.cc as consul client
+    """
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.status_file = os.path.join(self.tmp_dir, 'last_update')
+        self.cc = mock.Mock()
+        self._patch(mock.patch.object(consul_helper,
+                                      'LAST_STATUS_UPDATE_FILE',
+                                      self.status_file))
+        self._patch(mock.patch.object(consul_helper, 'get_consul_client',
+                                      side_effect=lambda: self.cc))
+        self._patch(mock.patch.object(consul_helper, 'get_ip_address',
+                                      return_value='10.0.0.1'))
+        self._patch(mock.patch.object(consul_helper.consul_status,
+                                      'publish_hostid'))
+
+    def _patch(self, patcher):
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _status(self):
+        return consul_helper.consul_status('host-1')
+
+
+class StatusFileTest(ConsulStatusTestCase):
+    def _write(self, content):
+        with open(self.status_file, 'w') as fptr:
+            fptr.write(content)
+
+    def test_no_file(self):
+        status = self._status()
+        self.assertEqual({}, status.last_status)
+
+    def test_truncated_file(self):
+        self._write('{"version": 2, "time": 1500000000, "status": {"10.0.')
+        status = self._status()
+        self.assertEqual({}, status.last_status)
+
+    def test_legacy_file(self):
+        self._write(json.dumps({
+            'time': '2017-07-14 02:40:00',
+            'status': {'10.0.0.1': {'eventType': 'host-down',
+                                    'hostname': 'host-2'}}}))
+        status = self._status()
+        self.assertEqual('host-down',
+                         status.last_status['10.0.0.1']['eventType'])
+        self.assertEqual(datetime(2017, 7, 14, 2, 40),
+                         status.last_status_update_time)
+
+    def test_unknown_version(self):
+        self._write(json.dumps({'version': 3, 'time': 1500000000,
+                                'status': {'10.0.0.1': 'host-down'}}))
+        status = self._status()
+        self.assertEqual({}, status.last_status)
+
+    def test_round_trip(self):
+        status = self._status()
+        status.last_status = {'10.0.0.1': {'eventType': 'host-down'},
+                              '10.0.0.2': {'eventType': 'host-up'}}
+        status.last_status_update_time = datetime(2017, 7, 14, 2, 40)
+        status.dirty = True
+        status._save_status()
+
+        self.assertFalse(status.dirty)
+        with open(self.status_file) as fptr:
+            self.assertEqual(consul_helper.STATUS_FILE_VERSION,
+                             json.load(fptr)['version'])
+        loaded = self._status()
+        self.assertEqual(status.last_status, loaded.last_status)
+        self.assertEqual(status.last_status_update_time,
+                         loaded.last_status_update_time)
+
+
+class ConfirmVotersTest(unittest.TestCase):
+    def test_next_addresses(self):
+        alive = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5']
+        self.assertEqual(['10.0.0.3', '10.0.0.4'],
+                         consul_helper.confirm_voters('10.0.0.2', alive, 2))
+
+    def test_wraps_around(self):
+        alive = ['10.0.0.3', '10.0.0.1', '10.0.0.5', '10.0.0.4']
+        self.assertEqual(['10.0.0.5', '10.0.0.1', '10.0.0.3'],
+                         consul_helper.confirm_voters('10.0.0.4', alive, 3))
+
+    def test_failed_address_not_alive(self):
+        alive = ['10.0.0.1', '10.0.0.3']
+        self.assertEqual(['10.0.0.3', '10.0.0.1'],
+                         consul_helper.confirm_voters('10.0.0.2', alive, 3))
+
+
+class FakeSnapshot(object):
+    def __init__(self, index, votes):
+        self.index = index
+        self.votes = votes
+
+    def get_prefix_indexes(self, prefix):
+        return self.index, dict((consul_helper.VOTE_PREFIX + key, value)
+                                for key, value in self.votes.items())
+
+
+class ConsulSnapshotTest(unittest.TestCase):
+    def test_get_prefix_indexes(self):
+        cc = mock.Mock()
+        cc.status.leader.return_value = '10.0.0.1:8300'
+        cc.kv.get.return_value = ('15', [
+            {'Key': 'pf9-ha/votes/a/b', 'Value': '{}', 'ModifyIndex': 12}])
+        snapshot = consul_helper.ConsulSnapshot(cc)
+
+        self.assertEqual((15, {'pf9-ha/votes/a/b': 12}),
+                         snapshot.get_prefix_indexes('pf9-ha/votes/'))
+        self.assertEqual({'pf9-ha/votes/a/b': '{}'},
+                         snapshot.get_prefix('pf9-ha/votes/'))
+        self.assertEqual(1, cc.kv.get.call_count)
+
+    def test_host_id_cache(self):
+        cc = mock.Mock()
+        cc.status.leader.return_value = '10.0.0.1:8300'
+        cc.kv = FakeKV()
+        cc.kv.put(consul_helper.HOSTID_PREFIX + '10.0.0.2:8301', 'host-2')
+        cache = {}
+
+        host_ids = consul_helper.ConsulSnapshot(cc, cache).host_ids
+        self.assertEqual({'10.0.0.2:8301': 'host-2'}, host_ids)
+        # Same index, the mappings are not parsed again
+        self.assertIs(host_ids,
+                      consul_helper.ConsulSnapshot(cc, cache).host_ids)
+
+        cc.kv.put(consul_helper.HOSTID_PREFIX + '10.0.0.3:8301', 'host-3')
+        self.assertEqual({'10.0.0.2:8301': 'host-2',
+                          '10.0.0.3:8301': 'host-3'},
+                         consul_helper.ConsulSnapshot(cc, cache).host_ids)
+        cc.kv.delete(consul_helper.HOSTID_PREFIX + '10.0.0.2:8301')
+        self.assertEqual({'10.0.0.3:8301': 'host-3'},
+                         consul_helper.ConsulSnapshot(cc, cache).host_ids)
+
+
+class ConfirmedFailuresTest(ConsulStatusTestCase):
+    def setUp(self):
+        super(ConfirmedFailuresTest, self).setUp()
+        cfg.CONF.set_override('confirm_failures', True, 'consul')
+        self.addCleanup(cfg.CONF.clear_override, 'confirm_failures',
+                        'consul')
+        self.status = self._status()
+        self.status.changed_clusters.add(consul_helper.cluster(
+            1000, {'hostname': 'failed', 'eventType': 2,
+                   'cluster_port': '10.0.0.9:8301'}))
+
+    def _confirmed(self, now, index, votes):
+        return _hosts(self.status._confirmed_failures(
+            FakeSnapshot(index, votes), now))
+
+    def test_quorum(self):
+        self.assertEqual([], self._confirmed(990, 10, {}))
+        self.assertEqual([], self._confirmed(
+            1000, 11, {'failed/a': 11}))
+        self.assertEqual([], self._confirmed(1040, 11, {'failed/a': 11}))
+        self.assertEqual(['failed'], self._confirmed(
+            1050, 12, {'failed/a': 11, 'failed/b': 12}))
+
+    def test_votes_of_other_hosts(self):
+        self._confirmed(990, 10, {})
+        self.assertEqual([], self._confirmed(
+            1040, 12, {'failed/a': 11, 'other/b': 12}))
+
+    def test_votes_before_first_read_do_not_count(self):
+        self.assertEqual([], self._confirmed(
+            1040, 12, {'failed/a': 11, 'failed/b': 12}))
+        # Until they are written again
+        self.assertEqual(['failed'], self._confirmed(
+            1050, 14, {'failed/a': 13, 'failed/b': 14}))
+
+    def test_old_votes_do_not_count(self):
+        self._confirmed(900, 10, {})
+        self._confirmed(910, 12, {'failed/a': 11, 'failed/b': 12})
+        self.assertEqual([], self._confirmed(
+            1040, 12, {'failed/a': 11, 'failed/b': 12}))
+        self.assertEqual([], self._confirmed(
+            1050, 13, {'failed/a': 11, 'failed/b': 13}))
+        self.assertEqual(['failed'], self._confirmed(
+            1060, 14, {'failed/a': 14, 'failed/b': 13}))
+
+
+class LeaderTest(ConsulStatusTestCase):
+    def setUp(self):
+        super(LeaderTest, self).setUp()
+        self._patch(mock.patch.object(consul_helper.consul_status,
+                                      'migrate_legacy_keys'))
+        self._patch(mock.patch.object(consul_helper.consul_status,
+                                      'populate_cache_from_consul'))
+        self.status = self._status()
+
+    def _snapshot(self, leader):
+        snapshot = mock.Mock()
+        snapshot.alive = True
+        snapshot.leader = leader + ':8300'
+        return snapshot
+
+    def test_cleanup_due_on_takeover(self):
+        self.assertTrue(self.status.cleanup_due())
+        self.status._last_cleanup = datetime.now()
+        self.assertFalse(self.status.cleanup_due())
+
+        self.assertTrue(self.status.am_i_cluster_leader(
+            self._snapshot('10.0.0.1')))
+        self.assertTrue(self.status.cleanup_due())
+
+        self.status._last_cleanup = datetime.now()
+        self.assertTrue(self.status.am_i_cluster_leader(
+            self._snapshot('10.0.0.1')))
+        self.assertFalse(self.status.cleanup_due())
+
+
+class WaitForChangeTest(ConsulStatusTestCase):
+    def setUp(self):
+        super(WaitForChangeTest, self).setUp()
+        self._patch(mock.patch.object(consul_helper, 'sleep'))
+        self.status = self._status()
+
+    def test_change(self):
+        self.cc.health.state.side_effect = [('10', []), ('12', [])]
+
+        self.assertTrue(self.status.wait_for_change(30))
+
+        self.assertEqual([mock.call('critical'),
+                          mock.call('critical', index='10', wait='30s')],
+                         self.cc.health.state.call_args_list)
+
+    def test_timeout(self):
+        self.cc.health.state.side_effect = [('10', []), ('10', [])]
+        self.assertFalse(self.status.wait_for_change(0.5))
+        self.assertEqual(mock.call('critical', index='10', wait='1s'),
+                         self.cc.health.state.call_args)
+        self.cc.health.state.side_effect = [('11', [])]
+        self.assertTrue(self.status.wait_for_change(30))
+
+    def test_error(self):
+        self.cc.health.state.side_effect = [('10', []),
+                                            Exception('no leader')]
+        self.assertFalse(self.status.wait_for_change(30))
+        consul_helper.sleep.assert_called_once_with(30)
+        self.assertIsNone(self.status._health_index)
+
+
+class FakeKV(object):
+    """
+    KV store of consul, with the index moving on every write
+    """
+    def __init__(self):
+        self.data = {}
+        self.index = 1
+
+    def get(self, key, recurse=False, keys=False, separator=None, **kwargs):
+        if keys:
+            found = set()
+            for name in self.data:
+                if name.startswith(key):
+                    rest = name[len(key):]
+                    if separator and separator in rest:
+                        rest = rest.split(separator)[0] + separator
+                    found.add(key + rest)
+            return str(self.index), sorted(found) or None
+        if recurse:
+            entries = [{'Key': name, 'Value': value, 'ModifyIndex': index}
+                       for name, (value, index) in sorted(self.data.items())
+                       if name.startswith(key)]
+            return str(self.index), entries or None
+        if key not in self.data:
+            return str(self.index), None
+        value, index = self.data[key]
+        return str(self.index), {'Key': key, 'Value': value,
+                                 'ModifyIndex': index}
+
+    def put(self, key, value, cas=None, **kwargs):
+        if cas is not None and self.data.get(key, (None, 0))[1] != cas:
+            return False
+        self.index += 1
+        self.data[key] = (value, self.index)
+        return True
+
+    def delete(self, key, **kwargs):
+        self.index += 1
+        self.data.pop(key, None)
+        return True
+
+    def value(self, key):
+        return self.data[key][0] if key in self.data else None
+
+
+def _legacy_record(hostname, event_type, change_time, report_id=None):
+    change = consul_helper.cluster(change_time, {
+        'hostname': hostname, 'eventType': event_type,
+        'cluster_port': '10.0.0.2:8301'})
+    notice_time = datetime.fromtimestamp(change_time).strftime(
+        '%Y-%m-%d %H:%M:%S')
+    return json.dumps({'node_info': repr(change),
+                       'notice_time': notice_time,
+                       'report_time': notice_time if report_id else None,
+                       'id': report_id})
+
+
+class MigrateLegacyKeysTest(ConsulStatusTestCase):
+    HOST_A = 'aaaaaaaa-0000-0000-0000-000000000001'
+    HOST_B = 'aaaaaaaa-0000-0000-0000-000000000002'
+
+    def setUp(self):
+        super(MigrateLegacyKeysTest, self).setUp()
+        self.cc.kv = FakeKV()
+        self.status = self._status()
+        self.status.leader = True
+
+    def test_migrate(self):
+        kv = self.cc.kv
+        kv.put('10.0.0.2:8301', self.HOST_A)
+        kv.put(self.HOST_A, _legacy_record(self.HOST_A, 2, 1500000000))
+        kv.put(self.HOST_B, _legacy_record(self.HOST_B, 1, 1500000000,
+                                           report_id='report-1'))
+        kv.put('other', 'kept')
+
+        self.status.migrate_legacy_keys()
+
+        self.assertEqual(['other', 'pf9-ha/'], kv.get('', keys=True,
+                                                      separator='/')[1])
+        self.assertEqual(self.HOST_A,
+                         kv.value(consul_helper.HOSTID_PREFIX +
+                                  '10.0.0.2:8301'))
+        record = json.loads(kv.value(consul_helper.REPORT_PREFIX +
+                                     self.HOST_A))
+        self.assertEqual(consul_helper.REPORT_RECORD_VERSION,
+                         record['version'])
+        self.assertEqual(1500000000, record['change_time'])
+        self.assertIsNone(record['id'])
+        self.assertEqual(record, json.loads(kv.value(
+            consul_helper.PENDING_PREFIX + self.HOST_A)))
+        self.assertEqual('report-1', json.loads(kv.value(
+            consul_helper.REPORT_PREFIX + self.HOST_B))['id'])
+        self.assertIsNone(kv.value(consul_helper.PENDING_PREFIX +
+                                   self.HOST_B))
+        self.assertEqual([self.HOST_A],
+                         _hosts(self.status.changed_clusters))
+
+    def test_new_keys_not_overwritten(self):
+        kv = self.cc.kv
+        kv.put('10.0.0.2:8301', self.HOST_B)
+        kv.put(consul_helper.HOSTID_PREFIX + '10.0.0.2:8301', self.HOST_A)
+        self.status.migrate_legacy_keys()
+        self.assertEqual(self.HOST_A, kv.value(
+            consul_helper.HOSTID_PREFIX + '10.0.0.2:8301'))
+        self.assertIsNone(kv.value('10.0.0.2:8301'))
+
+    def test_malformed_record(self):
+        kv = self.cc.kv
+        kv.put(self.HOST_A, '{"node_info": "{}", "id": null}')
+        kv.put(self.HOST_B, 'not json')
+        kv.put('10.0.0.2:8301', self.HOST_A)
+
+        self.status.migrate_legacy_keys()
+
+        self.assertEqual('not json', kv.value(self.HOST_B))
+        self.assertIsNotNone(kv.value(self.HOST_A))
+        self.assertIsNone(kv.value(consul_helper.REPORT_PREFIX +
+                                   self.HOST_A))
+        self.assertEqual(self.HOST_A, kv.value(
+            consul_helper.HOSTID_PREFIX + '10.0.0.2:8301'))
+        self.assertEqual(0, len(self.status.changed_clusters))
+
+    @mock.patch.object(consul_helper.consul_status,
+                       'populate_cache_from_consul')
+    def test_takeover_survives_failed_migration(self, populate):
+        self.status.leader = False
+        self.cc.kv = mock.Mock()
+        self.cc.kv.get.side_effect = consul.ConsulException('500')
+        snapshot = mock.Mock(alive=True, leader='10.0.0.1:8300')
+
+        self.assertTrue(self.status.am_i_cluster_leader(snapshot))
+
+        self.assertTrue(self.status.leader)
+        populate.assert_called_once_with(snapshot)
+
+
+class FailingOnlyTest(ConsulStatusTestCase):
+    def setUp(self):
+        super(FailingOnlyTest, self).setUp()
+        cfg.CONF.set_override('failing_only', True, 'consul')
+        self.addCleanup(cfg.CONF.clear_override, 'failing_only', 'consul')
+        self.now = 1000.0
+        self._patch(mock.patch.object(consul_helper, 'time',
+                                      side_effect=lambda: self.now))
+        self.cc.kv = FakeKV()
+        self.cc.status.leader.return_value = '10.0.0.1:8300'
+        self.members = {}
+        self.critical = set()
+        self.cc.agent.members.side_effect = lambda: [
+            dict(member) for member in self.members.values()]
+        self.cc.health.state.side_effect = lambda state: ('1', [
+            {'Node': name, 'CheckID': 'serfHealth', 'Status': 'critical'}
+            for name in self.critical])
+        for n in range(1, 4):
+            self._add_member(n)
+        self.status = self._status()
+
+    def _add_member(self, n):
+        addr = '10.0.0.%d' % n
+        self.members[n] = {'Name': 'node%d' % n, 'Addr': addr, 'Port': 8301,
+                           'Status': 1}
+        self.cc.kv.put('%s%s:8301' % (consul_helper.HOSTID_PREFIX, addr),
+                       'host-%d' % n)
+
+    def _tick(self, seconds=10):
+        self.now += seconds
+        self.status.get_cluster_status(consul_helper.ConsulSnapshot(self.cc))
+
+    def _changes(self):
+        return [(cls.change_info['hostname'], cls.change_info['eventType'])
+                for cls in self.status.changed_clusters]
+
+    def test_recovering_member(self):
+        self._tick()
+        self.assertEqual(1, self.cc.agent.members.call_count)
+
+        self.members[2]['Status'] = 4
+        self.critical.add('node2')
+        self._tick()
+        self.assertEqual([('host-2', 2)], self._changes())
+        # Reported as down
+        self.status.last_status['10.0.0.2'] = \
+            self.status.current_status['10.0.0.2']
+        self.status.changed_clusters.clear()
+        self._tick()
+        self.assertEqual([], self._changes())
+
+        self.members[2]['Status'] = 1
+        self.critical.discard('node2')
+        self._tick()
+        self.assertEqual([('host-2', 1)], self._changes())
+        # Checked until the change is reported
+        self._tick()
+        self.assertEqual(1, self.status.current_status['10.0.0.2'][
+            'eventType'])
+        # Only the baseline read all the members
+        self.assertEqual(1, self.cc.agent.members.call_count)
+
+    def test_member_that_left_seen_at_baseline_refresh(self):
+        self._tick()
+        self.members[3]['Status'] = 3
+        self._tick()
+        self._tick()
+        self.assertEqual([], self._changes())
+
+        self._tick(cfg.CONF.consul.member_refresh_interval)
+
+        self.assertEqual(2, self.cc.agent.members.call_count)
+        self.assertEqual([('host-3', 2)], self._changes())
+
+    def test_failing_member_not_in_baseline(self):
+        self._tick()
+        self._add_member(4)
+        self.members[4]['Status'] = 4
+        self.critical.add('node4')
+        self._tick()
+        self.assertEqual(2, self.cc.agent.members.call_count)
+        self.assertEqual(2, self.status.current_status['10.0.0.4'][
+            'eventType'])
+
+
+def _report_record(hostname, change_time, report_id=None, addr='10.0.0.2'):
+    change = consul_helper.cluster(change_time, {
+        'hostname': hostname, 'eventType': 2,
+        'cluster_port': '%s:8301' % addr})
+    return json.dumps(consul_helper.make_report_record(
+        change, report_id=report_id))
+
+
+class TakeoverTest(ConsulStatusTestCase):
+    def setUp(self):
+        super(TakeoverTest, self).setUp()
+        self.cc.kv = FakeKV()
+        self.cc.status.leader.return_value = '10.0.0.1:8300'
+        self.cc.agent.members.return_value = [
+            {'Name': 'node%d' % n, 'Addr': '10.0.0.%d' % n, 'Port': 8301,
+             'Status': 4 if n == 3 else 1} for n in range(1, 4)]
+        for n in range(1, 4):
+            self.cc.kv.put('%s10.0.0.%d:8301' % (consul_helper.HOSTID_PREFIX,
+                                                n), 'host-%d' % n)
+        self.threads = []
+        self._patch(mock.patch.object(
+            consul_helper.threading, 'Thread',
+            side_effect=lambda **kwargs: self.threads.append(kwargs) or
+            mock.Mock()))
+        self.status = self._status()
+        # The reconciler has its own client on the same cluster
+        self.reconcile_cc = mock.Mock(kv=self.cc.kv, agent=self.cc.agent,
+                                      status=self.cc.status)
+        consul_helper.get_consul_client.side_effect = \
+            lambda: self.reconcile_cc
+
+    def _put(self, prefix, hostname, value):
+        self.cc.kv.put(prefix + hostname, value)
+
+    def _take_over(self):
+        self.status.leader = True
+        self.status.populate_cache_from_consul(
+            consul_helper.ConsulSnapshot(self.cc))
+
+    def _reconcile(self):
+        thread = self.threads.pop(0)
+        thread['target'](*thread['args'])
+
+    def test_pending_records_loaded(self):
+        self._put(consul_helper.PENDING_PREFIX, 'host-5',
+                  _report_record('host-5', 1500000200))
+        self._put(consul_helper.PENDING_PREFIX, 'host-4',
+                  _report_record('host-4', 1500000100))
+        self._take_over()
+        self.assertEqual(['host-4', 'host-5'],
+                         _hosts(self.status.changed_clusters))
+        self.assertEqual(1, len(self.threads))
+
+    def test_unindexed_records_rewritten_as_pending(self):
+        self._put(consul_helper.PENDING_PREFIX, 'host-5',
+                  _report_record('host-5', 1500000200))
+        for hostname, change_time in [('host-5', 1500000200),
+                                      ('host-4', 1500000100)]:
+            self._put(consul_helper.REPORT_PREFIX, hostname,
+                      _report_record(hostname, change_time))
+        self._put(consul_helper.REPORT_PREFIX, 'host-6',
+                  _report_record('host-6', 1500000000, report_id='done'))
+        self._take_over()
+        self._reconcile()
+
+        self.status._merge_reconciled()
+
+        record = json.loads(self.status.kv_buffer.get_pending(
+            consul_helper.PENDING_PREFIX + 'host-4'))
+        self.assertEqual(1500000100, record['change_time'])
+        self.assertIsNone(self.status.kv_buffer.get_pending(
+            consul_helper.PENDING_PREFIX + 'host-6'))
+        # host-3 failed without a record
+        self.assertEqual(['host-4', 'host-5', 'host-3'],
+                         _hosts(self.status.changed_clusters))
+
+    def test_reconciled_during_tick(self):
+        self._put(consul_helper.REPORT_PREFIX, 'host-4',
+                  _report_record('host-4', 1500000100))
+        self._take_over()
+        get_cluster_status = self.status._get_cluster_status
+
+        def tick(*args, **kwargs):
+            # The reconciler finishes while this tick reads the members
+            self._reconcile()
+            return get_cluster_status(*args, **kwargs)
+
+        with mock.patch.object(self.status, '_get_cluster_status',
+                               side_effect=tick):
+            self.status.get_cluster_status(
+                consul_helper.ConsulSnapshot(self.cc))
+        self.assertNotIn('host-4', _hosts(self.status.changed_clusters))
+
+        self.status.get_cluster_status(consul_helper.ConsulSnapshot(self.cc))
+
+        self.assertEqual('host-4', _hosts(self.status.changed_clusters)[0])
+        self.assertIsNotNone(self.status.kv_buffer.get_pending(
+            consul_helper.PENDING_PREFIX + 'host-4'))
+
+    def test_reconciled_for_earlier_takeover(self):
+        self._put(consul_helper.REPORT_PREFIX, 'host-4',
+                  _report_record('host-4', 1500000100))
+        self._take_over()
+        self._take_over()
+        self._reconcile()
+        self.status._merge_reconciled()
+        self.assertEqual([], _hosts(self.status.changed_clusters))
+        self.assertEqual(0, len(self.status.kv_buffer))
+
+    def test_reconciler_uses_own_client(self):
+        self._take_over()
+        calls = consul_helper.get_consul_client.call_count
+        self._reconcile()
+        self.assertEqual(calls + 1, consul_helper.get_consul_client.call_count)
+        self.assertIsNot(self.reconcile_cc, self.status.cc)
@@ -0,0 +1,243 @@
+# Copyright 2017 Platform9 Systems Inc.
+# All Rights Reserved
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import mock
+import requests
+
+from oslo_config import cfg
+
+from ha.utils import report
+
+
+def _response(status_code, body=None):
+    resp = mock.Mock()
+    resp.status_code = status_code
+    resp.content = json.dumps(body)
+    resp.json.return_value = body
+    return resp
+
+
+def _data(hostname, event_type=2):
+    return {'hostname': hostname, 'eventType': event_type}
+
+
+class HaManagerReporterTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        for patcher in [mock.patch('time.sleep'),
+                        mock.patch('random.uniform',
+                                   side_effect=lambda low, high: high)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.reporter = report.HaManagerReporter()
+        self.reporter.token_manager = mock.Mock()
+        self.reporter.token_manager.get.return_value = {'id': 'token'}
+        self.reporter.session = mock.Mock()
+        self.post = self.reporter.session.post
+
+    def _urls(self):
+        return [call[0][0].split('/')[-1]
+                for call in self.post.call_args_list]
+
+    def test_post_retries_with_backoff(self):
+        self.post.side_effect = [requests.ConnectionError(),
+                                 _response(503), _response(200)]
+
+        resp = self.reporter._post('span', 'url', '{}', {})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(3, self.post.call_count)
+        self.assertEqual([mock.call(0.5), mock.call(1.0)],
+                         report.time.sleep.call_args_list)
+
+    def test_post_gives_up(self):
+        self.post.return_value = _response(500)
+        self.assertRaises(report.DeliveryFailed, self.reporter._post,
+                          'span', 'url', '{}', {})
+        self.assertEqual(cfg.CONF.report.retries + 1, self.post.call_count)
+
+    def test_post_client_error_not_retried(self):
+        self.post.return_value = _response(400)
+        self.assertEqual(400, self.reporter._post('span', 'url', '{}',
+                                                  {}).status_code)
+        self.assertEqual(1, self.post.call_count)
+
+    @mock.patch('time.time', return_value=1000)
+    def test_post_stops_at_deadline(self, _):
+        self.post.return_value = _response(500)
+        self.assertRaises(report.DeliveryFailed, self.reporter._post,
+                          'span', 'url', '{}', {}, deadline=1000.2)
+        self.assertEqual(1, self.post.call_count)
+        self.assertRaises(report.DeliveryFailed, self.reporter._post,
+                          'span', 'url', '{}', {}, deadline=999)
+        self.assertEqual(1, self.post.call_count)
+
+    def test_batch(self):
+        self.post.return_value = _response(200, {'results': [
+            {'success': True}, {'success': False}]})
+        results = self.reporter.report_status_batch(
+            [_data('a'), _data('b', 1), _data('c')])
+        self.assertEqual([True, False, False], results)
+        self.assertEqual(['events'], self._urls())
+
+    def test_batch_not_supported(self):
+        self.post.side_effect = [_response(404), _response(200, {
+            'success': True}), _response(200, {'success': True})]
+
+        results = self.reporter.report_status_batch([_data('a'),
+                                                     _data('b')])
+
+        self.assertEqual([True, True], results)
+        self.assertEqual(['events', 'a', 'b'], self._urls())
+        self.assertFalse(self.reporter.batch_supported)
+
+    def test_single_events_keep_results_of_delivered_ones(self):
+        self.reporter.batch_supported = False
+        self.post.side_effect = [_response(200, {'success': True})] + \
+            [requests.ConnectionError()] * (cfg.CONF.report.retries + 1) + \
+            [_response(200, {'success': True})]
+
+        results = self.reporter.report_status_batch(
+            [_data('a'), _data('b'), _data('c')])
+
+        self.assertEqual([True, False, True], results)
+
+    def test_rejected_token_invalidated(self):
+        self.post.return_value = _response(401)
+        self.assertEqual([False, False], self.reporter.report_status_batch(
+            [_data('a'), _data('b')]))
+        self.reporter.token_manager.invalidate.assert_called_with('token')
+
+    def test_no_token(self):
+        self.reporter.token_manager.get.return_value = None
+        self.assertFalse(self.reporter.report_status(_data('a')))
+        self.assertFalse(self.post.called)
+
+    def test_invalid_response(self):
+        resp = _response(200)
+        resp.json.side_effect = ValueError()
+        self.post.return_value = resp
+        self.assertEqual([False, False], self.reporter.report_status_batch(
+            [_data('a'), _data('b')]))
+
+
+def _token(token_id, expires_in):
+    expires = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                            time.gmtime(time.time() + expires_in))
+    return {'id': token_id, 'expires': expires}
+
+
+class StopLoop(Exception):
+    pass
+
+
+class TokenManagerTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF([], default_config_files=[])
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache_file = os.path.join(self.tmp_dir, 'cache', 'token')
+        patcher = mock.patch('threading.Thread')
+        self.thread = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = report.TokenManager('http://keystone/tokens',
+                                           self.cache_file)
+        self.manager.session = mock.Mock()
+        self.post = self.manager.session.post
+
+    def _keystone(self, *tokens):
+        self.post.side_effect = [
+            _response(200, {'access': {'token': token}}) for token in tokens]
+
+    def _cache(self, token):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as fptr:
+            json.dump(token, fptr)
+
+    def test_fetched_when_first_needed(self):
+        self.assertFalse(self.post.called)
+        self._keystone(_token('a', 3600))
+        self.assertEqual('a', self.manager.get()['id'])
+        self.assertEqual('a', self.manager.get()['id'])
+        self.assertEqual(1, self.post.call_count)
+        self.assertEqual(1, self.thread.call_count)
+
+    def test_saved_to_cache(self):
+        self._keystone(_token('a', 3600))
+        self.manager.get()
+        with open(self.cache_file) as fptr:
+            self.assertEqual('a', json.load(fptr)['id'])
+        self.assertEqual(0600, stat.S_IMODE(os.stat(self.cache_file).st_mode))
+        self.assertFalse(os.path.exists(self.cache_file + '.tmp'))
+
+    def test_loaded_from_cache(self):
+        self._cache(_token('cached', 3600))
+        self.assertEqual('cached', self.manager.get()['id'])
+        self.assertFalse(self.post.called)
+
+    def test_expiring_cache_replaced(self):
+        self._cache(_token('cached', 60))
+        self._keystone(_token('new', 3600))
+        self.assertEqual('new', self.manager.get()['id'])
+
+    def test_unreadable_cache(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as fptr:
+            fptr.write('{"id": ')
+        self._keystone(_token('new', 3600))
+        self.assertEqual('new', self.manager.get()['id'])
+
+    def test_need_refresh(self):
+        token = _token('a', 600)
+        self.assertFalse(self.manager._need_refresh(
+            token, report.TokenManager.EXPIRY_MARGIN))
+        self.assertTrue(self.manager._need_refresh(
+            token, report.TokenManager.REFRESH_AHEAD))
+        self.assertTrue(self.manager._need_refresh(None))
+        self.assertTrue(self.manager._need_refresh({'id': 'a',
+                                                    'expires': 'soon'}))
+
+    def test_no_token_close_to_expiry(self):
+        self._keystone(_token('a', 60))
+        self.assertIsNone(self.manager.get())
+
+    def test_keystone_unreachable(self):
+        self.post.side_effect = requests.ConnectionError()
+        self.assertIsNone(self.manager.get())
+
+    def test_invalidate(self):
+        self._keystone(_token('a', 3600), _token('b', 3600))
+        self.manager.get()
+        self.manager.invalidate('a')
+        self.assertEqual('b', self.manager.get()['id'])
+
+    def test_invalidate_after_refresh(self):
+        # A request sent with token a fails after a refresh got token b
+        self._keystone(_token('a', 3600), _token('b', 3600))
+        self.manager.get()
+        with self.manager._lock:
+            self.manager._token = None
+            self.manager._refresh(report.TokenManager.EXPIRY_MARGIN)
+        self.manager.invalidate('a')
+        self.assertEqual('b', self.manager.get()['id'])
+        self.assertEqual(2, self.post.call_count)
+
+    @mock.patch('time.sleep', side_effect=StopLoop())
+    def test_refresh_ahead_of_expiry(self, sleep):
+        self.manager._token = _token('a', 2000)
+        self.assertRaises(StopLoop, self.manager._refresh_loop)
+        wait = sleep.call_args[0][0]
+        self.assertTrue(1095 <= wait <= 1100, wait)
+
+    @mock.patch('time.sleep', side_effect=StopLoop())
+    def test_refresh_retry(self, sleep):
+        self.assertRaises(StopLoop, self.manager._refresh_loop)
+        sleep.assert_called_once_with(report.TokenManager.RETRY_INTERVAL)
@@ -4,20 +4,30 @@
 from datetime import datetime
 from datetime import timedelta
 from ha.utils import log as logging
+from ha.utils import trace
 from netifaces import gateways
 from netifaces import ifaddresses
 from netifaces import AF_INET
+from os import fsync
 from os import makedirs
+from os import rename
 from os.path import dirname
 from os.path import exists
 from oslo_config import cfg
 from subprocess import check_output
 from subprocess import CalledProcessError
+from time import mktime
+from time import sleep
+from time import time
 from uuid import uuid4
 
+import base64
+import bisect
+import collections
 import json
 import consul
 import re
+import threading
 
 
 LOG = logging.getLogger(__name__)
@@ -32,8 +42,40 @@ consul_opts = [
                     'controller in seconds.'),
     cfg.StrOpt('last_update_file', default='/var/consul-status/last_update',
                help='Location of the status update cache file'),
+    cfg.BoolOpt('last_update_fsync', default=True,
+                help='Whether the status update cache file is synced to disk '
+                     'when it is written.'),
     cfg.IntOpt('key_reap_interval', default=72*60,
-               help='Minutes before stale key value entries are deleted.')
+               help='Minutes before stale key value entries are deleted.'),
+    cfg.IntOpt('cleanup_interval', default=60*60,
+               help='Seconds between scans of the KV store for stale '
+                    'entries by the cluster leader.'),
+    cfg.BoolOpt('watch', default=False,
+                help='Wait for cluster membership changes with consul '
+                     'blocking queries instead of polling every '
+                     'status_check_interval seconds.'),
+    cfg.IntOpt('watch_interval', default=60,
+               help='Maximum time in seconds to wait for a membership change'
+                    ' in watch mode before checking the cluster anyway.'),
+    cfg.BoolOpt('failing_only', default=False,
+                help='Only ask consul for the members whose serf health '
+                     'check is critical on every status check. The full '
+                     'member list is read every member_refresh_interval '
+                     'seconds as a baseline.'),
+    cfg.IntOpt('member_refresh_interval', default=600,
+               help='Seconds between reads of the full member list in '
+                    'failing_only mode.'),
+    cfg.BoolOpt('confirm_failures', default=False,
+                help='Have peers of a failed node vote on its failure so that '
+                     'the leader can report it after confirm_interval '
+                     'instead of report_interval.'),
+    cfg.IntOpt('confirm_interval', default=30,
+               help='Seconds a failure has to last before it can be reported '
+                    'when peer_quorum peers have confirmed it.'),
+    cfg.IntOpt('confirm_voters', default=3,
+               help='Number of peers that vote on the failure of a node.'),
+    cfg.IntOpt('peer_quorum', default=2,
+               help='Number of peer votes needed to confirm a failure.')
 ]
 
 node_grp = cfg.OptGroup('node', title='Options related to a consul node')
@@ -50,6 +92,24 @@ CONF.register_opts(node_opts, node_grp)
 LAST_STATUS_UPDATE_FILE = CONF.consul.last_update_file
 UUID_PATTERN = re.compile(r'^[\da-f]{8}-([\da-f]{4}-){3}[\da-f]{12}$', re.IGNORECASE)
 CONSUL_PORTS = [8300, 8301, 8302, 8400, 8500, 8600]
+# KV prefix under which the <ip>:<port> = <host ID> mappings are published
+HOSTID_PREFIX = 'pf9-ha/hosts/'
+# KV prefix of the <host ID> = <report record> entries kept by the leader
+REPORT_PREFIX = 'pf9-ha/reports/'
+# Copies of the report records that have not been reported yet, so that a
+# new leader can pick them up without reading all the records
+PENDING_PREFIX = 'pf9-ha/pending/'
+# pf9-ha/votes/<host ID of the failed node>/<host ID of the voter>
+VOTE_PREFIX = 'pf9-ha/votes/'
+REPORT_RECORD_VERSION = 1
+# Format of the status update cache file. Files without a version are the
+# legacy format holding whole member reports and formatted times.
+STATUS_FILE_VERSION = 2
+# Largest number of operations consul accepts in one transaction
+TXN_MAX_OPS = 64
+# Minimum seconds between checks for keys written at the KV root by older
+# agents, made while some members have no host ID under HOSTID_PREFIX
+LEGACY_CHECK_INTERVAL = 60
 
 
 def _valid_ip_address(string):
@@ -71,6 +131,8 @@ def _valid_consul_port(string):
         return False
 
 def valid_cluster_port(string):
+    if ':' not in string:
+        return False
     ip_address, port = string.split(':', 1)
     return _valid_ip_address(ip_address) and _valid_consul_port(port)
 
@@ -90,13 +152,319 @@ def get_ip_address():
         return ''
 
 
+class _TracedConsulHTTP(object):
+    """
+    Wraps the python-consul HTTP client so that every consul API call is
+    recorded as a span
+    """
+    def __init__(self, http):
+        self._http = http
+
+    def _call(self, method, callback, path, **kwargs):
+        with trace.span('consul.%s %s' % (method.upper(), path)) as sp:
+            def traced_callback(response):
+                sp.status_code = response.code
+                sp.payload_size = len(response.body or '')
+                return callback(response)
+            return getattr(self._http, method)(traced_callback, path,
+                                               **kwargs)
+
+    def get(self, callback, path, params=None):
+        return self._call('get', callback, path, params=params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self._call('put', callback, path, params=params, data=data)
+
+    def delete(self, callback, path, params=None):
+        return self._call('delete', callback, path, params=params)
+
+
+def get_consul_client():
+    cc = consul.Consul()
+    cc.http = _TracedConsulHTTP(cc.http)
+    return cc
+
+
+class ConsulSnapshot(object):
+    """
+    State of the consul cluster as seen by one iteration of the manager
+    loop. The leader is read when the snapshot is taken. The members and the
+    KV store are read the first time they are needed and are not read again
+    for the life of the snapshot, so every check made during the iteration
+    sees the same cluster. host_id_cache keeps the host ID mappings across
+    snapshots, they are only parsed again when the consul index of their
+    prefix has changed.
+    """
+    def __init__(self, cc, host_id_cache=None):
+        self._cc = cc
+        self._host_id_cache = host_id_cache
+        try:
+            self._leader = cc.status.leader() or ''
+        except Exception:
+            # No consul agent to talk to
+            self._leader = ''
+        self._members = None
+        self._critical_nodes = None
+        self._prefixes = {}
+        self._indexes = {}
+        self._values = {}
+        self._host_ids = None
+
+    @property
+    def leader(self):
+        return self._leader
+
+    @property
+    def alive(self):
+        # KV store is not available when quorum is lost
+        return self._leader != ''
+
+    @property
+    def members(self):
+        if self._members is None:
+            self._members = tuple(self._cc.agent.members())
+        return self._members
+
+    @property
+    def member_addrs(self):
+        return frozenset(m['Addr'] for m in self.members)
+
+    @property
+    def critical_nodes(self):
+        """
+        Names of the members whose serf health check is critical
+        """
+        if self._critical_nodes is None:
+            _, checks = self._cc.health.state('critical')
+            self._critical_nodes = frozenset(
+                check['Node'] for check in checks or []
+                if check.get('CheckID') == 'serfHealth')
+        return self._critical_nodes
+
+    def get_prefix(self, prefix):
+        """
+        Key to value mapping of the keys under prefix, read with one
+        recursive query. Empty when the cluster is not available.
+        """
+        if prefix not in self._prefixes:
+            kv = {}
+            index = None
+            modify_indexes = {}
+            if self.alive:
+                index, kv_list = self._cc.kv.get(prefix, recurse=True)
+                kv = dict((entry['Key'], entry['Value'])
+                          for entry in kv_list or [])
+                modify_indexes = dict((entry['Key'], entry['ModifyIndex'])
+                                      for entry in kv_list or [])
+            self._prefixes[prefix] = kv
+            # python-consul gives the X-Consul-Index header as a string
+            self._indexes[prefix] = (int(index) if index else None,
+                                     modify_indexes)
+        return self._prefixes[prefix]
+
+    def get_prefix_indexes(self, prefix):
+        """
+        Consul index of the read of the keys under prefix, and the
+        ModifyIndex of each of those keys
+        """
+        self.get_prefix(prefix)
+        return self._indexes[prefix]
+
+    @property
+    def host_ids(self):
+        """
+        The <ip>:<port> to host ID mappings published by the members
+        """
+        if self._host_ids is None:
+            index, _ = self.get_prefix_indexes(HOSTID_PREFIX)
+            cache = self._host_id_cache
+            if cache is not None and index is not None and \
+                    cache.get('index') == index:
+                self._host_ids = cache['host_ids']
+            else:
+                self._host_ids = dict(
+                    (key[len(HOSTID_PREFIX):], value)
+                    for key, value in self.get_prefix(HOSTID_PREFIX).items()
+                    if valid_cluster_port(key[len(HOSTID_PREFIX):]))
+                if cache is not None:
+                    cache.update(index=index, host_ids=self._host_ids)
+        return self._host_ids
+
+    def get_host_id(self, cluster_port):
+        """
+        Host ID published for cluster_port, without reading all of them
+        unless they have been read already
+        """
+        if self._host_ids is not None:
+            return self._host_ids.get(cluster_port)
+        return self.get_value(HOSTID_PREFIX + cluster_port)
+
+    def get_value(self, key):
+        """
+        Value of a single key. Answered from a prefix that has been read
+        already if it covers the key, otherwise only that key is fetched.
+        """
+        for prefix, kv in self._prefixes.items():
+            if key.startswith(prefix):
+                return kv.get(key)
+        if key not in self._values:
+            data = None
+            if self.alive:
+                _, data = self._cc.kv.get(key)
+            self._values[key] = data['Value'] if data else None
+        return self._values[key]
+
+
+class TxnUnsupported(Exception):
+    """
+    Consul does not have the /v1/txn endpoint
+    """
+    pass
+
+
+class KVWriteBuffer(object):
+    """
+    Gathers the KV writes and deletes of one manager iteration and commits
+    them with as few /v1/txn calls as possible. A write with cas=0 only
+    creates the key, a write with a non-zero cas only succeeds if the key
+    was not modified since that index. A failed check only drops the
+    operation that failed, the other operations are committed.
+    """
+    def __init__(self, cc):
+        self._cc = cc
+        self._ops = []
+        self._pending = {}
+        self.txn_supported = True
+
+    def __len__(self):
+        return len(self._ops)
+
+    def set(self, key, value, cas=None):
+        if key in self._pending:
+            # Overwrite the pending value, keeping the original check
+            self._pending[key]['Value'] = value
+            return
+        op = {'Verb': 'set', 'Key': key, 'Value': value}
+        if cas is not None:
+            op['Verb'] = 'cas'
+            op['Index'] = cas
+        self._ops.append(op)
+        self._pending[key] = op
+
+    def delete(self, key):
+        self._pending.pop(key, None)
+        self._ops = [op for op in self._ops if op['Key'] != key]
+        self._ops.append({'Verb': 'delete', 'Key': key})
+
+    def get_pending(self, key):
+        """
+        Value that will be written to key on commit, None if there is none
+        """
+        op = self._pending.get(key)
+        return op['Value'] if op else None
+
+    def _encode(self, op):
+        op = dict(op)
+        if 'Value' in op:
+            op['Value'] = base64.b64encode(op['Value'])
+        return {'KV': op}
+
+    def _txn(self, ops):
+        """
+        Run ops in one transaction. Returns the indexes of the operations
+        that failed, in which case nothing was committed.
+        """
+        response = self._cc.http.put(
+            lambda response: response, '/v1/txn',
+            data=json.dumps([self._encode(op) for op in ops]))
+        if response.code == 200:
+            return []
+        if response.code == 409:
+            errors = json.loads(response.body).get('Errors') or []
+            return [error['OpIndex'] for error in errors]
+        if response.code in (400, 404, 405):
+            # Consul older than 0.7 does not have transactions
+            raise TxnUnsupported()
+        raise consul.ConsulException('%d %s' % (response.code, response.body))
+
+    def _apply(self, op):
+        if op['Verb'] == 'delete':
+            return self._cc.kv.delete(op['Key'])
+        return self._cc.kv.put(op['Key'], op['Value'], cas=op.get('Index'))
+
+    def _commit_txn(self, chunk):
+        """
+        Commit chunk in one transaction. Returns the number of operations
+        that were dropped because their check failed.
+        """
+        failed = self._txn(chunk)
+        if not failed:
+            return 0
+        # The transaction was rolled back, run it again without the
+        # operations whose check failed
+        dropped = len(failed)
+        chunk = [op for i, op in enumerate(chunk) if i not in failed]
+        if chunk and self._txn(chunk):
+            LOG.warn('KV transaction failed twice, dropping %d operations',
+                     len(chunk))
+            dropped += len(chunk)
+        return dropped
+
+    def _restore(self, ops):
+        # Only called while the buffer is empty
+        self._ops = ops
+        self._pending = dict((op['Key'], op) for op in ops
+                             if op['Verb'] != 'delete')
+
+    def commit(self):
+        """
+        Commit the buffered operations. Returns the number of operations
+        that were dropped because their check failed. If consul fails, the
+        operations that were not committed are kept for the next commit and
+        the error is raised.
+        """
+        ops, self._ops, self._pending = self._ops, [], {}
+        dropped = 0
+        sent = 0
+        try:
+            while sent < len(ops):
+                chunk = ops[sent:sent + TXN_MAX_OPS]
+                if self.txn_supported:
+                    try:
+                        dropped += self._commit_txn(chunk)
+                        sent += len(chunk)
+                        continue
+                    except TxnUnsupported:
+                        LOG.info('Consul does not support transactions, '
+                                 'writing KV keys one at a time')
+                        self.txn_supported = False
+                for op in chunk:
+                    if self._apply(op) is False:
+                        dropped += 1
+                    sent += 1
+        except Exception:
+            self._restore(ops[sent:])
+            raise
+        if dropped:
+            LOG.info('%d KV operations were dropped as their key changed',
+                     dropped)
+        return dropped
+
+
 class cluster:
+    """
+    A member status change. change_time is in seconds since the epoch.
+    """
     change_time = None
     change_info = {}
     def __init__(self, time, info):
         self.change_info = info
         self.change_time = time
 
+    @property
+    def key(self):
+        return (self.change_info['hostname'], self.change_info['eventType'])
+
     def __eq__(self, other):
         if not isinstance(other, cluster):
             return False
@@ -107,8 +475,8 @@ class cluster:
 
     def __repr__(self):
         jobj = {
-            'change_time': datetime.strftime(self.change_time,
-                                             "%Y-%m-%d %H:%M:%S"),
+            'change_time': datetime.strftime(
+                datetime.fromtimestamp(self.change_time), "%Y-%m-%d %H:%M:%S"),
             'change_info': json.dumps(self.change_info)
         }
         return json.dumps(jobj)
@@ -118,7 +486,151 @@ class cluster:
         obj = json.loads(string)
         change_time = datetime.strptime(obj['change_time'], "%Y-%m-%d %H:%M:%S")
         change_info = json.loads(obj['change_info'])
-        return cls(change_time, change_info)
+        return cls(_to_epoch(change_time), change_info)
+
+
+class PendingChanges(object):
+    """
+    Status changes waiting to be reported, keyed by (hostname, eventType)
+    and kept in the order they were seen. As changes are added with the
+    current time the oldest ones are always at the front.
+    """
+    def __init__(self):
+        self._changes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._changes)
+
+    def __iter__(self):
+        return iter(self._changes.values())
+
+    def __contains__(self, cls):
+        return cls.key in self._changes
+
+    def add(self, cls):
+        """
+        Add a change unless one for the same host and event is pending.
+        Returns True if it was added.
+        """
+        if cls.key in self._changes:
+            return False
+        self._changes[cls.key] = cls
+        return True
+
+    def remove(self, cls):
+        self._changes.pop(cls.key, None)
+
+    def merge(self, clss):
+        """
+        Add changes that may be older than the pending ones, keeping the
+        order by the time they were seen. Returns the changes added.
+        """
+        added = [cls for cls in clss if cls.key not in self._changes]
+        if added:
+            changes = sorted(self._changes.values() + added,
+                             key=lambda cls: cls.change_time)
+            self._changes = collections.OrderedDict(
+                (cls.key, cls) for cls in changes)
+        return added
+
+    def clear(self):
+        self._changes.clear()
+
+    def oldest(self):
+        for cls in self._changes.itervalues():
+            return cls
+        return None
+
+    def older_than(self, cutoff):
+        """
+        Changes seen before cutoff, in seconds since the epoch. Only those
+        changes and the first newer one are looked at.
+        """
+        older = []
+        for cls in self._changes.itervalues():
+            if cls.change_time >= cutoff:
+                break
+            older.append(cls)
+        return older
+
+
+def member_report(member, cluster_id, timestamp):
+    """
+    Status report of a consul member whose host ID is cluster_id
+    """
+    if member.get('Status', 4) == 1:
+        # Node alive
+        event_type = 1
+        detail = 1
+        event_id = 1
+        start_time = timestamp
+        end_time = ""
+    else:
+        # Node failed
+        event_type = 2
+        detail = 2
+        event_id = 1
+        start_time = end_time = timestamp
+    return {
+        'eventType': event_type,
+        'cluster_port': "%s:%s" % (member.get('Addr'), member.get('Port')),
+        'startTime': start_time,
+        'endTime': end_time,
+        'hostname': cluster_id,
+        'uuid': cluster_id,
+        'eventID': event_id,
+        'detail': detail,
+        'id': str(uuid4())
+    }
+
+
+def confirm_voters(addr, alive_addrs, count):
+    """
+    The count addresses that follow addr in the sorted alive_addrs, wrapping
+    around. Every node picks the same voters from the same member list.
+    """
+    alive_addrs = sorted(a for a in alive_addrs if a != addr)
+    start = bisect.bisect(alive_addrs, addr)
+    ring = alive_addrs[start:] + alive_addrs[:start]
+    return ring[:count]
+
+
+def _to_epoch(dt):
+    return mktime(dt.timetuple()) if dt else None
+
+
+def make_report_record(cls, notice_time=None, report_time=None,
+                       report_id=None):
+    """
+    Record kept under REPORT_PREFIX for a status change until it has been
+    reported and reaped. Times are seconds since the epoch.
+    """
+    return {
+        'version': REPORT_RECORD_VERSION,
+        'change_time': cls.change_time,
+        'change_info': cls.change_info,
+        'notice_time': notice_time or time(),
+        'report_time': report_time,
+        'id': report_id
+    }
+
+
+def parse_report_record(value):
+    """
+    Parse a report record, converting the legacy format if needed. The
+    legacy record is JSON with the string form of the cluster object in
+    node_info and formatted local times.
+    """
+    record = json.loads(value)
+    if record.get('version') == REPORT_RECORD_VERSION:
+        return record
+    cls = cluster.from_str(record['node_info'])
+    legacy_time = lambda t: _to_epoch(
+        datetime.strptime(t, '%Y-%m-%d %H:%M:%S')) if t else None
+    return make_report_record(cls,
+                              notice_time=legacy_time(record['notice_time']),
+                              report_time=legacy_time(record['report_time']),
+                              report_id=record['id'])
 
 
 class consul_status:
@@ -129,113 +641,322 @@ class consul_status:
     cc = None
     dirty = False
     host_id = None
-    changed_clusters = []
     leader = False
 
     def __init__(self, host_id):
+        self.changed_clusters = PendingChanges()
+        self._health_index = None
+        self._last_cleanup = None
+        self._legacy_checked_at = None
+        self._unmapped_members = False
+        self._hostid_published_at = None
+        self._baseline_at = None
+        self._baseline_by_name = {}
+        self._baseline_by_addr = {}
+        self._baseline_unseen = set()
+        self._takeover = 0
+        self._reconcile_lock = threading.Lock()
+        self._reconciled = None
+        self._votes = {}
+        self._host_id_cache = {}
+        self._vote_index = None
+        self._vote_writes = {}
         if not exists(dirname(LAST_STATUS_UPDATE_FILE)):
             makedirs(dirname(LAST_STATUS_UPDATE_FILE))
-        if exists(LAST_STATUS_UPDATE_FILE):
+        self._load_status()
+        self.cc = get_consul_client()
+        self.kv_buffer = KVWriteBuffer(self.cc)
+        self.host_id = host_id
+        reap_interval = CONF.consul.key_reap_interval
+        self.reap_interval = timedelta(minutes=reap_interval)
+        self.publish_hostid()
+        self.commit_kv()
+
+    def _load_status(self):
+        """
+        Load the last known status of the members. A file that cannot be
+        parsed, e.g. one cut short by a crash, is ignored and the status is
+        rebuilt from consul.
+        """
+        self.last_status = {}
+        self.current_status = {}
+        if not exists(LAST_STATUS_UPDATE_FILE):
+            return
+        try:
             with open(LAST_STATUS_UPDATE_FILE) as fptr:
                 last_update_json = json.load(fptr)
-                self.last_status = last_update_json.get('status', {})
+            version = last_update_json.get('version')
+            if version == STATUS_FILE_VERSION:
+                self.last_status = dict(
+                    (addr, {'eventType': event_type}) for addr, event_type in
+                    last_update_json['status'].items())
+                if last_update_json.get('time'):
+                    self.last_status_update_time = datetime.fromtimestamp(
+                        last_update_json['time'])
+            elif version is None:
+                self.last_status = last_update_json.get('status') or {}
                 last_update_time = last_update_json.get('time')
-                self.current_status = last_update_json.get('current_status')
                 if last_update_time and last_update_time != 'None':
                     self.last_status_update_time = datetime.strptime(
                             last_update_time, "%Y-%m-%d %H:%M:%S")
-        self.cc = consul.Consul()
-        self.host_id = host_id
-        reap_interval = CONF.consul.key_reap_interval
-        self.reap_interval = timedelta(minutes=reap_interval)
-        self.publish_hostid()
+            else:
+                LOG.warn('Ignoring status cache file of unknown version %s',
+                         version)
+        except (IOError, ValueError, KeyError, AttributeError):
+            LOG.warn('Ignoring unreadable status cache file %s',
+                     LAST_STATUS_UPDATE_FILE, exc_info=True)
 
-    def publish_hostid(self):
+    def _save_status(self):
+        """
+        Write the last known status of the members if it changed. The file
+        is replaced in one rename so that a crash never leaves it half
+        written.
+        """
+        if not self.dirty:
+            return
+        data = {
+            'version': STATUS_FILE_VERSION,
+            'time': _to_epoch(self.last_status_update_time),
+            'status': dict((addr, status.get('eventType'))
+                           for addr, status in self.last_status.items())
+        }
+        tmp_file = LAST_STATUS_UPDATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as fptr:
+            json.dump(data, fptr, separators=(',', ':'))
+            if CONF.consul.last_update_fsync:
+                fptr.flush()
+                fsync(fptr.fileno())
+        rename(tmp_file, LAST_STATUS_UPDATE_FILE)
+        self.dirty = False
+
+    def snapshot(self):
+        return ConsulSnapshot(self.cc, self._host_id_cache)
+
+    def commit_kv(self):
+        """
+        Commit the KV writes buffered since the last commit
+        """
+        if len(self.kv_buffer):
+            try:
+                self.kv_buffer.commit()
+            except Exception:
+                LOG.exception('Could not commit KV writes')
+
+    def publish_hostid(self, snapshot=None):
         '''
         This function updates the KV store with the <ip_addres>:8301=<host ID>.
-        If such a key already exists with the same value then it is not updated
+        If such a key already exists with the same value then it is not updated.
+        Once published the key is only checked again every cleanup_interval
+        seconds, or on every iteration by the leader which reads all the
+        host IDs anyway.
         '''
-        key = '%s:%s' % (get_ip_address(), '8301')
-        if self.cluster_alive():
-            # KV store is not available when quorum is lost
-            _, data = self.cc.kv.get(key)
-            if not data:
-                LOG.info('Adding {key}={id}'.format(key=key, id=self.host_id))
-                self.cc.kv.put(key, self.host_id)
+        snapshot = snapshot or self.snapshot()
+        key = '%s%s:%s' % (HOSTID_PREFIX, get_ip_address(), '8301')
+        if snapshot.alive:
+            recheck = timedelta(seconds=CONF.consul.cleanup_interval)
+            if not self.leader and self._hostid_published_at and \
+                    datetime.now() - self._hostid_published_at < recheck:
+                return
+            value = snapshot.get_value(key)
+            if not value:
+                LOG.info('Adding %s=%s', key, self.host_id)
+                self.kv_buffer.set(key, self.host_id)
+            elif value != self.host_id:
+                LOG.info('Updating %s to %s', key, self.host_id)
+                self.kv_buffer.set(key, self.host_id)
             else:
-                if data['Value'] != self.host_id:
-                    LOG.info('Updating {key} to {id}'.format(
-                        key=key, id=self.host_id))
-                    self.cc.kv.put(key, self.host_id)
+                # Only once the key is seen in consul, so that a write lost
+                # with a failed commit is made again on the next iteration
+                self._hostid_published_at = datetime.now()
         else:
-            LOG.warn('Not adding {id} to KV since cluster is '
-                     'unavailable'.format(id=self.host_id))
+            LOG.warn('Not adding %s to KV since cluster is unavailable',
+                     self.host_id)
+
+    def _set_baseline(self, members):
+        self._baseline_at = time()
+        self._baseline_by_name = dict((m['Name'], m) for m in members)
+        self._baseline_by_addr = dict((m['Addr'], m) for m in members)
+        self._baseline_unseen = set(self._baseline_by_addr) - \
+            set(self.last_status)
+
+    def _baseline_due(self):
+        return self._baseline_at is None or \
+            time() - self._baseline_at >= CONF.consul.member_refresh_interval
 
-    def _get_cluster_status(self, current_time=datetime.now()):
+    def _failing_members(self, snapshot):
+        """
+        Members with a critical serf health check, plus the members that
+        were failing at the last check or have a pending change so that
+        their recovery is seen and the members of the baseline whose status
+        has not been recorded yet. Returns None if a failing member is not
+        in the baseline, e.g. one that joined after it was read.
+        """
+        members = {}
+        for name in snapshot.critical_nodes:
+            if name not in self._baseline_by_name:
+                return None
+            members[name] = dict(self._baseline_by_name[name], Status=4)
+        addrs = set(addr for addr, status in self.current_status.items()
+                    if status['eventType'] == 2)
+        addrs.update(cls.change_info['cluster_port'].split(':')[0]
+                     for cls in self.changed_clusters)
+        self._baseline_unseen = set(addr for addr in self._baseline_unseen
+                                    if addr not in self.last_status)
+        addrs.update(self._baseline_unseen)
+        for addr in addrs:
+            member = self._baseline_by_addr.get(addr)
+            if not member or member['Name'] in members:
+                continue
+            # Members that left the cluster have no health check, they are
+            # only seen again when the baseline is refreshed
+            status = member.get('Status')
+            members[member['Name']] = dict(
+                member, Status=status if status in (2, 3) else 1)
+        return members.values()
+
+    def _get_cluster_status(self, snapshot, current_time=None):
+        current_time = current_time or datetime.now()
         cluster_report = {}
-        for member in self.cc.agent.members():
-            if member.get('Status', 4) == 1:
-                # Node alive
-                event_type = 1
-                detail = 1
-                event_id = 1
-                start_time = datetime.strftime(current_time, '%Y-%m-%d %H:%M:%S')
-                end_time = ""
-            else:
-                # Node failed
-                event_type = 2
-                detail = 2
-                event_id = 1
-                start_time = end_time = datetime.strftime(current_time,
-                                                          '%Y-%m-%d %H:%M:%S')
+        members = None
+        if CONF.consul.failing_only and not self._baseline_due():
+            members = self._failing_members(snapshot)
+            get_host_id = snapshot.get_host_id
+        if members is None:
+            members = snapshot.members
+            get_host_id = snapshot.host_ids.get
+            if CONF.consul.failing_only:
+                self._set_baseline(members)
+        timestamp = datetime.strftime(current_time, '%Y-%m-%d %H:%M:%S')
+        self._unmapped_members = False
+        for member in members:
             cluster_port = "%s:%s" % (member.get('Addr'), member.get('Port'))
 
-            ignore, data = self.cc.kv.get(cluster_port)
-            if not data:
+            cluster_id = get_host_id(cluster_port)
+            if not cluster_id:
                 # Cannot get the host id, which means that ha-slave is not
                 # running. We cannot be sure of the cluster state and reporting
                 # without the host id does not work hence skip this host.
+                self._unmapped_members = True
                 continue
-            cluster_id = data['Value']
-
-            cluster_report[member['Addr']] = {
-                'eventType': event_type,
-                'cluster_port': "%s:%s" % (member.get('Addr'), member.get('Port')),
-                'startTime': start_time,
-                'endTime': end_time,
-                'hostname': cluster_id,
-                'uuid': cluster_id,
-                'eventID': event_id,
-                'detail': detail,
-                'id': str(uuid4())
-            }
+
+            cluster_report[member['Addr']] = member_report(member, cluster_id,
+                                                           timestamp)
         return cluster_report
 
-    def _should_report_change(self):
-        report_interval = timedelta(seconds=CONF.consul.report_interval)
-        retval = None
-        reported_cls = None
-        for cluster in self.changed_clusters:
+    def _should_report_change(self, snapshot, current_state):
+        """
+        Return the changes that have lasted for report_interval and have not
+        been reported yet. Each one is recorded in the KV store so that it
+        can be tracked until it is reported.
+        """
+        now = time()
+        cutoff = now - CONF.consul.report_interval
+        changes = []
+        confirmed = self._confirmed_failures(snapshot, now)
+        for cluster in self.changed_clusters.older_than(cutoff) + confirmed:
             LOG.debug('Checking %s status before reporting',
                     cluster.change_info['cluster_port'])
-            if datetime.now() - cluster.change_time > report_interval:
-                current_state = self._get_cluster_status()
-                addr = cluster.change_info['cluster_port'].split(':')[0]
-                if addr in current_state and current_state[addr]['eventType'] \
-                        == cluster.change_info['eventType']:
-                    reported_cls = cluster
-                    retval = cluster.change_info
-                    break
-        if reported_cls:
-            ignore, data = self.cc.kv.get(retval['hostname'])
-            if not data:
-                self.report_node_down_to_kv(retval['hostname'], str(reported_cls))
+            addr = cluster.change_info['cluster_port'].split(':')[0]
+            if addr not in current_state or current_state[addr]['eventType'] \
+                    != cluster.change_info['eventType']:
+                continue
+            hostid = cluster.change_info['hostname']
+            value = snapshot.get_value(REPORT_PREFIX + hostid)
+            if not value:
+                self.report_node_down_to_kv(hostid, cluster)
+            elif parse_report_record(value).get('id'):
+                # Already reported once
+                self.changed_clusters.remove(cluster)
+                continue
+            changes.append(cluster.change_info)
+        return changes
+
+    def _confirmed_failures(self, snapshot, now):
+        """
+        Failures that have lasted for confirm_interval but not yet for
+        report_interval and that peer_quorum peers have voted for. Votes
+        written long before the failure was seen by this node are left out,
+        see _read_votes for how they are timed.
+        """
+        if not CONF.consul.confirm_failures:
+            return []
+        # Read on every iteration so that new votes are timed as they come
+        votes = {}
+        for key, written_at in self._read_votes(snapshot, now).items():
+            if written_at is not None:
+                hostid = key[len(VOTE_PREFIX):].split('/')[0]
+                votes.setdefault(hostid, []).append(written_at)
+        candidates = [
+            cls for cls in self.changed_clusters.older_than(
+                now - CONF.consul.confirm_interval)
+            if cls.change_info['eventType'] == 2 and
+            cls.change_time >= now - CONF.consul.report_interval]
+        if not candidates:
+            return []
+        confirmed = []
+        for cls in candidates:
+            since = cls.change_time - CONF.consul.confirm_interval
+            count = len([t for t in votes.get(cls.change_info['hostname'], [])
+                         if t >= since])
+            if count >= CONF.consul.peer_quorum:
+                LOG.info('Failure of %s confirmed by %d peers',
+                         cls.change_info['cluster_port'], count)
+                confirmed.append(cls)
+        return confirmed
+
+    def _read_votes(self, snapshot, now):
+        """
+        Map the vote keys to the time they were written, on the clock of
+        this node as the clocks of the voters may differ from it. A vote
+        whose consul ModifyIndex is above the index of the previous read was
+        written since that read. Votes already there at the first read after
+        becoming the leader have no known time.
+        """
+        index, modify_indexes = snapshot.get_prefix_indexes(VOTE_PREFIX)
+        writes = {}
+        for key, modify_index in modify_indexes.items():
+            seen = self._vote_writes.get(key)
+            if seen and seen[0] == modify_index:
+                writes[key] = seen
+            elif self._vote_index is not None and \
+                    modify_index > self._vote_index:
+                writes[key] = (modify_index, now)
             else:
-                data_obj = json.loads(data['Value'])
-                if data_obj.get('id'):
-                    # Already reported once
-                    retval = None
-        return retval
+                writes[key] = (modify_index, None)
+        self._vote_index = index
+        self._vote_writes = writes
+        return dict((key, seen[1]) for key, seen in writes.items())
+
+    def vote_failures(self, snapshot):
+        """
+        Vote for the failure of the members that the local consul agent sees
+        as failed and that this node is one of the confirm_voters of. The
+        vote is withdrawn once the member is no longer seen as failed.
+        """
+        if not CONF.consul.confirm_failures or not snapshot.alive:
+            return
+        leader_ip = snapshot.leader.split(':')[0]
+        alive_addrs = [m['Addr'] for m in snapshot.members
+                       if m.get('Status') == 1 and m['Addr'] != leader_ip]
+        my_ip = get_ip_address()
+        failed = {}
+        for member in snapshot.members:
+            if member.get('Status') != 4:
+                continue
+            hostid = snapshot.get_host_id(
+                "%s:%s" % (member.get('Addr'), member.get('Port')))
+            if hostid:
+                failed[hostid] = member['Addr']
+        for hostid in set(self._votes) - set(failed):
+            self.delete_from_kv(self._votes.pop(hostid))
+        for hostid, addr in failed.items():
+            if hostid in self._votes or my_ip not in confirm_voters(
+                    addr, alive_addrs, CONF.consul.confirm_voters):
+                continue
+            key = '%s%s/%s' % (VOTE_PREFIX, hostid, self.host_id)
+            LOG.info('Voting for the failure of %s', addr)
+            self.kv_buffer.set(key, json.dumps({'time': time()}))
+            self._votes[hostid] = key
 
     def update(self, current_status):
         for key, value in current_status.items():
@@ -243,51 +964,53 @@ class consul_status:
                 # New node was added
                 self.last_status[key] = current_status[key]
                 LOG.info('New node added %s', key)
+                self.dirty = True
             elif value.get('eventType') != \
                     self.last_status[key].get('eventType'):
-                LOG.info('Status of {node} changed from {old} to {new}'.format(
-                    node=key, old=self.last_status[key].get('eventType'),
-                    new=value.get('eventType')))
+                LOG.info('Status of %s changed from %s to %s', key,
+                         self.last_status[key].get('eventType'),
+                         value.get('eventType'))
                 # Status of a node has changed
-                cls_obj = cluster(datetime.now(), current_status[key])
-                if cls_obj not in self.changed_clusters:
-                    self.changed_clusters.append(cls_obj)
-                self.dirty = True
+                self.changed_clusters.add(cluster(time(), current_status[key]))
         self.current_status = current_status
-        with open(LAST_STATUS_UPDATE_FILE, 'w') as fptr:
-            fptr.truncate()
-            json.dump({
-                'status': self.last_status,
-                'time': datetime.strftime(self.last_status_update_time,
-                                          '%Y-%m-%d %H:%M:%S'),
-                'current_status': self.current_status
-            }, fptr)
-
-    def get_cluster_status(self):
-        """
-        This function will return a update the status file when called. If
-        cluster status remains changed for x minutes then the changed status
-        will be reported back else the older status is returned.
+
+    def get_cluster_status(self, snapshot=None):
+        """
+        This function will return a update the status file when called. All
+        the cluster status changes that remained for x minutes are returned
+        so that they can be reported together, the list is empty if there
+        are none.
         x is fetched from the conf option - CONF.consul.report_interval and
         it defaults to 6 minutes.
         """
-        result = {}
+        snapshot = snapshot or self.snapshot()
+        self._merge_reconciled()
         current_time = datetime.now()
-        report_change = self._should_report_change()
-        current_status = self._get_cluster_status(current_time)
+        current_status = self._get_cluster_status(snapshot, current_time)
+        report_changes = self._should_report_change(snapshot, current_status)
         self.last_status_update_time = current_time
         self.update(current_status)
-        if report_change:
-            self.last_status = self.current_status
-            return report_change
-        return None
+        for change in report_changes:
+            addr = change['cluster_port'].split(':')[0]
+            self.last_status[addr] = current_status[addr]
+            self.dirty = True
+        self._save_status()
+        if self._unmapped_members and time() - (self._legacy_checked_at or 0) \
+                >= LEGACY_CHECK_INTERVAL:
+            # The host IDs may have been published by agents that are not
+            # upgraded yet
+            try:
+                self.migrate_legacy_keys()
+            except Exception:
+                LOG.exception('Could not migrate legacy KV keys')
+        return report_changes
 
-    def am_i_cluster_leader(self):
-        if not self.cluster_alive():
+    def am_i_cluster_leader(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        if not snapshot.alive:
             # There is no cluster so no leader
             return False
-        cluster_leader = self.cc.status.leader()
-        leader_ip = cluster_leader.split(':')[0]
+        leader_ip = snapshot.leader.split(':')[0]
         my_ip = get_ip_address()
         am_i_leader = my_ip == leader_ip
 
@@ -295,41 +1018,179 @@ class consul_status:
         if am_i_leader != self.leader:
             self.leader = am_i_leader
             if am_i_leader:
-                # Node just became the leader
-                self.populate_cache_from_consul()
+                # Node just became the leader, the KV store is scanned for
+                # stale entries on this iteration
+                self._last_cleanup = None
+                self._vote_index = None
+                self._vote_writes = {}
+                try:
+                    self.migrate_legacy_keys()
+                except Exception:
+                    LOG.exception('Could not migrate legacy KV keys')
+                self.populate_cache_from_consul(snapshot)
             else:
                 # Node gave up leadership
-                # Clear the changed_clusters array so that there is nothing
-                # to report
-                self.changed_clusters = []
+                # Clear the changed_clusters so that there is nothing to
+                # report
+                self.changed_clusters.clear()
         return am_i_leader
 
-    def populate_cache_from_consul(self):
-        _, kv_list = self.cc.kv.get('', recurse=True)
-        self.changed_clusters = []
-        if kv_list is None:
-            kv_list = []
-        for kv in kv_list:
-            key = kv['Key']
-            value = kv['Value']
-            if UUID_PATTERN.match(key):
-                obj = json.loads(value)
-                cls = cluster.from_str(obj['node_info'])
-                self.changed_clusters.append(cls)
-        # If the leader node goes down, then host down event is not
-        # recorded in KV store. It is possible that leader was not able to
-        # record some other failed nodes in KV store. Check the current status
-        # and add any failed nodes in the changed_status array that are not
-        # present in it already. Addresses bug: IAAS-7044
-        current_status = self._get_cluster_status()
-        for addr, data in current_status.items():
-            if data['eventType'] == 2:
-                # Failed node
-                cls_obj = cluster(datetime.now(), data)
-                if cls_obj not in self.changed_clusters:
-                    LOG.info('Found a failed node {node} that was not in '
-                             'KV'.format(node=addr))
-                    self.changed_clusters.append(cls_obj)
+    def migrate_legacy_keys(self):
+        """
+        Move the host ID and report keys written at the KV root by older
+        agents under their prefixes. Only the names of the root keys are
+        listed to find them. Agents that are not upgraded yet keep writing
+        there, so this is done on every takeover and cleanup pass and when
+        members without a host ID are seen. Report records that cannot be
+        parsed are left where they are.
+        """
+        self._legacy_checked_at = time()
+        pending = []
+        _, keys = self.cc.kv.get('', keys=True, separator='/')
+        for key in keys or []:
+            if valid_cluster_port(key):
+                new_key = HOSTID_PREFIX + key
+            elif UUID_PATTERN.match(key):
+                new_key = REPORT_PREFIX + key
+            else:
+                continue
+            _, data = self.cc.kv.get(key)
+            if data:
+                value = data['Value']
+                if new_key.startswith(REPORT_PREFIX):
+                    try:
+                        record = parse_report_record(value)
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        LOG.warn('Not migrating malformed legacy report '
+                                 'record %s', key, exc_info=True)
+                        continue
+                    value = json.dumps(record)
+                    if not record['id']:
+                        # Not reported by the leader that recorded it
+                        self.cc.kv.put(PENDING_PREFIX + key, value, cas=0)
+                        pending.append(cluster(record['change_time'],
+                                               record['change_info']))
+                # Do not overwrite a key already written in the new layout
+                self.cc.kv.put(new_key, value, cas=0)
+            self.cc.kv.delete(key)
+            LOG.info('Migrated legacy KV key %s to %s', key, new_key)
+        if self.leader:
+            self.changed_clusters.merge(pending)
+
+    def populate_cache_from_consul(self, snapshot):
+        """
+        Rebuild the pending changes when this node becomes the leader. Only
+        the pending report records are read so that the changes can be
+        reported right away, the other records and the members are checked
+        by _reconcile in the background.
+        """
+        self.changed_clusters.clear()
+        records = [parse_report_record(value) for value in
+                   snapshot.get_prefix(PENDING_PREFIX).values()]
+        # Keep the pending changes ordered by the time they were seen
+        for record in sorted(records, key=lambda r: r['change_time']):
+            self.changed_clusters.add(cluster(record['change_time'],
+                                              record['change_info']))
+        self._takeover += 1
+        reconciler = threading.Thread(target=self._reconcile,
+                                      args=(self._takeover,),
+                                      name='takeover-reconcile')
+        reconciler.daemon = True
+        reconciler.start()
+
+    def _reconcile(self, takeover):
+        """
+        Find the changes a new leader has to track that are not in the
+        pending records: report records without a pending copy, e.g. ones
+        written by older agents, and failed nodes that were never recorded
+        in KV because the previous leader went down. Addresses bug:
+        IAAS-7044
+        """
+        try:
+            # The HTTP session of self.cc is not shared with this thread
+            snapshot = ConsulSnapshot(get_consul_client())
+            reports = snapshot.get_prefix(REPORT_PREFIX)
+            pending = snapshot.get_prefix(PENDING_PREFIX)
+            unindexed = {}
+            for key, value in reports.items():
+                hostid = key[len(REPORT_PREFIX):]
+                record = parse_report_record(value)
+                if not record['id'] and PENDING_PREFIX + hostid not in pending:
+                    unindexed[hostid] = record
+            failed = []
+            timestamp = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+            host_ids = snapshot.host_ids
+            for member in snapshot.members:
+                if member.get('Status', 4) == 1:
+                    continue
+                cluster_id = host_ids.get(
+                    "%s:%s" % (member.get('Addr'), member.get('Port')))
+                if cluster_id and REPORT_PREFIX + cluster_id not in reports:
+                    failed.append(member_report(member, cluster_id, timestamp))
+        except Exception:
+            LOG.exception('Could not reconcile the pending status changes')
+            return
+        with self._reconcile_lock:
+            self._reconciled = (takeover, unindexed, failed)
+
+    def _merge_reconciled(self):
+        """
+        Add the changes found by _reconcile to the pending ones
+        """
+        with self._reconcile_lock:
+            reconciled, self._reconciled = self._reconciled, None
+        if not reconciled:
+            return
+        takeover, unindexed, failed = reconciled
+        if takeover != self._takeover or not self.leader:
+            # Leadership changed meanwhile
+            return
+        for hostid, record in unindexed.items():
+            self.kv_buffer.set(PENDING_PREFIX + hostid, json.dumps(record))
+        clss = [cluster(record['change_time'], record['change_info'])
+                for record in unindexed.values()]
+        clss.extend(cluster(time(), data) for data in failed)
+        for cls in self.changed_clusters.merge(clss):
+            LOG.info('Found a pending change of {node} that was not in the '
+                     'pending records'.format(
+                         node=cls.change_info['cluster_port']))
+
+    def wait_for_change(self, timeout):
+        """
+        Block until the health checks of the cluster change or until timeout
+        seconds have passed, using a consul blocking query. Members joining,
+        leaving or failing all change their serfHealth check, so this covers
+        catalog membership changes as well.
+        Returns True if a change was seen.
+        """
+        # Any health check change moves the index, asking for the critical
+        # ones only keeps the responses small as every node waits on it
+        try:
+            if self._health_index is None:
+                self._health_index, _ = self.cc.health.state('critical')
+            index, _ = self.cc.health.state(
+                'critical', index=self._health_index,
+                wait='%ds' % max(int(timeout), 1))
+        except Exception:
+            LOG.warn('Blocking query on consul health failed', exc_info=True)
+            self._health_index = None
+            sleep(timeout)
+            return False
+        changed = index != self._health_index
+        # The index can go backwards e.g. when the consul servers are rebuilt
+        self._health_index = index
+        return changed
+
+    def seconds_until_next_report(self, default):
+        """
+        Time until the oldest pending status change has been seen for
+        report_interval seconds and can be reported, capped to default.
+        """
+        oldest = self.changed_clusters.oldest()
+        if oldest is None:
+            return default
+        due = oldest.change_time + CONF.consul.report_interval - time()
+        return min(due, default)
 
     def cluster_alive(self):
         try:
@@ -337,66 +1198,94 @@ class consul_status:
         except:
             return False
 
-    def report_node_down_to_kv(self, hostid, node_info, report_time=None,
+    def report_node_down_to_kv(self, hostid, cls, report_time=None,
                                report_id=None):
-        data = {
-            'notice_time': datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
-            'report_time': report_time,
-            'id': report_id,
-            'node_info': node_info
-        }
-        self.cc.kv.put(hostid, json.dumps(data))
+        record = make_report_record(cls, report_time=report_time,
+                                    report_id=report_id)
+        # A record written meanwhile, e.g. by a previous leader, is kept
+        self.kv_buffer.set(REPORT_PREFIX + hostid, json.dumps(record), cas=0)
+        if not report_id:
+            self.kv_buffer.set(PENDING_PREFIX + hostid, json.dumps(record))
 
-    def update_kv(self, key, value):
-        self.cc.kv.put(key, value)
+    def update_kv(self, key, value, cas=None):
+        self.kv_buffer.set(key, value, cas=cas)
 
     def delete_from_kv(self, key):
-        try:
-            self.cc.kv.delete(key)
-        except:
-            LOG.warn('{id} tried to delete non-existent key - {key}'.format(
-                id=self.host_id, key=key))
+        self.kv_buffer.delete(key)
 
     def get_report_status(self, hostid):
-        ignore, data = self.cc.kv.get(hostid)
+        """
+        Return the report record of hostid and the index to check the record
+        against when it is updated. The index is None for a record that is
+        still buffered.
+        """
+        key = REPORT_PREFIX + hostid
+        value = self.kv_buffer.get_pending(key)
+        if value:
+            return parse_report_record(value), None
+        ignore, data = self.cc.kv.get(key)
         if data:
-            return json.loads(data['Value'])
+            return parse_report_record(data['Value']), data['ModifyIndex']
         else:
             LOG.warn('{id} tried to access report status for {host} which '
                      'did not exist'.format(id=self.host_id, host=hostid))
-            return None
+            return None, None
 
     def update_reported_status(self, cluster_status):
-        temp_cls = cluster(datetime.now(), cluster_status)
-        self.changed_clusters.remove(temp_cls)
-        old_status = self.get_report_status(cluster_status['hostname'])
+        self.changed_clusters.remove(cluster(time(), cluster_status))
+        old_status, index = self.get_report_status(cluster_status['hostname'])
         if not old_status:
             return
-        old_status['report_time'] = datetime.strftime(datetime.now(),
-                                                      '%Y-%m-%d %H:%M:%S')
+        old_status['report_time'] = time()
         old_status['id'] = cluster_status['id']
-        self.update_kv(cluster_status['hostname'], json.dumps(old_status))
-
-    def cleanup_consul_kv_store(self):
-        _, kv_list = self.cc.kv.get('', recurse=True)
-        for kv in kv_list:
-            key = kv['Key']
-            value = kv['Value']
-            if UUID_PATTERN.match(key):
-                # Dealing with a status report key-value pair
-                value = json.loads(value)
-                report_time_str = value['report_time']
-                report_uuid = value['id']
-                if not report_uuid:
-                    # This key value pair was not reported.Don't delete the key
+        self.update_kv(REPORT_PREFIX + cluster_status['hostname'],
+                       json.dumps(old_status), cas=index)
+        self.delete_from_kv(PENDING_PREFIX + cluster_status['hostname'])
+
+    def cleanup_due(self):
+        """
+        Stale entries are reaped after key_reap_interval, so the KV store is
+        only scanned for them every cleanup_interval seconds rather than on
+        every status check.
+        """
+        cleanup_interval = timedelta(seconds=CONF.consul.cleanup_interval)
+        return self._last_cleanup is None or \
+            datetime.now() - self._last_cleanup >= cleanup_interval
+
+    def cleanup_consul_kv_store(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        self._last_cleanup = datetime.now()
+        try:
+            self.migrate_legacy_keys()
+        except Exception:
+            LOG.exception('Could not migrate legacy KV keys')
+        member_addrs = snapshot.member_addrs
+        reap_before = time() - self.reap_interval.total_seconds()
+        reports = snapshot.get_prefix(REPORT_PREFIX)
+        for key, value in snapshot.get_prefix(PENDING_PREFIX).items():
+            # Pending copy of a record that was reported or reaped
+            report = reports.get(REPORT_PREFIX + key[len(PENDING_PREFIX):])
+            if not report or parse_report_record(report)['id']:
+                self.delete_from_kv(key)
+        vote_before = time() - CONF.consul.report_interval
+        for key, value in snapshot.get_prefix(VOTE_PREFIX).items():
+            # Failures are reported on their own by then
+            try:
+                if json.loads(value)['time'] >= vote_before:
                     continue
-                report_time = datetime.strptime(report_time_str,
-                                                "%Y-%m-%d %H:%M:%S")
-                if datetime.now() - report_time > self.reap_interval:
-                    self.cc.kv.delete(key)
-            elif valid_cluster_port(key):
-                # Dealing with "<ip>:<port>" = <host_id>
-                ip_addr = key.split(':')[0]
-                if ip_addr not in [x['Addr'] for x in self.cc.agent.members()]:
-                    self.cc.kv.delete(key)
+            except (ValueError, KeyError, TypeError):
+                pass
+            self.delete_from_kv(key)
+        for key, value in reports.items():
+            record = parse_report_record(value)
+            if not record['id']:
+                # This key value pair was not reported.Don't delete the key
+                continue
+            if record['report_time'] < reap_before:
+                self.delete_from_kv(key)
+        for key in snapshot.get_prefix(HOSTID_PREFIX):
+            # Dealing with "<ip>:<port>" = <host_id>
+            ip_addr = key[len(HOSTID_PREFIX):].split(':')[0]
+            if ip_addr not in member_addrs:
+                self.delete_from_kv(key)
 
@@ -6,9 +6,13 @@ from os.path import exists
 from os import makedirs
 from oslo_config import cfg
 
+import atexit
 import logging
 import logging.handlers
 import logging.config
+import Queue
+import threading
+import time
 
 CONF = cfg.CONF
 
@@ -16,7 +20,15 @@ log_group = cfg.OptGroup('log', title='Group for all log options')
 log_opts = [
     cfg.StrOpt('level', default='DEBUG', help='Log level'),
     cfg.StrOpt('file', default='/var/log/pf9/pf9-ha.log',
-               help='log file location')
+               help='log file location'),
+    cfg.BoolOpt('use_queue', default=False,
+                help='Hand log records to a background writer thread so '
+                     'that the status loop does not wait on file I/O'),
+    cfg.IntOpt('rate_limit_interval', default=0,
+               help='Seconds over which identical messages are rate limited.'
+                    ' 0 disables rate limiting'),
+    cfg.IntOpt('rate_limit_burst', default=5,
+               help='Identical messages let through per rate limit interval')
 ]
 
 CONF.register_group(log_group)
@@ -37,9 +49,117 @@ def setup_log_dir_and_file(filename, mode='a', encoding=None, owner=None):
     except:
         return logging.NullHandler()
 
+_STOP = object()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue without formatting them. A writer thread formats
+    them and hands them to the target handler. Records are dropped rather
+    than blocking the caller when the queue is full.
+    """
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._write, name='log-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.stop)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord(dict(
+                    name=__name__, levelno=logging.WARN, levelname='WARNING',
+                    msg='Log queue was full, dropped %d messages',
+                    args=(dropped,))))
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def stop(self, timeout=5):
+        if self._writer.is_alive():
+            self.queue.put(_STOP)
+            self._writer.join(timeout)
+        self.target.close()
+
+    def close(self):
+        self.stop()
+        logging.Handler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst identical messages through in every interval seconds
+    """
+    def __init__(self, interval, burst):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self._seen = {}
+
+    def _key(self, record):
+        key = (record.name, record.levelno, record.msg)
+        try:
+            return hash(key + (record.args,))
+        except TypeError:
+            return hash(key + (repr(record.args),))
+
+    def filter(self, record):
+        now = time.time()
+        key = self._key(record)
+        window_start, count, suppressed = self._seen.get(key, (now, 0, 0))
+        if now - window_start >= self.interval:
+            window_start, count = now, 0
+        if count >= self.burst:
+            self._seen[key] = (window_start, count, suppressed + 1)
+            return False
+        if suppressed:
+            record.msg = '%s (%d identical messages suppressed)' % (
+                record.msg, suppressed)
+        self._seen[key] = (window_start, count + 1, 0)
+        if len(self._seen) > 10000:
+            for k, (start, _, skipped) in self._seen.items():
+                if now - start >= self.interval and not skipped:
+                    del self._seen[k]
+        return True
+
+
+def setup_handler(filename):
+    handler = setup_log_dir_and_file(filename)
+    if CONF.log.use_queue:
+        handler = QueueHandler(handler)
+    if CONF.log.rate_limit_interval:
+        handler.addFilter(RateLimitFilter(CONF.log.rate_limit_interval,
+                                          CONF.log.rate_limit_burst))
+    return handler
+
+
 def setup_logger():
+    """
+    Configure the root logger. This is called once with the default options
+    when this module is imported and again once the config files are parsed.
+    """
     log_config = {
         'version': 1.0,
+        'disable_existing_loggers': False,
         'formatters': {
             'default': {
                 'format': '%(asctime)s %(name)s %(levelname)s %(message)s'
@@ -47,10 +167,10 @@ def setup_logger():
         },
         'handlers': {
             'file': {
-                '()': setup_log_dir_and_file,
+                '()': setup_handler,
                 'level': CONF.log.level,
                 'formatter': 'default',
-                'filename': LOG_FILE,
+                'filename': CONF.log.file,
             },
         },
         'root': {
@@ -58,6 +178,9 @@ def setup_logger():
             'level': CONF.log.level,
         },
     }
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
     logging.config.dictConfig(log_config)
 
 
@@ -2,10 +2,20 @@
 # All Rights Reserved
 
 from ha.utils import log as logging
+from ha.utils import trace
 from oslo_config import cfg
 
+from os import chmod
+from os import makedirs
+from os import rename
+from os.path import dirname
+from os.path import exists
+
+import calendar
 import json
+import random
 import requests
+import threading
 import time
 
 LOG = logging.getLogger(__name__)
@@ -23,18 +33,113 @@ keystone_opts = [
     cfg.StrOpt('admin_tenant_name', help='Tenant associated with masakari user')
 ]
 
+report_grp = cfg.OptGroup('report', title='Options related to reporting '
+                                          'status changes to the DU')
+report_opts = [
+    cfg.FloatOpt('connect_timeout', default=5,
+                 help='Seconds to wait for a connection to the DU'),
+    cfg.FloatOpt('read_timeout', default=15,
+                 help='Seconds to wait for the DU to respond'),
+    cfg.IntOpt('retries', default=2,
+               help='Number of times a report is retried when the DU cannot '
+                    'be reached or returns a server error'),
+    cfg.FloatOpt('retry_backoff', default=0.5,
+                 help='Seconds to wait before the first retry. The wait '
+                      'doubles with every retry and is randomized.'),
+    cfg.FloatOpt('retry_backoff_max', default=8,
+                 help='Maximum seconds to wait between retries'),
+    cfg.FloatOpt('report_timeout', default=60,
+                 help='Seconds after which no more attempts are made to '
+                      'report the changes of one status check. Changes that '
+                      'could not be reported are sent again later.'),
+    cfg.StrOpt('token_cache_file', default='/var/consul-status/token',
+               help='Keystone token is cached in this file so that it can be '
+                    'reused after a restart until it expires.')
+]
+
 CONF.register_group(keystone_auth_grp)
 CONF.register_opts(keystone_opts, keystone_auth_grp)
+CONF.register_group(report_grp)
+CONF.register_opts(report_opts, report_grp)
 
 
-class Reporter(object):
+class DeliveryFailed(Exception):
+    """
+    The DU could not be reached or kept returning server errors
+    """
+    pass
 
-    def __init__(self):
-        self.keystone_token_url = '/'.join([DU_URL, 'keystone', 'v2.0', 'tokens'])
+
+class TokenManager(object):
+    """
+    Keystone token shared by all the reporters of the process. The token is
+    fetched the first time it is needed, cached on disk along with its
+    expiry and refreshed in the background ahead of its expiry.
+    """
+    # Seconds before expiry after which the token is not handed out anymore
+    EXPIRY_MARGIN = 300
+    # Seconds before expiry at which the background refresh kicks in
+    REFRESH_AHEAD = 900
+    # Seconds between refresh attempts while keystone cannot be reached
+    RETRY_INTERVAL = 30
+
+    def __init__(self, token_url, cache_file):
+        self.token_url = token_url
+        self.cache_file = cache_file
         self.insecure = CONF.keystone_authtoken.insecure
-        self.token = self._get_token()
+        self.session = requests.Session()
+        self.timeout = (CONF.report.connect_timeout, CONF.report.read_timeout)
+        self._token = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    @staticmethod
+    def _expires_in(token):
+        """
+        Seconds until the token expires, None if it cannot be told
+        """
+        if not token:
+            return None
+        try:
+            expires = calendar.timegm(time.strptime(token['expires'],
+                                                    '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return expires - time.time()
+
+    def _need_refresh(self, token, margin=EXPIRY_MARGIN):
+        """
+        Return True if token should be refreshed. A missing token, e.g. when
+        keystone could not be reached, always needs a refresh.
+        """
+        expires_in = self._expires_in(token)
+        return expires_in is None or expires_in < margin
+
+    def _load(self):
+        if not exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file) as fptr:
+                return json.load(fptr)
+        except (IOError, ValueError):
+            LOG.warn('Ignoring unreadable token cache %s', self.cache_file)
+            return None
 
-    def _get_token(self):
+    def _save(self, token):
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            if not exists(dirname(self.cache_file)):
+                makedirs(dirname(self.cache_file))
+            with open(tmp_file, 'w') as fptr:
+                chmod(tmp_file, 0600)
+                json.dump(token, fptr)
+            rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            LOG.warn('Could not cache the token in %s', self.cache_file,
+                     exc_info=True)
+
+    def _fetch(self):
         headers = {'Content-Type': 'application/json'}
         data = {
             'auth': {
@@ -46,59 +151,253 @@ class Reporter(object):
             }
         }
         data = json.dumps(data)
-        resp = requests.post(self.keystone_token_url, data=data,
-                             headers=headers, verify=self.insecure)
+        try:
+            with trace.span('keystone.get_token') as sp:
+                resp = sp.record_response(self.session.post(
+                    self.token_url, data=data, headers=headers,
+                    verify=self.insecure, timeout=self.timeout))
+        except requests.RequestException:
+            LOG.warn('Could not reach keystone', exc_info=True)
+            return None
         if resp.status_code != requests.codes.ok:
-            return False
-        return resp.json()['access']['token']
+            LOG.error('Keystone returned %d', resp.status_code)
+            return None
+        try:
+            return resp.json()['access']['token']
+        except (ValueError, KeyError, TypeError):
+            LOG.error('Keystone returned an invalid token response')
+            return None
+
+    def _refresh(self, margin):
+        # Called with the lock held
+        if not self._loaded:
+            self._token = self._load()
+            self._loaded = True
+        if self._need_refresh(self._token, margin):
+            LOG.debug('Fetching new token as the old token has almost expired')
+            token = self._fetch()
+            if token:
+                self._token = token
+                self._save(token)
+        return self._token
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                expires_in = self._expires_in(self._token)
+            if expires_in is None:
+                wait = self.RETRY_INTERVAL
+            else:
+                wait = max(expires_in - self.REFRESH_AHEAD,
+                           self.RETRY_INTERVAL)
+            time.sleep(wait)
+            try:
+                with self._lock:
+                    self._refresh(self.REFRESH_AHEAD)
+            except Exception:
+                LOG.exception('Background token refresh failed')
+
+    def get(self):
+        """
+        Return a token that is valid for at least EXPIRY_MARGIN seconds or
+        None if no such token could be had from the cache or keystone.
+        """
+        with self._lock:
+            token = self._refresh(self.EXPIRY_MARGIN)
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop,
+                                                   name='token-refresh')
+                self._refresher.daemon = True
+                self._refresher.start()
+        if self._need_refresh(token):
+            return None
+        return token
 
-    def _need_refresh(self):
+    def invalidate(self, token_id):
         """
-        Return True if token should be refreshed.
+        Drop a token that was rejected, unless it was replaced already
         """
-        str_exp_time = self.token['expires']
-        token_time = time.strptime(str_exp_time, '%Y-%m-%dT%H:%M:%SZ')
-        current_time = time.gmtime()
+        with self._lock:
+            if self._token and self._token['id'] == token_id:
+                self._token = None
 
-        # If the Token's expiry is in 300 secs or less, it needs refresh
-        return True if time.mktime(token_time) - time.mktime(current_time) < 300.0 \
-            else False
 
-    def _refresh_token(self):
-        self.token = self._get_token()
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+
+def get_token_manager():
+    global _token_manager
+    with _token_manager_lock:
+        if _token_manager is None:
+            token_url = '/'.join([DU_URL, 'keystone', 'v2.0', 'tokens'])
+            _token_manager = TokenManager(token_url,
+                                          CONF.report.token_cache_file)
+    return _token_manager
+
+
+class Reporter(object):
+
+    def __init__(self):
+        # Keep-alive connections are reused across reports
+        self.session = requests.Session()
+        self.timeout = (CONF.report.connect_timeout, CONF.report.read_timeout)
+        # The token is fetched when the first report is sent, not here
+        self.token_manager = get_token_manager()
+
+    def _check_auth(self, resp, headers):
+        if resp.status_code == requests.codes.unauthorized:
+            # Fetch a new token for the next attempt
+            self.token_manager.invalidate(headers['X-Auth-Token'])
+            raise DeliveryFailed('Token was rejected')
+        return resp
+
+    def _post(self, span_name, url, payload, headers, retries=None,
+              deadline=None):
+        """
+        POST with retries. Connection errors, timeouts and server errors are
+        retried with a randomized exponential backoff. No attempt is started
+        after deadline, in seconds since the epoch. DeliveryFailed is raised
+        when all the attempts failed, any other response is returned.
+        """
+        if retries is None:
+            retries = CONF.report.retries
+        for attempt in range(retries + 1):
+            if attempt:
+                backoff = min(CONF.report.retry_backoff_max,
+                              CONF.report.retry_backoff * 2 ** (attempt - 1))
+                backoff = random.uniform(backoff / 2, backoff)
+                if deadline is not None and time.time() + backoff > deadline:
+                    break
+                time.sleep(backoff)
+            elif deadline is not None and time.time() > deadline:
+                break
+            try:
+                with trace.span(span_name) as sp:
+                    resp = sp.record_response(self.session.post(
+                        url, data=payload, headers=headers,
+                        verify=CONF.keystone_authtoken.insecure,
+                        timeout=self.timeout))
+            except requests.RequestException as e:
+                LOG.warn('POST %s failed (attempt %d of %d): %s', url,
+                         attempt + 1, retries + 1, e)
+                continue
+            if resp.status_code < 500:
+                return resp
+            LOG.warn('POST %s returned %d (attempt %d of %d)', url,
+                     resp.status_code, attempt + 1, retries + 1)
+        raise DeliveryFailed(url)
 
     def report_status(self, data):
         raise NotImplementedError()
 
+    def report_status_batch(self, data_list):
+        """
+        Report several status changes. Returns the result of each one, in
+        order. Reporters without a bulk API report them one at a time.
+        """
+        return [self.report_status(data) for data in data_list]
+
+
 class HaManagerReporter(Reporter):
+    """
+    Reports cluster status changes to hamgr. report_status returns True
+    only once hamgr accepted the report. Other reports stay pending in the
+    consul KV store and are sent again by the cluster leader, whichever
+    node that is by then.
+    """
 
     def __init__(self):
         self.hamgr_url = '/'.join([DU_URL, 'hamgr', 'v1', 'ha'])
+        # Cleared when hamgr turns out not to have the bulk events API
+        self.batch_supported = True
         super(HaManagerReporter, self).__init__()
 
-    def report_status(self, data):
-        if self._need_refresh():
-            LOG.debug("Fetching new token as the old token has almost expired")
-            self._refresh_token()
+    def _get_headers(self):
+        token = self.token_manager.get()
+        if not token:
+            raise DeliveryFailed('No keystone token')
         headers = {
             "Content-Type": "application/json",
-            "X-Auth-Token": self.token['id']
+            "X-Auth-Token": token['id']
         }
+        if trace.current_trace_id():
+            headers[trace.TRACE_HEADER] = trace.current_trace_id()
+        return headers
+
+    @staticmethod
+    def _get_event(data):
         if data['eventType'] == 1:
-            event = 'host-up'
+            return {'event': 'host-up', 'event_details': data}
         elif data['eventType'] == 2:
-            event = 'host-down'
-        payload = json.dumps({'event': event, 'event_details': data})
-        try:
-            host_url = '/'.join([self.hamgr_url, data['hostname']])
-            resp = requests.post(host_url, data=payload, headers=headers,
-                                 verify=CONF.keystone_authtoken.insecure)
+            return {'event': 'host-down', 'event_details': data}
+
+    def _send(self, events, retries=None):
+        """
+        Send the events to hamgr and return the result of each one. Raises
+        DeliveryFailed if hamgr could not be reached with the bulk API.
+        Events hamgr did not answer for properly are not delivered, nor are
+        the ones left when report_timeout has passed.
+        """
+        deadline = time.time() + CONF.report.report_timeout
+        headers = self._get_headers()
+        if len(events) > 1 and self.batch_supported:
+            resp = self._post('hamgr.report_status_batch',
+                              '/'.join([self.hamgr_url, 'events']),
+                              json.dumps({'events': events}), headers,
+                              retries=retries, deadline=deadline)
+            self._check_auth(resp, headers)
+            if resp.status_code == requests.codes.ok:
+                try:
+                    results = [r.get('success', False) is True
+                               for r in resp.json()['results']]
+                except (ValueError, KeyError, AttributeError, TypeError):
+                    LOG.error('HA manager returned an invalid response')
+                    return [False] * len(events)
+                # Events without a result were not handled
+                return (results + [False] * len(events))[:len(events)]
+            if resp.status_code != requests.codes.not_found:
+                LOG.error('HA manager returned %d', resp.status_code)
+                return [False] * len(events)
+            LOG.info('HA manager does not support reporting events in '
+                     'bulk, reporting them one at a time')
+            self.batch_supported = False
+        results = []
+        for event in events:
+            host_url = '/'.join([self.hamgr_url,
+                                 event['event_details']['hostname']])
+            try:
+                resp = self._post('hamgr.report_status', host_url,
+                                  json.dumps(event), headers, retries=retries,
+                                  deadline=deadline)
+                self._check_auth(resp, headers)
+            except (DeliveryFailed, requests.RequestException):
+                # The events accepted so far must not be sent again
+                LOG.error('Could not report the status of %s',
+                          event['event_details']['hostname'], exc_info=True)
+                results.append(False)
+                continue
             if resp.status_code != requests.codes.ok:
                 LOG.error('HA manager returned %d', resp.status_code)
-                return False
+                results.append(False)
             else:
-                LOG.info('Status reported successfully to HA manager')
-                return resp.json().get('success', False)
-        except:
+                try:
+                    results.append(resp.json().get('success', False) is True)
+                except (ValueError, AttributeError):
+                    LOG.error('HA manager returned an invalid response')
+                    results.append(False)
+        return results
+
+    def report_status_batch(self, data_list):
+        events = [self._get_event(data) for data in data_list]
+        try:
+            results = self._send(events)
+        except (DeliveryFailed, requests.RequestException):
             LOG.error('Status report failed', exc_info=True)
-            return False
+            return [False] * len(events)
+        LOG.info('%d status changes reported to HA manager, %d accepted',
+                 len(events), len([r for r in results if r]))
+        return results
+
+    def report_status(self, data):
+        return self.report_status_batch([data])[0]
@@ -0,0 +1,181 @@
+# Copyright 2017 Platform9 Systems Inc.
+# All Rights Reserved
+
+"""
+Timing instrumentation for calls made from the host agent to consul and to
+the Platform9 DU. Each call is recorded as a span with its duration, status
+code and response payload size. Spans recorded while a trace is active share
+its trace ID, which is also sent along with status reports so that hamgr
+can record its own spans under the same trace.
+"""
+
+from contextlib import contextmanager
+from ha.utils import log as logging
+from oslo_config import cfg
+from uuid import uuid4
+
+import collections
+import functools
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+trace_grp = cfg.OptGroup('trace', title='Options related to call timing '
+                                        'instrumentation')
+trace_opts = [
+    cfg.ListOpt('sink', default=[],
+                help='Sinks that receive the call timings. Valid values are '
+                     'log and memory.'),
+    cfg.IntOpt('buffer_size', default=1000,
+               help='Number of spans held by the memory sink')
+]
+
+CONF.register_group(trace_grp)
+CONF.register_opts(trace_opts, trace_grp)
+
+TRACE_HEADER = 'X-Trace-Id'
+
+_sinks = []
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, name, trace_id=None, operation=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.operation = operation
+        self.start = time.time()
+        self.duration = None
+        self.status_code = None
+        self.payload_size = None
+        self.error = None
+
+    def record_response(self, resp):
+        """
+        Record the status code and payload size of a requests response
+        """
+        self.status_code = getattr(resp, 'status_code', None)
+        try:
+            self.payload_size = len(resp.content)
+        except (AttributeError, TypeError):
+            pass
+        return resp
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    trace_id=self.trace_id,
+                    operation=self.operation,
+                    start=self.start,
+                    duration=self.duration,
+                    status_code=self.status_code,
+                    payload_size=self.payload_size,
+                    error=self.error)
+
+
+class LogSink(object):
+    def emit(self, span):
+        LOG.info('span %s trace=%s operation=%s duration=%.3fs status=%s '
+                 'size=%s error=%s', span.name, span.trace_id,
+                 span.operation, span.duration, span.status_code,
+                 span.payload_size, span.error)
+
+
+class RingBufferSink(object):
+    def __init__(self, size=1000):
+        self._spans = collections.deque(maxlen=size)
+
+    def emit(self, span):
+        self._spans.append(span.to_dict())
+
+    def spans(self, trace_id=None):
+        spans = list(self._spans)
+        if trace_id:
+            spans = [s for s in spans if s['trace_id'] == trace_id]
+        return spans
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def clear_sinks():
+    del _sinks[:]
+
+
+def get_spans(trace_id=None):
+    spans = []
+    for sink in _sinks:
+        if isinstance(sink, RingBufferSink):
+            spans.extend(sink.spans(trace_id=trace_id))
+    return spans
+
+
+def configure():
+    clear_sinks()
+    for name in CONF.trace.sink:
+        if name == 'log':
+            add_sink(LogSink())
+        elif name == 'memory':
+            add_sink(RingBufferSink(CONF.trace.buffer_size))
+        else:
+            LOG.warn('Ignoring unknown trace sink %s', name)
+
+
+def current_trace_id():
+    return getattr(_local, 'trace_id', None)
+
+
+def _emit(span):
+    for sink in _sinks:
+        try:
+            sink.emit(span)
+        except Exception:
+            LOG.exception('Trace sink %s failed', sink)
+
+
+@contextmanager
+def start_trace(operation):
+    """
+    Group all the spans opened within this context under one trace ID. Nested
+    calls reuse the outer trace.
+    """
+    if current_trace_id():
+        yield _local.trace_id
+        return
+    _local.trace_id = str(uuid4())
+    _local.operation = operation
+    try:
+        yield _local.trace_id
+    finally:
+        _local.trace_id = None
+        _local.operation = None
+
+
+@contextmanager
+def span(name):
+    sp = Span(name, trace_id=current_trace_id(),
+              operation=getattr(_local, 'operation', None))
+    try:
+        yield sp
+    except Exception as e:
+        sp.error = e.__class__.__name__
+        raise
+    finally:
+        sp.finish()
+        _emit(sp)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return inner
+    return decorator